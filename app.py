@@ -2,21 +2,28 @@
 """
 WebAI Search Service - Main Application
 """
-from flask import Flask, render_template, request, jsonify, session, redirect
+from flask import Flask, render_template, request, jsonify, session, redirect, Response
 from flask_socketio import SocketIO, emit
 import subprocess
-import threading
 import os
 import sys
 import json
 import time
 from datetime import datetime
 import secrets
-import queue
 import re
 from dotenv import load_dotenv
 from session_manager import SessionManager
+from token_budget import history_budget, estimate_tokens
 from file_converter import FileConverter
+from claude_worker_pool import WorkerPool
+from job_scheduler import JobScheduler, QueueFull
+import io_reactor
+from response_cache import ResponseCache, prompt_version
+from latency_model import LatencyModel, DEADLINE_HEADER
+from upstream_client import UpstreamClient
+from stream_utils import (DeltaStream, EmitBuffer, EmitMetrics, EventQueue, ReplayStore, RESUME_GRACE,
+                          send_to_queue, sse_event, wants_deltas)
 from werkzeug.utils import secure_filename
 # from config import DB_PATH, APP_LOG  # Disabled after rollback
 
@@ -27,7 +34,13 @@ app = Flask(__name__)
 
 # Initialize session manager
 # Use external HDD for database storage
-session_manager = SessionManager('webai.db')
+# WEBAI_WRITE_BEHIND=1 batches message writes on a background writer thread
+# WEBAI_ARCHIVE_DB=<path> 古いチャットを別DBに退避 (utils/archive_chats.py)
+session_manager = SessionManager(
+    'webai.db',
+    write_behind=os.environ.get('WEBAI_WRITE_BEHIND', '0') == '1',
+    archive_path=os.environ.get('WEBAI_ARCHIVE_DB')
+)
 file_converter = FileConverter()
 
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -41,18 +54,37 @@ ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'secure_password_123')
 # Claude実行パス
 CLAUDE_EXECUTABLE = os.environ.get('CLAUDE_EXECUTABLE', 'claude')
 
-class ClaudeRunner:
-    def __init__(self, socketio, session_id):
-        self.socketio = socketio
-        self.session_id = session_id
-        self.process = None
-        self.output_queue = queue.Queue()
-        
-    def run_query(self, prompt):
-        """Claudeコマンドを実行してプロンプトを処理"""
-        try:
-            # Web検索機能を明示的に有効にするプロンプトを構築
-            enhanced_prompt = f"""あなたはWeb検索機能を持つAIアシスタントです。
+# 起動済みの `claude --print` プロセスを待機させておき、プロンプトはstdinで渡す
+claude_workers = WorkerPool(
+    lambda profile: [CLAUDE_EXECUTABLE, '--print'],
+    warm_profiles=['default'],
+    stderr=subprocess.STDOUT,
+    env={**os.environ, 'PYTHONUNBUFFERED': '1'}
+)
+
+# 同時実行数の上限と待ち行列 (WEBAI_DEFAULT_CONCURRENCY, WEBAI_QUEUE_SIZE)
+job_scheduler = JobScheduler()
+QUEUE_REPORT_INTERVAL = 2  # 待ち順位を通知する間隔 (秒)
+
+# 同じ質問への回答キャッシュ (WEBAI_RESPONSE_CACHE_MB=0 で無効, WEBAI_RESPONSE_CACHE_DB で永続化)
+response_cache = ResponseCache(path=os.environ.get('WEBAI_RESPONSE_CACHE_DB'))
+
+# モデルと思考モード (ultrathink等) ごとの実行時間の履歴から決める期限 (WEBAI_LATENCY_DB で永続化)
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+DEADLINE_SLACK = 5  # /api/send の読み取りタイムアウトの余裕 (秒)。API側の504を先に受け取る
+
+# APIへの接続をキープアライブで使い回す (WEBAI_UPSTREAM_POOL_SIZE, WEBAI_UPSTREAM_POOL_BLOCK)
+upstream = UpstreamClient()
+
+# 行ごとのemitをまとめて送る (WEBAI_EMIT_INTERVAL_MS, WEBAI_EMIT_BYTES, WEBAI_EMIT_SENTENCE_MS)
+emit_metrics = EmitMetrics()
+
+# 差分形式のストリームの直近のイベント。再接続したクライアントは resume で続きから受け取る
+# (WEBAI_REPLAY_TTL, WEBAI_REPLAY_MAX_MB, WEBAI_REPLAY_EVENTS, WEBAI_RESUME_GRACE)
+replay_store = ReplayStore()
+
+# Web検索機能を明示的に有効にするプロンプト
+WEB_SEARCH_PROMPT = """あなたはWeb検索機能を持つAIアシスタントです。
 必要に応じてWebSearch toolを使用して、最新の情報や特定のWebサイトの内容を検索してください。
 
 ユーザーの質問: {prompt}
@@ -61,92 +93,194 @@ class ClaudeRunner:
 1. 最新の情報が必要な場合は、WebSearch toolを使用して検索を実行
 2. 特定のWebサイトについて聞かれた場合は、そのサイトの内容を検索
 3. 検索結果を元に、正確で有用な回答を提供"""
+PROMPT_VERSION = prompt_version(WEB_SEARCH_PROMPT)
+
+# 実行中・待機中のクエリ (Socket.IO sid -> {job_id: (runner, job)})。切断・cancel_query で中止する
+active_queries = {}
+# 接続が切れたクエリ (stream_id -> (runner, job))。RESUME_GRACE 秒以内に resume されなければ中止
+detached_queries = {}
+# POST /api/query で始めたクエリ (job_id -> (stream_id, runner, job))。ストリームが replay_store から消えたら外す
+stream_jobs = {}
+FINAL_UPDATES = ('complete', 'cancelled', 'error')  # ストリームを終える stream_update の type
+
+# Keep the first turn of a chat (usually the task description) in every history window
+HISTORY_PIN_FIRST = os.environ.get('WEBAI_HISTORY_PIN_FIRST', '1') == '1'
+
+# ページングの上限 (1リクエストあたりの最大件数)
+MAX_PAGE_SIZE = 200
+
+def get_page_args(default_limit=None):
+    """Read before_id/after_id/limit cursor parameters from the query string"""
+    limit = request.args.get('limit', default_limit, type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return {
+        'before_id': request.args.get('before_id', type=int),
+        'after_id': request.args.get('after_id', type=int),
+        'limit': limit
+    }
+
+def owns_chat(chat_id, user_id):
+    """クライアントが指定した chat_id がこのユーザーのチャットか (存在しないチャットも False)"""
+    return session_manager.get_chat_owner(chat_id) == user_id
+
+def emit_to(target, name, payload):
+    socketio.emit(name, payload, room=target)
+
+class ClaudeRunner:
+    def __init__(self, socketio, session_id, deltas=False, owner=None, chat_id=None, send=emit_to):
+        self.socketio = socketio
+        self.session_id = session_id
+        self.send = send  # 差分形式の送り先: Socket.IO の sid (emit_to) か SSE の EventQueue (send_to_queue)
+        self.process = None
+        self.worker = None
+        self.cancelled = False
+        self.deadline = None
+        self.accumulated_output = []
+        # protocol 2 のクライアントには差分 (stream_id, seq, delta) だけを送る
+        self.stream = DeltaStream() if deltas else None
+        self.emitter = None
+        # 回答はチャットDBにも逐次保存する (chat_id 指定時)。リロードしても途中まで表示できる
+        self.chat_id = chat_id
+        self.message = None
+        if self.stream is not None:
+            replay_store.open(self.stream.stream_id, session_id, owner=owner)
+        
+    def _send(self, update, final=False):
+        """stream_update を送信。差分形式は再開用に保存し、resume後は新しい接続へ送る"""
+        if self.stream is not None:
+            replay_store.publish(self.stream.stream_id, 'stream_update', update, self.send, final=final)
+        else:
+            self.socketio.emit('stream_update', update, room=self.session_id)
+        
+    def _emit_text(self, text):
+        """まとめた出力を1フレームで送信: 差分形式は新しい部分、旧形式は全文"""
+        if self.message is not None:
+            session_manager.append_to_message(self.message, text)
+        if self.stream is not None:
+            update = {'type': 'delta', **self.stream.delta(text)}
+        else:
+            update = {'type': 'assistant', 'content': '\n'.join(self.accumulated_output)}
+        update['timestamp'] = datetime.now().isoformat()
+        self._send(update)
+        
+    def _final(self, update_type):
+        """complete / cancelled の通知: 旧形式は全文、差分形式は最後のseqとチェックサム"""
+        # 溜まっている出力を先に送る (中止時は捨てる)
+        self.emitter.close(flush=update_type == 'complete')
+        if self.message is not None and update_type == 'complete':
+            session_manager.finish_message(self.message)
+        if self.stream is not None:
+            update = {'type': update_type, **self.stream.end()}
+        else:
+            update = {'type': update_type, 'content': '\n'.join(self.accumulated_output)}
+        update['timestamp'] = datetime.now().isoformat()
+        self._send(update, final=True)
+        
+    def _error(self, content):
+        """エラーの通知: 溜まっている出力は先に回答とリプレイへ送る (中止時だけ捨てる)"""
+        if self.emitter is not None:
+            self.emitter.close(flush=not self.cancelled)
+        self._send({
+            'type': 'error',
+            'content': content,
+            'timestamp': datetime.now().isoformat()
+        }, final=True)
+        
+    def cancel(self):
+        """クライアントが離れた: 実行中のClaudeをプロセスグループごと終了"""
+        self.cancelled = True
+        if self.worker is not None:
+            claude_workers.cancel(self.worker)
+        
+    def run_query(self, prompt, deadline):
+        """Claudeコマンドを実行してプロンプトを処理"""
+        worker = None
+        self.deadline = deadline
+        try:
+            # Web検索機能を明示的に有効にするプロンプトを構築
+            enhanced_prompt = WEB_SEARCH_PROMPT.format(prompt=prompt)
             
-            # Claudeコマンドを構築
-            cmd = [CLAUDE_EXECUTABLE, enhanced_prompt]
-            
-            # プロセスを開始
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                env={**os.environ, 'PYTHONUNBUFFERED': '1'}
-            )
-            
-            # 出力を読み取るスレッドを開始
-            read_thread = threading.Thread(target=self._read_output)
-            read_thread.daemon = True
-            read_thread.start()
+            # 待機中のClaudeプロセスを取得してプロンプトを渡す
+            worker = claude_workers.acquire('default')
+            self.worker = worker
+            if self.cancelled:
+                return
+            # 最初の出力の期限は実行開始から数える。全体の期限は到着時からで、待ち行列で使い切っていれば実行しない
+            deadline.begin()
+            deadline.check()
+            worker.send(enhanced_prompt)
+            self.process = worker.process
             
-            # 出力をリアルタイムで送信
-            accumulated_output = []
-            while True:
-                try:
-                    line = self.output_queue.get(timeout=0.1)
-                    if line is None:  # プロセス終了
-                        break
-                    
-                    accumulated_output.append(line)
-                    
-                    # 特定のパターンを検出して進捗を表示
-                    if "WebSearch" in line or "searching" in line.lower():
-                        self.socketio.emit('stream_update', {
-                            'type': 'progress',
-                            'content': f"🔍 {line}",
-                            'timestamp': datetime.now().isoformat()
-                        }, room=self.session_id)
-                    elif "WebFetch" in line or "fetching" in line.lower():
-                        self.socketio.emit('stream_update', {
-                            'type': 'progress',
-                            'content': f"📄 {line}",
-                            'timestamp': datetime.now().isoformat()
-                        }, room=self.session_id)
-                    else:
-                        # 通常の出力を蓄積して表示
-                        current_content = '\n'.join(accumulated_output)
-                        self.socketio.emit('stream_update', {
-                            'type': 'assistant',
-                            'content': current_content,
-                            'timestamp': datetime.now().isoformat()
-                        }, room=self.session_id)
-                    
-                except queue.Empty:
-                    if self.process.poll() is not None:
-                        # プロセスが終了している
-                        break
+            # 出力はI/Oリアクターのスレッドが行単位で届ける (プロセスごとの読み取りスレッドは不要)
+            self.accumulated_output = []
+            if self.chat_id is not None:
+                # status 'streaming' の空の回答を先に作り、まとめて送るたびに追記する
+                self.message = session_manager.start_message(self.chat_id)
+            # 送信は共有のタイマースレッド、DBへの追記は session_manager の書き込みスレッドで行う (リアクタースレッドを止めない)
+            self.emitter = EmitBuffer(self._emit_text, name=self.session_id or self.stream.stream_id,
+                                      metrics=emit_metrics, defer=True)
+            stream = io_reactor.get_reactor().register(
+                self.process.stdout, on_line=self._on_line, process=self.process)
+            # 全体・最初の出力・無出力の期限を超えたらプロセスグループごと終了
+            phase = deadline.wait(stream.done)
+            if phase:
+                worker.kill()
+                stream.wait()
+                # 打ち切った実行も下限値として記録し、遅い実行が履歴から抜け落ちないようにする
+                latency_model.record(deadline, timed_out=True)
+            returncode = stream.returncode
             
             # 最終的な結果を送信
-            if self.process.returncode == 0:
-                self.socketio.emit('stream_update', {
-                    'type': 'complete',
-                    'content': '\n'.join(accumulated_output),
-                    'timestamp': datetime.now().isoformat()
-                }, room=self.session_id)
+            if phase:
+                self._error(f'処理がタイムアウトしました ({phase}, {deadline.elapsed():.0f}秒)')
+            elif self.cancelled:
+                self._final('cancelled')
+            elif returncode == 0:
+                response_cache.put(prompt, 'default', '\n'.join(self.accumulated_output),
+                                   web_search=True, version=PROMPT_VERSION)
+                latency_model.record(deadline)
+                self._final('complete')
             else:
-                self.socketio.emit('stream_update', {
-                    'type': 'error',
-                    'content': f'Process exited with code {self.process.returncode}',
-                    'timestamp': datetime.now().isoformat()
-                }, room=self.session_id)
+                self._error(f'Process exited with code {returncode}')
                 
         except Exception as e:
-            self.socketio.emit('stream_update', {
-                'type': 'error',
-                'content': str(e),
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+            self._error(str(e))
+        finally:
+            if self.emitter is not None:
+                # 通常はどの経路でも閉じ済み。_error 自体が失敗した場合だけ残りを捨てる
+                self.emitter.close(flush=False)
+            if self.message is not None and not self.message.finished:
+                # 中止・タイムアウト・エラー: 途中までの回答を残す
+                session_manager.finish_message(self.message, 'interrupted')
+            if self.stream is not None:
+                replay_store.close(self.stream.stream_id)
+            if worker is not None:
+                claude_workers.release(worker)
     
-    def _read_output(self):
-        """出力を読み取ってキューに追加"""
-        try:
-            for line in iter(self.process.stdout.readline, ''):
-                if line:
-                    self.output_queue.put(line.strip())
-            self.output_queue.put(None)  # 終了シグナル
-        except Exception as e:
-            self.output_queue.put(f"Error reading output: {e}")
+    def _on_line(self, line):
+        """リアクタースレッドから1行ずつ呼ばれ、進捗や途中経過を送信"""
+        line = line.strip()
+        self.deadline.touch()
+        self.accumulated_output.append(line)
+        self.worker.tokens += estimate_tokens(line)
+        
+        # 全行を改行区切りで追記 (旧形式のcontentと同じ全文になる)。送信は時間・サイズ・文末でまとめる
+        self.emitter.add(line if len(self.accumulated_output) == 1 else '\n' + line)
+        
+        # 特定のパターンを検出して進捗を表示
+        if "WebSearch" in line or "searching" in line.lower():
+            self._send({
+                'type': 'progress',
+                'content': f"🔍 {line}",
+                'timestamp': datetime.now().isoformat()
+            })
+        elif "WebFetch" in line or "fetching" in line.lower():
+            self._send({
+                'type': 'progress',
+                'content': f"📄 {line}",
+                'timestamp': datetime.now().isoformat()
+            })
 
 @app.route('/')
 def index():
@@ -215,9 +349,23 @@ def get_chats():
         return jsonify({'error': 'Not authenticated'}), 401
     
     user_id = session['username']
-    chats = session_manager.get_user_chats(user_id)
+    chats = session_manager.get_user_chats(user_id, **get_page_args(default_limit=50))
     return jsonify(chats)
 
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Full-text search across the user's chats"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索語を入力してください'}), 400
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return jsonify(session_manager.search_messages(session['username'], query, limit=limit, offset=offset))
+
 @app.route('/api/send', methods=['POST'])
 def api_send():
     """Send message API endpoint"""
@@ -234,50 +382,52 @@ def api_send():
         return jsonify({'error': 'No message provided'}), 400
     
     user_id = session['username']
+    if chat_id and not owns_chat(chat_id, user_id):
+        return jsonify({'error': 'このチャットにはアクセスできません'}), 403
     
     # Create new chat if needed
     if not chat_id:
         chat_id = session_manager.create_chat(user_id)
     
-    # Save user message
-    session_manager.add_message(chat_id, 'user', message)
+    # Save user message (queued in write-behind mode)
+    user_message_saved = session_manager.submit_message(chat_id, 'user', message)
     
     try:
         # Build conversation history if session mode is enabled
-        conversation_history = []
-        if use_session:
-            conversation_history = session_manager.build_conversation_history(chat_id)
-            # Remove the last message (current one) to avoid duplication
-            if conversation_history and conversation_history[-1]['content'] == message:
-                conversation_history = conversation_history[:-1]
-        
-        # Prepare the full prompt with history
         full_prompt = message
-        if conversation_history:
-            # Format conversation history
-            history_text = ""
-            for msg in conversation_history:
-                role = "ユーザー" if msg['role'] == 'user' else "アシスタント"
-                history_text += f"\n{role}: {msg['content']}\n"
-            
-            full_prompt = f"以下は過去の会話履歴です:\n{history_text}\n\n現在のユーザーの質問: {message}"
+        if use_session:
+            # Read-your-writes: wait for the message just queued; its id bounds the history
+            user_message_id = user_message_saved.result()
+            # Turns before the current message that fit the model's token budget,
+            # pre-rendered by the recent-turns cache
+            history_text = session_manager.build_history_text(
+                chat_id,
+                before_id=user_message_id,
+                max_tokens=history_budget(model),
+                pin_first=HISTORY_PIN_FIRST
+            )
+            if history_text:
+                full_prompt = f"以下は過去の会話履歴です:\n{history_text}\n\n現在のユーザーの質問: {message}"
         
         # Use simple API for now
-        import requests
+        # 残りの期限をヘッダーで渡し、APIも同じ期限で打ち切る
         api_url = "http://localhost:8001/chat"
-        response = requests.post(
+        deadline = latency_model.deadline(model, message)
+        response = upstream.post(
             api_url,
             json={'message': full_prompt, 'model': model},
-            timeout=600
+            headers={DEADLINE_HEADER: deadline.header()},
+            timeout=deadline.remaining() + DEADLINE_SLACK
         )
         
         if response.status_code == 200:
             result = response.json()
             assistant_message = result.get('message', '')
+            latency_model.record(deadline)
             
             # Save assistant response
             if assistant_message:
-                session_manager.add_message(chat_id, 'assistant', assistant_message)
+                session_manager.submit_message(chat_id, 'assistant', assistant_message)
             
             return jsonify({
                 'message': assistant_message,
@@ -288,6 +438,101 @@ def api_send():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/query', methods=['POST'])
+def api_query():
+    """クエリを開始して job_id を返す。出力は GET /api/stream/<job_id> (SSE) で受け取る"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.get_json() or {}
+    prompt = data.get('prompt', '')
+    if not prompt:
+        return jsonify({'error': 'No prompt provided'}), 400
+    
+    user_id = session['username']
+    chat_id = data.get('chat_id')
+    if chat_id and not owns_chat(chat_id, user_id):
+        return jsonify({'error': 'このチャットにはアクセスできません'}), 403
+    chat_id = chat_id or session_manager.create_chat(user_id)
+    session_manager.submit_message(chat_id, 'user', prompt)
+    for job_id, entry in list(stream_jobs.items()):
+        if entry[0] not in replay_store:
+            del stream_jobs[job_id]
+    
+    # キャッシュ済みの回答も同じストリームとして保存し、/api/stream で受け取らせる
+    cached = response_cache.get(prompt, 'default', web_search=True, version=PROMPT_VERSION)
+    if cached is not None:
+        session_manager.submit_message(chat_id, 'assistant', cached)
+        stream = DeltaStream()
+        replay_store.open(stream.stream_id, None, owner=user_id)
+        for update, final in (({'type': 'delta', **stream.delta(cached)}, False),
+                              ({'type': 'complete', **stream.end()}, True)):
+            update['timestamp'] = datetime.now().isoformat()
+            replay_store.publish(stream.stream_id, 'stream_update', update, send_to_queue, final=final)
+        replay_store.close(stream.stream_id)
+        stream_jobs[stream.stream_id] = (stream.stream_id, None, None)
+        return jsonify({'job_id': stream.stream_id, 'stream_id': stream.stream_id, 'chat_id': chat_id,
+                        'state': 'finished', 'cached': True}), 202
+    
+    runner = ClaudeRunner(socketio, None, deltas=True, owner=user_id, chat_id=chat_id, send=send_to_queue)
+    try:
+        job = job_scheduler.submit('default', runner.run_query, prompt,
+                                   latency_model.deadline('default', prompt))
+    except QueueFull as e:
+        replay_store.close(runner.stream.stream_id)
+        response = jsonify({
+            'error': f'混雑しています。{e.retry_after}秒後にもう一度お試しください。',
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    
+    stream_jobs[job.id] = (runner.stream.stream_id, runner, job)
+    job.future.add_done_callback(lambda future: forget_query(runner, job))
+    # 誰も /api/stream に接続しないまま RESUME_GRACE 秒たったら中止 (切断時と同じ)
+    if RESUME_GRACE > 0:
+        detach_query(runner, job)
+    return jsonify({**job.status(), 'job_id': job.id, 'stream_id': runner.stream.stream_id,
+                    'chat_id': chat_id}), 202
+
+@app.route('/api/stream/<job_id>', methods=['GET'])
+def api_stream(job_id):
+    """ジョブの出力を Server-Sent Events で送る (イベント名は stream_update の type, id は seq)
+    再接続時はブラウザが送る Last-Event-ID (最後に受け取った seq) の続きから"""
+    if 'username' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    stream_id, runner, job = stream_jobs.get(job_id, (None, None, None))
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_seq = 0
+    events = EventQueue()
+    if (stream_id is None
+            or replay_store.resume(stream_id, last_seq, events, send_to_queue, owner=session['username']) is None):
+        return jsonify({'error': 'このストリームは再開できません。もう一度質問してください。'}), 404
+    detached_queries.pop(stream_id, None)
+    
+    def generate():
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    yield ': keep-alive\n\n'  # プロキシの読み取りタイムアウト対策・切断の検出
+                    continue
+                update = event[1]
+                yield sse_event(update['type'], update, update.get('seq'))
+                if update['type'] in FINAL_UPDATES:
+                    return
+        finally:
+            # 途中で切断: 別の接続が引き継いでいなければ再接続を待ってから中止
+            if runner is not None and replay_store.running(stream_id) and replay_store.target(stream_id) is events:
+                detach_query(runner, job)
+    
+    # nginx の proxy_buffering off と同じく、X-Accel-Buffering でこの応答のバッファリングを止める
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/clear', methods=['POST'])
 def api_clear():
     """Clear context API endpoint"""
@@ -305,7 +550,7 @@ def get_chat_messages(chat_id):
     if 'username' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    messages = session_manager.get_chat_messages(chat_id)
+    messages = session_manager.get_chat_messages(chat_id, **get_page_args())
     return jsonify(messages)
 
 @app.route('/api/chats/<int:chat_id>', methods=['DELETE'])
@@ -364,6 +609,18 @@ def api_upload():
     except Exception as e:
         return jsonify({'error': f'ファイル処理エラー: {str(e)}'}), 500
 
+@app.route('/api/ready', methods=['GET'])
+def api_ready():
+    """Readiness: 200 once a pre-started Claude worker is waiting"""
+    status = claude_workers.ready()
+    status['jobs'] = job_scheduler.snapshot()
+    status['cache'] = response_cache.snapshot()
+    status['latency'] = latency_model.snapshot()
+    status['emit'] = emit_metrics.snapshot()
+    status['replay'] = replay_store.snapshot()
+    status['upstream'] = upstream.snapshot()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/api/monitor', methods=['GET'])
 def api_monitor():
     """Get Claude monitor status"""
@@ -419,13 +676,136 @@ def handle_query(data):
     prompt = data.get('prompt', '')
     session_id = data.get('session_id', request.sid)
     
-    # バックグラウンドでClaudeを実行
-    runner = ClaudeRunner(socketio, session_id)
-    thread = threading.Thread(target=runner.run_query, args=(prompt,))
-    thread.daemon = True
-    thread.start()
+    # 質問と回答をチャットに保存 (chat_id がなければ新しいチャット)
+    chat_id = data.get('chat_id')
+    if chat_id and not owns_chat(chat_id, session['username']):
+        emit('error', {'error': 'このチャットにはアクセスできません'})
+        return
+    chat_id = chat_id or session_manager.create_chat(session['username'])
+    session_manager.submit_message(chat_id, 'user', prompt)
+    
+    # 同じ質問の回答がキャッシュにあれば、Claudeを起動せず同じイベントで返す
+    cached = response_cache.get(prompt, 'default', web_search=True, version=PROMPT_VERSION)
+    if cached is not None:
+        session_manager.submit_message(chat_id, 'assistant', cached)
+        emit('query_started', {'status': 'Processing your query...', 'cached': True, 'chat_id': chat_id})
+        if wants_deltas(data):
+            stream = DeltaStream()
+            updates = [{'type': 'delta', **stream.delta(cached)}, {'type': 'complete', **stream.end()}]
+        else:
+            updates = [{'type': update_type, 'content': cached} for update_type in ('assistant', 'complete')]
+        for update in updates:
+            update['timestamp'] = datetime.now().isoformat()
+            socketio.emit('stream_update', update, room=session_id)
+        return
+    
+    # スケジューラ経由でClaudeを実行 (上限を超えた分は待ち行列へ)
+    runner = ClaudeRunner(socketio, session_id, deltas=wants_deltas(data), owner=session['username'],
+                          chat_id=chat_id)
+    try:
+        job = job_scheduler.submit('default', runner.run_query, prompt,
+                                   latency_model.deadline('default', prompt))
+    except QueueFull as e:
+        emit('query_rejected', {
+            'error': f'混雑しています。{e.retry_after}秒後にもう一度お試しください。',
+            'retry_after': e.retry_after
+        })
+        return
+    
+    # 切断・cancel_query で止められるよう登録し、終了したら外す
+    active_queries.setdefault(request.sid, {})[job.id] = (runner, job)
+    job.future.add_done_callback(lambda future: forget_query(runner, job))
     
-    emit('query_started', {'status': 'Processing your query...'})
+    # 最初の差分より前に切断されても resume できるよう stream_id を先に渡す
+    stream_info = {'chat_id': chat_id}
+    if runner.stream is not None:
+        stream_info['stream_id'] = runner.stream.stream_id
+    if job.state == 'running':
+        emit('query_started', {'status': 'Processing your query...', 'job_id': job.id, **stream_info})
+    else:
+        emit('query_queued', {**job.status(), **stream_info})
+        socketio.start_background_task(report_queue_position, job, session_id)
+
+def report_queue_position(job, session_id):
+    """開始まで待ち順位と開始予定時刻を通知"""
+    while not job.started.wait(QUEUE_REPORT_INTERVAL):
+        status = job.status()
+        if status['state'] != 'queued':
+            break
+        socketio.emit('query_queued', status, room=session_id)
+    if job.state != 'cancelled':
+        socketio.emit('query_started', {'status': 'Processing your query...', 'job_id': job.id}, room=session_id)
+
+def forget_query(runner, job):
+    """終了したクエリを登録から外す (resume で別のsidへ移っていることもある)"""
+    for queries in list(active_queries.values()):
+        queries.pop(job.id, None)
+    if runner.stream is not None:
+        detached_queries.pop(runner.stream.stream_id, None)
+        # 待機中に取り消されたジョブは run_query を通らない
+        replay_store.close(runner.stream.stream_id)
+
+def cancel_queries(sid, job_id=None):
+    """sidのクエリ (job_id指定時はその1件) を中止: 待機中なら取り消し、実行中ならClaudeを終了"""
+    cancelled = []
+    for runner, job in list(active_queries.get(sid, {}).values()):
+        if job_id is not None and job.id != job_id:
+            continue
+        if not job.cancel():
+            runner.cancel()
+        cancelled.append(job.id)
+    return cancelled
+
+@socketio.on('cancel_query')
+def handle_cancel_query(data=None):
+    """クライアントからの明示的な中止 (job_id省略時は実行中の全クエリ)"""
+    job_ids = cancel_queries(request.sid, (data or {}).get('job_id'))
+    emit('query_cancelled', {'job_ids': job_ids})
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    """タブを閉じた・接続が切れた: 結果を受け取る相手がいないので中止
+    差分形式のクエリは RESUME_GRACE 秒だけ続け、再接続したクライアントの resume を待つ"""
+    for runner, job in active_queries.pop(request.sid, {}).values():
+        if runner.stream is not None and RESUME_GRACE > 0:
+            detach_query(runner, job)
+        elif not job.cancel():
+            runner.cancel()
+
+def detach_query(runner, job):
+    """受け取る相手のいない差分形式のクエリ: RESUME_GRACE 秒以内に再接続されなければ中止"""
+    detached_queries[runner.stream.stream_id] = (runner, job)
+    socketio.start_background_task(cancel_detached, runner.stream.stream_id)
+
+def cancel_detached(stream_id):
+    """猶予が過ぎても再接続されなかったクエリを中止"""
+    socketio.sleep(RESUME_GRACE)
+    entry = detached_queries.pop(stream_id, None)
+    if entry is not None:
+        runner, job = entry
+        if not job.cancel():
+            runner.cancel()
+
+@socketio.on('resume')
+def handle_resume(data):
+    """再接続したクライアントに last_seq より後のイベントを送り、以後の出力も新しい接続へ送る"""
+    if 'username' not in session:
+        emit('error', {'error': 'Not authenticated'})
+        return
+    stream_id = data.get('stream_id')
+    try:
+        last_seq = int(data.get('last_seq') or 0)
+    except (TypeError, ValueError):
+        last_seq = 0
+    replayed = replay_store.resume(stream_id, last_seq, request.sid, emit_to, owner=session['username'])
+    if replayed is None:
+        emit('resume_failed', {'stream_id': stream_id, 'error': 'このストリームは再開できません。もう一度質問してください。'})
+        return
+    entry = detached_queries.pop(stream_id, None)
+    if entry is not None:
+        # 中止されずに済んだクエリは新しい接続の cancel_query / 切断で止められるようにする
+        active_queries.setdefault(request.sid, {})[entry[1].id] = entry
+    emit('stream_resumed', {'stream_id': stream_id, 'replayed': replayed})
 
 if __name__ == '__main__':
     # 必要なディレクトリを作成
@@ -13,6 +13,7 @@ from datetime import datetime
 import secrets
 import threading
 import re
+from stream_utils import DeltaStream, wants_deltas
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -37,9 +38,11 @@ AVAILABLE_MODELS = [
 DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'claude-opus-4-20250514')
 
 class ClaudeAPIRunner:
-    def __init__(self, socketio, session_id):
+    def __init__(self, socketio, session_id, deltas=False):
         self.socketio = socketio
         self.session_id = session_id
+        # protocol 2 のクライアントには差分 (stream_id, seq, delta) だけを送る
+        self.stream = DeltaStream() if deltas else None
         
     def run_query(self, prompt, model=None):
         """Claude Code APIを使用してプロンプトを処理"""
@@ -131,22 +134,23 @@ class ClaudeAPIRunner:
                                             'timestamp': datetime.now().isoformat()
                                         }, room=self.session_id)
                                     
-                                    # 通常の出力を送信
-                                    current_content = ''.join(accumulated_content)
-                                    self.socketio.emit('stream_update', {
-                                        'type': 'assistant',
-                                        'content': current_content,
-                                        'timestamp': datetime.now().isoformat()
-                                    }, room=self.session_id)
+                                    # 通常の出力を送信 (差分形式は新しい部分だけ、旧形式は全文)
+                                    if self.stream is not None:
+                                        update = {'type': 'delta', **self.stream.delta(content)}
+                                    else:
+                                        update = {'type': 'assistant', 'content': ''.join(accumulated_content)}
+                                    update['timestamp'] = datetime.now().isoformat()
+                                    self.socketio.emit('stream_update', update, room=self.session_id)
                         except json.JSONDecodeError:
                             continue
             
             # 完了通知
-            self.socketio.emit('stream_update', {
-                'type': 'complete',
-                'content': ''.join(accumulated_content),
-                'timestamp': datetime.now().isoformat()
-            }, room=self.session_id)
+            if self.stream is not None:
+                update = {'type': 'complete', **self.stream.end()}
+            else:
+                update = {'type': 'complete', 'content': ''.join(accumulated_content)}
+            update['timestamp'] = datetime.now().isoformat()
+            self.socketio.emit('stream_update', update, room=self.session_id)
                 
         except requests.exceptions.Timeout:
             self.socketio.emit('stream_update', {
@@ -244,7 +248,7 @@ def handle_query(data):
     session_id = data.get('session_id', request.sid)
     
     # バックグラウンドでClaude APIを実行
-    runner = ClaudeAPIRunner(socketio, session_id)
+    runner = ClaudeAPIRunner(socketio, session_id, deltas=wants_deltas(data))
     thread = threading.Thread(target=runner.run_query, args=(prompt, model))
     thread.daemon = True
     thread.start()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Asyncio front end for SessionManager
+Runs the blocking sqlite3 calls on a dedicated executor so coroutines never stall the event loop
+"""
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from session_manager import SessionManager
+
+# Executor defaults
+IO_WORKERS = 4  # SQLite allows one writer at a time, so a few threads cover reads
+
+
+class _SharedRead:
+    """One in-flight read and the number of coroutines waiting on it"""
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSessionManager:
+    """Same API as SessionManager, with every method a coroutine
+
+    Identical reads issued while one is already running share its result
+    instead of queueing another query. Cancelling the last waiter of a read
+    cancels it, interrupting the SQLite statement if it has already started.
+    """
+    def __init__(self, db_path='webai.db', manager=None, max_workers=IO_WORKERS, **manager_kwargs):
+        self._owns_manager = manager is None
+        self.manager = manager or SessionManager(db_path, **manager_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='session-io')
+        self._inflight = {}
+        # Bumped after every write so that reads started earlier are not
+        # shared with callers that expect to see that write
+        self._generation = 0
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self.stats = {'reads': 0, 'coalesced': 0, 'interrupted': 0}
+
+    # Reads
+
+    async def get_user_chats(self, user_id, limit=50, before_id=None, after_id=None):
+        """Get user's chat list, most recently updated first"""
+        return await self._read('get_user_chats', user_id, limit=limit,
+                                before_id=before_id, after_id=after_id)
+
+    async def get_chat_messages(self, chat_id, before_id=None, after_id=None, limit=None):
+        """Get messages for a specific chat, oldest first"""
+        return await self._read('get_chat_messages', chat_id, before_id=before_id,
+                                after_id=after_id, limit=limit)
+
+    async def get_session_context(self, user_id):
+        """Get saved session context for a user"""
+        return await self._read('get_session_context', user_id)
+
+    async def build_conversation_history(self, chat_id, limit=20, before_id=None, max_tokens=None, pin_first=False):
+        """Build conversation history for Claude API"""
+        return await self._read('build_conversation_history', chat_id, limit=limit, before_id=before_id,
+                                max_tokens=max_tokens, pin_first=pin_first)
+
+    async def build_history_text(self, chat_id, limit=20, before_id=None, max_tokens=None, pin_first=False):
+        """Same window as build_conversation_history, rendered for the prompt"""
+        return await self._read('build_history_text', chat_id, limit=limit, before_id=before_id,
+                                max_tokens=max_tokens, pin_first=pin_first)
+
+    # Writes
+
+    async def create_chat(self, user_id, title=None):
+        """Create a new chat session"""
+        return await self._write(self.manager.create_chat, user_id, title)
+
+    async def add_message(self, chat_id, role, content):
+        """Add a message to a chat and return its id"""
+        return await self._write(self.manager.submit_message, chat_id, role, content)
+
+    async def delete_chat(self, chat_id):
+        """Delete a chat and all its messages"""
+        return await self._write(self.manager.delete_chat, chat_id)
+
+    async def save_session_context(self, user_id, context):
+        """Save session context for a user"""
+        return await self._write(self.manager.save_session_context, user_id, context)
+
+    async def clear_session_context(self, user_id):
+        """Clear session context for a user"""
+        return await self._write(self.manager.clear_session_context, user_id)
+
+    async def flush(self, timeout=None):
+        """Wait until every queued write so far has been committed"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.manager.flush, timeout)
+
+    async def close(self):
+        """Finish running queries and release the executor (and the manager, if ours)"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+        if self._owns_manager:
+            await loop.run_in_executor(None, self.manager.close)
+
+    # Internals
+
+    async def _read(self, name, *args, **kwargs):
+        """Run a read on the executor, sharing it with identical concurrent reads"""
+        self.stats['reads'] += 1
+        key = (name, args, tuple(sorted(kwargs.items())), self._generation)
+        shared = self._inflight.get(key)
+        if shared is None:
+            task = asyncio.ensure_future(self._run(getattr(self.manager, name), *args, **kwargs))
+            shared = _SharedRead(task)
+            self._inflight[key] = shared
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats['coalesced'] += 1
+
+        shared.waiters += 1
+        try:
+            return await asyncio.shield(shared.task)
+        except asyncio.CancelledError:
+            # Only abandon the query once nobody else is waiting for it
+            if shared.waiters == 1:
+                shared.task.cancel()
+            raise
+        finally:
+            shared.waiters -= 1
+
+    async def _run(self, fn, *args, **kwargs):
+        """Call fn in a worker thread; interrupt its statement if cancelled mid-query"""
+        token = object()
+        future = self._executor.submit(self._call, token, fn, args, kwargs)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Not started yet: the executor drops it. Running: stop the statement
+            if not future.cancel():
+                self._interrupt(token)
+            raise
+
+    def _call(self, token, fn, args, kwargs):
+        """Worker-thread side of _run: publish this thread's connection while fn runs"""
+        conn = self.manager.pool.get()
+        with self._running_lock:
+            self._running[token] = conn
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._running_lock:
+                del self._running[token]
+
+    def _interrupt(self, token):
+        with self._running_lock:
+            conn = self._running.get(token)
+            if conn is not None:
+                conn.interrupt()
+                self.stats['interrupted'] += 1
+
+    async def _write(self, fn, *args):
+        """Run a write to completion, even if the caller stops waiting
+
+        Writes are never interrupted: a half-saved conversation is worse than
+        a late one. submit_message returns a Future, which is awaited as well.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.shield(loop.run_in_executor(self._executor, fn, *args))
+            if isinstance(result, Future):
+                result = await asyncio.shield(asyncio.wrap_future(result))
+            return result
+        finally:
+            self._generation += 1
@@ -20,6 +20,10 @@ import chardet
 from PyPDF2 import PdfReader
 from docx import Document
 
+from latency_model import LatencyModel, DeadlineExceeded, DEADLINE_HEADER
+from stream_utils import DeltaStream, EmitBuffer, EmitMetrics, ReplayStore, RESUME_GRACE, wants_deltas
+from upstream_client import UpstreamClient
+
 # Load environment variables
 load_dotenv()
 
@@ -67,9 +71,60 @@ ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'secure_password_123')
 # Claude API URL - Use host.docker.internal when running in Docker
 CLAUDE_API_URL = os.environ.get('CLAUDE_API_URL', 'http://host.docker.internal:8000')
 
+# Deadlines from recorded answer times per model and thinking mode, instead of a flat 120 s;
+# the remaining budget is sent in X-Request-Deadline so the host API enforces the same one
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+DEADLINE_SLACK = 5  # Extra seconds on the read timeout, so the host API's own error arrives first
+
+# Keep-alive connections to the host API, shared by all greenlets (WEBAI_UPSTREAM_POOL_SIZE,
+# WEBAI_UPSTREAM_POOL_BLOCK); the session is created on first use, after monkey_patch()
+upstream = UpstreamClient()
+
 # Active sessions tracking
 active_sessions = {}
 
+# Upstream /message streams in progress, by Socket.IO sid; closing one aborts the
+# HTTP request, which makes the host API kill its Claude process
+active_streams = {}
+stream_stats = {'completed': 0, 'cancelled': 0}
+# Frames per stream after coalescing (WEBAI_EMIT_INTERVAL_MS, WEBAI_EMIT_BYTES, WEBAI_EMIT_SENTENCE_MS)
+emit_metrics = EmitMetrics()
+# Recent events of delta streams, replayed to clients that reconnect and send 'resume'
+# (WEBAI_REPLAY_TTL, WEBAI_REPLAY_MAX_MB, WEBAI_REPLAY_EVENTS, WEBAI_RESUME_GRACE)
+replay_store = ReplayStore()
+# Delta streams whose client disconnected, by stream id; aborted unless resumed within RESUME_GRACE
+detached_streams = {}
+
+
+def emit_to(target, name, payload):
+    socketio.emit(name, payload, room=target)
+
+
+def abort_stream(stream, sid):
+    stream['cancelled'] = True
+    stream_stats['cancelled'] += 1
+    try:
+        stream['response'].close()
+    except Exception as e:
+        logger.warning(f"Error closing upstream stream for {sid}: {e}")
+
+
+def cancel_stream(sid):
+    """Abort the sid's upstream streams; returns True if any was running"""
+    streams = active_streams.pop(sid, [])
+    for stream in streams:
+        abort_stream(stream, sid)
+    return bool(streams)
+
+
+def cancel_detached(stream_id):
+    """Abort a detached stream once the grace period passes without a resume"""
+    socketio.sleep(RESUME_GRACE)
+    stream = detached_streams.pop(stream_id, None)
+    if stream is not None:
+        logger.info(f"[STREAM] Not resumed within {RESUME_GRACE:.0f}s, aborting {stream_id}")
+        abort_stream(stream, stream_id)
+
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -336,7 +391,7 @@ def health_check():
         # Check Claude API availability
         claude_status = "unavailable"
         try:
-            response = requests.get(f"{CLAUDE_API_URL}/status", timeout=5)
+            response = upstream.get(f"{CLAUDE_API_URL}/status", timeout=5)
             if response.status_code == 200:
                 claude_status = "available"
         except:
@@ -346,7 +401,13 @@ def health_check():
             'status': 'healthy',
             'timestamp': datetime.utcnow().isoformat(),
             'claude_api': claude_status,
-            'active_sessions': len(active_sessions)
+            'active_sessions': len(active_sessions),
+            'active_streams': sum(len(streams) for streams in active_streams.values()),
+            'streams': dict(stream_stats),
+            'emit': emit_metrics.snapshot(),
+            'replay': replay_store.snapshot(),
+            'upstream': upstream.snapshot(),
+            'latency': latency_model.snapshot()
         })
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -381,18 +442,68 @@ def handle_connect():
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    """Handle WebSocket disconnection"""
+    """Handle WebSocket disconnection
+
+    Delta streams keep running for RESUME_GRACE seconds so a reconnecting client can resume
+    them; other streams are aborted right away.
+    """
+    for stream in active_streams.pop(request.sid, []):
+        if stream['stream_id'] is not None and RESUME_GRACE > 0:
+            detached_streams[stream['stream_id']] = stream
+            socketio.start_background_task(cancel_detached, stream['stream_id'])
+            logger.info(f"WebSocket disconnected mid-response, awaiting resume of {stream['stream_id']}: {request.sid}")
+        else:
+            abort_stream(stream, request.sid)
+            logger.info(f"WebSocket disconnected mid-response, aborted upstream stream: {request.sid}")
     if request.sid in active_sessions:
         del active_sessions[request.sid]
         logger.info(f"WebSocket disconnected: {request.sid}")
 
 
+@socketio.on('cancel_query')
+def handle_cancel_query(data=None):
+    """Stop the response being generated for this client"""
+    cancelled = cancel_stream(request.sid)
+    logger.info(f"[CANCEL] cancel_query from {request.sid}: {'aborted' if cancelled else 'nothing running'}")
+    emit('query_cancelled', {'cancelled': cancelled})
+
+
+@socketio.on('resume')
+def handle_resume(data):
+    """Replay what a reconnected client missed after last_seq and send the rest of the stream to it"""
+    if 'user_id' not in session:
+        emit('error', {'error': 'Authentication required'})
+        return
+    stream_id = data.get('stream_id')
+    try:
+        last_seq = int(data.get('last_seq') or 0)
+    except (TypeError, ValueError):
+        last_seq = 0
+    replayed = replay_store.resume(stream_id, last_seq, request.sid, emit_to, owner=session['user_id'])
+    if replayed is None:
+        logger.info(f"[RESUME] {stream_id} from seq {last_seq}: not available")
+        emit('resume_failed', {'stream_id': stream_id, 'error': 'The response can no longer be resumed'})
+        return
+    stream = detached_streams.pop(stream_id, None)
+    if stream is not None:
+        # Still running: cancel_query and disconnects of the new connection apply to it
+        active_streams.setdefault(request.sid, []).append(stream)
+    logger.info(f"[RESUME] {stream_id} from seq {last_seq}: replayed {replayed} events to {request.sid}")
+    emit('stream_resumed', {'stream_id': stream_id, 'replayed': replayed})
+
+
 @socketio.on('ping')
 def handle_ping(data):
     """Handle ping for testing"""
     logger.info(f"Received ping: {data}")
     emit('pong', {'timestamp': data.get('timestamp'), 'server_time': datetime.utcnow().isoformat()})
 
+def complete_event(deltas):
+    """stream_complete payload; with the delta protocol it also carries the last seq and checksum"""
+    if deltas is None:
+        return {'status': 'Response complete'}
+    return deltas.end(status='Response complete')
+
 @socketio.on('message')
 def handle_message(data):
     """Handle incoming chat message"""
@@ -411,6 +522,16 @@ def handle_message(data):
         model = data.get('model', 'claude-3-sonnet')
         web_search = data.get('web_search', True)
         session_id = session.get('user_id')
+        # Protocol 2 clients get numbered deltas ('stream_delta') instead of the whole text per chunk
+        deltas = DeltaStream() if wants_deltas(data) else None
+        sid = request.sid
+        
+        def send(name, payload, final=False):
+            """Emit a stream event; delta streams go through the replay store (resumable)"""
+            if deltas is not None:
+                replay_store.publish(deltas.stream_id, name, payload, emit_to, final=final)
+            else:
+                socketio.emit(name, payload, room=sid)
         
         if not user_message:
             logger.error("[MESSAGE] Empty message received")
@@ -419,8 +540,11 @@ def handle_message(data):
         
         logger.info(f"[MESSAGE] Processing: message='{user_message[:50]}...', model={model}, web_search={web_search}")
         
-        # Emit acknowledgment
-        emit('message_received', {'status': 'Processing your request...'})
+        # Emit acknowledgment (with the stream id, so the client can resume even before the first delta)
+        received = {'status': 'Processing your request...'}
+        if deltas is not None:
+            received['stream_id'] = deltas.stream_id
+        emit('message_received', received)
         
         # Prepare request for Claude API
         claude_request = {
@@ -431,16 +555,24 @@ def handle_message(data):
         }
         
         # Send request to Claude API
+        stream = None
+        response = None
+        emitter = None
+        completed = False  # The whole answer arrived: the connection can go back to the pool
+        deadline = latency_model.deadline(model, user_message)
         try:
             # Check API availability first
             logger.info(f"Checking Claude API health at {CLAUDE_API_URL}/health")
-            health_check = requests.get(f"{CLAUDE_API_URL}/health", timeout=5)
+            health_check = upstream.get(f"{CLAUDE_API_URL}/health", timeout=5)
             if health_check.status_code != 200:
                 logger.error(f"Claude API health check failed: {health_check.status_code}")
                 emit('error', {'error': 'Claude API is not available'})
                 return
             logger.info("Claude API health check passed")
             
+            if deltas is not None:
+                replay_store.open(deltas.stream_id, sid, owner=session_id)
+            
             # Send message to Claude API with model and web_search parameters
             api_request = {
                 'content': user_message,
@@ -451,26 +583,49 @@ def handle_message(data):
             logger.info(f"[CLAUDE] Sending request to Claude API: {api_request}")
             logger.info(f"[CLAUDE] URL: {CLAUDE_API_URL}/message")
             
-            response = requests.post(
+            # Read timeout: the longest silence allowed (the host API sends keep-alive lines)
+            read_timeout = min(deadline.remaining(), deadline.inactivity or deadline.remaining())
+            response = upstream.post(
                 f"{CLAUDE_API_URL}/message",
                 json=api_request,
                 stream=True,
-                timeout=120,
-                headers={'Accept': 'application/x-ndjson'}
+                timeout=(5, read_timeout + DEADLINE_SLACK),
+                headers={'Accept': 'application/x-ndjson', DEADLINE_HEADER: deadline.header()}
             )
             
+            # Register the stream so a disconnect or cancel_query can abort it
+            stream = {'response': response, 'cancelled': False,
+                      'stream_id': deltas.stream_id if deltas is not None else None}
+            active_streams.setdefault(request.sid, []).append(stream)
+            if request.sid not in active_sessions:
+                # Disconnected while the request was being sent
+                cancel_stream(request.sid)
+            
             logger.info(f"Claude API response status: {response.status_code}")
             if response.status_code != 200:
                 logger.error(f"Claude API error response: {response.text}")
-                emit('error', {'error': f'Claude API error: {response.status_code}'})
+                send('error', {'error': f'Claude API error: {response.status_code}'}, final=True)
                 return
             
-            # Stream response chunks
+            # Stream response chunks; lines are batched into frames, which the buffer's
+            # timer may send after this handler has moved on, hence socketio.emit to the sid
             current_content = ""
             chunk_count = 0
+            
+            def send_frame(text):
+                if deltas is not None:
+                    send('stream_delta', deltas.delta(text))
+                else:
+                    send('stream_chunk', {'chunk': current_content})
+            
+            emitter = EmitBuffer(send_frame, name=sid, metrics=emit_metrics)
             logger.info("[STREAM] Starting to stream response chunks")
             
             for line in response.iter_lines():
+                if stream['cancelled']:
+                    break
+                # Keep-alive lines arrive while Claude is silent; the deadline still applies
+                deadline.check()
                 if line:
                     try:
                         line_str = line.decode('utf-8')
@@ -482,24 +637,29 @@ def handle_message(data):
                             logger.debug(f"[STREAM] Parsed data: {data}")
                             
                             if 'content' in data:
+                                deadline.touch()
                                 chunk_content = data['content']
-                                if current_content:
-                                    current_content += "\n" + chunk_content
+                                # Blocks are joined with newlines; a delta continues the block before it
+                                if current_content and data.get('type') != 'delta':
+                                    delta = "\n" + chunk_content
                                 else:
-                                    current_content = chunk_content
+                                    delta = chunk_content
+                                current_content += delta
                                 
                                 chunk_count += 1
-                                logger.info(f"[STREAM] Emitting chunk {chunk_count}: {len(chunk_content)} chars to {request.sid}")
-                                emit('stream_chunk', {'chunk': current_content})
+                                logger.info(f"[STREAM] Buffering chunk {chunk_count}: {len(chunk_content)} chars for {request.sid}")
+                                emitter.add(delta)
                                 
                             elif 'error' in data:
                                 logger.error(f"[STREAM] Error from Claude API: {data['error']}")
-                                emit('error', {'error': data['error']})
+                                send('error', {'error': data['error']}, final=True)
                                 return
                                 
                             elif 'status' in data and data['status'] == 'complete':
                                 logger.info(f"[STREAM] Stream complete after {chunk_count} chunks")
-                                emit('stream_complete', {'status': 'Response complete'})
+                                completed = True
+                                emitter.close()
+                                send('stream_complete', complete_event(deltas), final=True)
                                 break
                                 
                     except json.JSONDecodeError as e:
@@ -507,18 +667,56 @@ def handle_message(data):
                     except Exception as e:
                         logger.error(f"[STREAM] Error parsing chunk: {e}")
             
-            logger.info(f"[STREAM] Final: Sent {chunk_count} chunks, total content length: {len(current_content)}")
-            emit('stream_complete', {'status': 'Response complete'})
+            if stream['cancelled']:
+                logger.info(f"[STREAM] Cancelled after {chunk_count} chunks")
+                return
+            
+            completed = True
+            emitter.close()
+            logger.info(f"[STREAM] Final: Sent {chunk_count} chunks in {emitter.frames} frames, total content length: {len(current_content)}")
+            send('stream_complete', complete_event(deltas), final=True)
+            if chunk_count:
+                latency_model.record(deadline)
             
+        except DeadlineExceeded as e:
+            # Closing the response tells the host API to kill the CLI run
+            logger.error(f"[CLAUDE] {e}")
+            response.close()
+            latency_model.record(deadline, timed_out=True)
+            if emitter is not None:
+                emitter.close()  # The text so far still reaches the client, before the error
+            send('error', {'error': 'Request timed out'}, final=True)
         except requests.exceptions.Timeout:
             logger.error("[CLAUDE] Request timed out")
-            emit('error', {'error': 'Request timed out'})
+            if emitter is not None:
+                emitter.close()
+            send('error', {'error': 'Request timed out'}, final=True)
         except requests.exceptions.ConnectionError as e:
             logger.error(f"[CLAUDE] Connection error: {e}")
-            emit('error', {'error': 'Claude API is not available'})
+            send('error', {'error': 'Claude API is not available'}, final=True)
         except Exception as e:
+            if stream is not None and stream['cancelled']:
+                # Reading from the response we closed in cancel_stream()
+                logger.info(f"[STREAM] Cancelled: {type(e).__name__}")
+                return
             logger.error(f"[CLAUDE] Request failed: {type(e).__name__}: {e}")
-            emit('error', {'error': f'Failed to connect to Claude API: {str(e)}'})
+            send('error', {'error': f'Failed to connect to Claude API: {str(e)}'}, final=True)
+        finally:
+            if emitter is not None:
+                emitter.close(flush=False)
+            if response is not None:
+                # Cancelled or failed: close the connection so the host API stops the run
+                upstream.release(response, reuse=completed)
+            if deltas is not None:
+                replay_store.close(deltas.stream_id)
+                detached_streams.pop(deltas.stream_id, None)
+            # After a resume the stream is registered under the new connection's sid
+            for stream_sid, streams in list(active_streams.items()):
+                if stream in streams:
+                    streams.remove(stream)
+                    stream_stats['completed'] += 1
+                    if not streams:
+                        active_streams.pop(stream_sid, None)
             
     except Exception as e:
         logger.error(f"[MESSAGE] Error handling message: {type(e).__name__}: {e}")
@@ -1,6 +1,11 @@
 let socket = null;
 let isConnected = false;
 let currentMessageDiv = null;
+// Delta protocol (stream_assembler.js); without it the server sends the whole text per chunk
+let assembler = typeof StreamAssembler !== 'undefined' ? new StreamAssembler() : null;
+// A delta stream is in progress: after a reconnect, ask the server to resume it
+let streaming = false;
+let resuming = false;
 
 // Initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
@@ -20,6 +25,10 @@ function initializeWebSocket() {
         console.log('Connected to WebSocket');
         updateConnectionStatus('connected');
         isConnected = true;
+        if (streaming) {
+            resuming = false;  // A resume sent on the old connection got no answer
+            resumeStream();
+        }
     });
     
     socket.on('disconnect', function() {
@@ -39,6 +48,10 @@ function initializeWebSocket() {
     });
     
     socket.on('message_received', function(data) {
+        if (assembler && data.stream_id) {
+            assembler.reset(data.stream_id);
+            streaming = true;
+        }
         if (currentMessageDiv) {
             currentMessageDiv.querySelector('.message-content').textContent = data.status;
         }
@@ -48,14 +61,50 @@ function initializeWebSocket() {
         handleStreamChunk(data.chunk);
     });
     
+    socket.on('stream_delta', function(data) {
+        if (assembler.apply(data)) {
+            showStreamText(assembler.text);
+        } else {
+            resumeStream();
+        }
+    });
+    
     socket.on('stream_complete', function(data) {
         console.log('Stream complete:', data.status);
+        if (assembler && data.stream_id) {
+            if (assembler.done && data.stream_id === assembler.streamId) {
+                return;  // Already completed (e.g. replayed after a resume)
+            }
+            if (!assembler.finish(data)) {
+                resumeStream();  // The replay brings the missing deltas and this event again
+                return;
+            }
+            showStreamText(assembler.text);
+        }
+        streaming = false;
+        currentMessageDiv = null;
+        enableInput();
+    });
+    
+    socket.on('stream_resumed', function(data) {
+        resuming = false;
+        console.log('Stream resumed:', data.stream_id, data.replayed, 'events replayed');
+    });
+    
+    socket.on('resume_failed', function(data) {
+        streaming = false;
+        resuming = false;
+        if (currentMessageDiv) {
+            currentMessageDiv.classList.add('message-error');
+        }
+        console.error('Resume failed:', data.error);
         currentMessageDiv = null;
         enableInput();
     });
     
     socket.on('error', function(data) {
         console.error('Server error:', data.error);
+        streaming = false;
         if (currentMessageDiv) {
             currentMessageDiv.querySelector('.message-content').textContent = 
                 `Error: ${data.error}`;
@@ -124,7 +173,11 @@ function sendMessage() {
     disableInput();
     
     // Send message via WebSocket
-    socket.emit('message', { message: message });
+    const payload = { message: message };
+    if (assembler) {
+        payload.protocol = STREAM_PROTOCOL;
+    }
+    socket.emit('message', payload);
 }
 
 function addMessage(content, sender, isThinking = false) {
@@ -190,6 +243,29 @@ function handleStreamChunk(chunk) {
     messageContainer.scrollTop = messageContainer.scrollHeight;
 }
 
+function resumeStream() {
+    if (resuming) {
+        return;  // The replay of the last resume is still on its way
+    }
+    resuming = true;
+    // last_seq: what has been applied (after a checksum mismatch, 0 to start over)
+    socket.emit('resume', { stream_id: assembler.streamId, last_seq: assembler.recover() });
+}
+
+function showStreamText(text) {
+    if (!currentMessageDiv) {
+        currentMessageDiv = addMessage('', 'ai');
+    }
+    
+    const contentDiv = currentMessageDiv.querySelector('.message-content');
+    contentDiv.classList.remove('message-thinking');
+    contentDiv.textContent = text;
+    
+    // Scroll to bottom
+    const messageContainer = document.getElementById('messageContainer');
+    messageContainer.scrollTop = messageContainer.scrollHeight;
+}
+
 function updateConnectionStatus(status) {
     const statusDot = document.querySelector('.status-dot');
     const statusText = document.querySelector('.status-text');
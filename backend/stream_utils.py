@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""
+Delta stream protocol (v2) for streamed answers
+Each update carries only the new text with the stream id and a sequence number, instead of
+the whole answer so far; every CHECKSUM_INTERVAL deltas and at the end, the CRC-32 and UTF-8
+length of the text up to that point let the client verify what it has reassembled
+EmitBuffer coalesces the CLI's line-by-line output into fewer, larger frames (one shared
+EmitTimer thread ends every buffer's window); ReplayStore keeps
+recent events so a client that lost its connection can resume a stream from its last seq;
+EventQueue lets an HTTP response (Server-Sent Events) be a ReplayStore target like a socket
+Copy of the root stream_utils.py: backend/ is built as its own Docker context
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+STREAM_PROTOCOL = 2          # Clients opt in with {'protocol': 2}; others get whole-text updates
+CHECKSUM_INTERVAL = 16       # Deltas between checksums
+
+# Emit coalescing (per deployment): a frame goes out when the oldest buffered text is
+# EMIT_INTERVAL old, EMIT_BYTES are buffered, or a sentence ends EMIT_SENTENCE_INTERVAL
+# after the previous frame - whichever comes first. WEBAI_EMIT_INTERVAL_MS=0 sends every chunk
+EMIT_INTERVAL = float(os.environ.get('WEBAI_EMIT_INTERVAL_MS', '40')) / 1000
+EMIT_BYTES = int(os.environ.get('WEBAI_EMIT_BYTES', '4096'))
+EMIT_SENTENCE_INTERVAL = float(os.environ.get('WEBAI_EMIT_SENTENCE_MS', '10')) / 1000
+RECENT_STREAMS = 50          # Finished streams kept for EmitMetrics.snapshot()
+
+# Resumable streams (delta protocol only)
+REPLAY_TTL = float(os.environ.get('WEBAI_REPLAY_TTL', '300'))        # Seconds a finished stream stays resumable
+REPLAY_MAX_BYTES = int(float(os.environ.get('WEBAI_REPLAY_MAX_MB', '32')) * 1024 * 1024)
+REPLAY_EVENTS = int(os.environ.get('WEBAI_REPLAY_EVENTS', '4096'))  # Ring size per stream
+RESUME_GRACE = float(os.environ.get('WEBAI_RESUME_GRACE', '20'))    # Seconds a run outlives its client's connection
+EVENT_OVERHEAD = 200         # Bytes counted per stored event besides its text
+SSE_KEEPALIVE = 15           # Seconds between comment lines on an idle event stream (proxy read timeouts)
+
+SENTENCE_END = re.compile(r'(?:[.!?。．！？]["\'」』）)]*|\n\n)\s*$')
+
+
+def wants_deltas(data):
+    """True if a client request opted in to the delta protocol"""
+    try:
+        return int((data or {}).get('protocol') or 1) >= STREAM_PROTOCOL
+    except (TypeError, ValueError):
+        return False
+
+
+class DeltaStream:
+    """The text of one streamed answer and the numbered delta events that rebuild it"""
+
+    def __init__(self, stream_id=None, checksum_interval=CHECKSUM_INTERVAL):
+        self.stream_id = stream_id or uuid.uuid4().hex
+        self.checksum_interval = checksum_interval
+        self.seq = 0
+        self.parts = []
+        self.length = 0          # UTF-8 bytes so far
+        self.crc32 = 0           # Of those bytes, updated incrementally
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def delta(self, text):
+        """Event payload appending text: {'stream_id', 'seq', 'delta'} (+ checksum)"""
+        data = text.encode('utf-8')
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.length += len(data)
+        self.parts.append(text)
+        self.seq += 1
+        event = {'stream_id': self.stream_id, 'seq': self.seq, 'delta': text}
+        if self.seq % self.checksum_interval == 0:
+            event.update(self.checksum())
+        return event
+
+    def checksum(self):
+        return {'crc32': self.crc32, 'length': self.length}
+
+    def end(self, **fields):
+        """Payload closing the stream: last seq and the checksum of the whole text"""
+        return {'stream_id': self.stream_id, 'seq': self.seq, **self.checksum(), **fields}
+
+
+class EmitMetrics:
+    """Frames per second of the streams an app is sending, for its status endpoint"""
+
+    def __init__(self, recent=RECENT_STREAMS):
+        self._lock = threading.Lock()
+        self._active = set()
+        self._recent = deque(maxlen=recent)
+        self.frames = 0
+        self.chunks = 0
+
+    def started(self, buffer):
+        with self._lock:
+            self._active.add(buffer)
+
+    def finished(self, buffer):
+        with self._lock:
+            self._active.discard(buffer)
+            self._recent.append(buffer.stats())
+            self.frames += buffer.frames
+            self.chunks += buffer.chunks
+
+    def snapshot(self):
+        with self._lock:
+            active = [buffer.stats() for buffer in self._active]
+            recent = list(self._recent)
+            frames, chunks = self.frames, self.chunks
+        return {
+            'interval_ms': EMIT_INTERVAL * 1000,
+            'max_bytes': EMIT_BYTES,
+            'frames': frames,
+            'chunks': chunks,
+            'chunks_per_frame': round(chunks / frames, 2) if frames else None,
+            'active': active,
+            'recent_fps': round(sum(s['fps'] for s in recent) / len(recent), 1) if recent else None
+        }
+
+
+class EmitTimer:
+    """One thread that ends the coalescing windows of every EmitBuffer
+
+    Instead of a threading.Timer per window, buffers push the deadline of their open
+    window onto a heap; the thread sleeps until the nearest one and calls the buffer
+    back. Entries of windows that were flushed early (size, sentence end, close) are
+    skipped when they come due.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []                  # (due, order, buffer, window), nearest first
+        self._order = itertools.count()
+        self._thread = None
+
+    def schedule(self, buffer, due, window):
+        """Call buffer._on_timer(window) at monotonic time due"""
+        with self._cond:
+            order = next(self._order)
+            heapq.heappush(self._heap, (due, order, buffer, window))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='emit-timer', daemon=True)
+                self._thread.start()
+            if self._heap[0][1] == order:
+                self._cond.notify()      # New nearest deadline
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                _, _, buffer, window = heapq.heappop(self._heap)
+            try:
+                buffer._on_timer(window)
+            except Exception:
+                # A failing flush callback must not stop the windows of the other streams
+                logger.exception(f"Emit flush failed for stream {buffer.name}")
+
+
+_emit_timer = None
+_emit_timer_lock = threading.Lock()
+
+
+def get_emit_timer():
+    """The process-wide EmitTimer; its thread starts with the first window"""
+    global _emit_timer
+    with _emit_timer_lock:
+        if _emit_timer is None:
+            _emit_timer = EmitTimer()
+        return _emit_timer
+
+
+class EmitBuffer:
+    """Collects one stream's text and passes it to flush(text) in batches
+
+    add() is called for each chunk as it arrives; the shared EmitTimer sends what is
+    left once the window ends, so nothing waits for the next chunk. With defer=True,
+    add() never flushes itself - a full buffer or a sentence end is handed to the
+    timer thread too - for callers that must not block (the I/O reactor's callbacks).
+    close() sends the rest and must come before the stream's final event. Calls of
+    flush are serialised by a second lock, which add() does not wait on, so frames keep
+    their order across the adding thread and the timer thread.
+    """
+
+    def __init__(self, flush, name=None, metrics=None, interval=EMIT_INTERVAL, max_bytes=EMIT_BYTES,
+                 sentence_interval=EMIT_SENTENCE_INTERVAL, defer=False):
+        self._flush = flush
+        self.name = name
+        self.defer = defer
+        self.metrics = metrics
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.sentence_interval = sentence_interval
+        self._lock = threading.Lock()        # Buffered text and window state
+        self._send_lock = threading.RLock()  # Held across flush(text); taken before _lock
+        self._pending = []
+        self._pending_bytes = 0
+        self._window = 0         # Bumped by every flush; stale timer entries carry an older one
+        self._due = None         # When the open window's nearest EmitTimer entry comes due
+        self._closed = False
+        self.started = time.monotonic()
+        self.last_frame = self.started
+        self.frames = 0
+        self.chunks = 0
+        if metrics is not None:
+            metrics.started(self)
+
+    def add(self, text):
+        with self._lock:
+            if self._closed or not text:
+                return
+            self.chunks += 1
+            self._pending.append(text)
+            self._pending_bytes += len(text.encode('utf-8'))
+            now = time.monotonic()
+            full = (self.interval <= 0 or self._pending_bytes >= self.max_bytes
+                    or (now - self.last_frame >= self.sentence_interval and SENTENCE_END.search(text)))
+            if not full or self.defer:
+                # The timer thread flushes: when the window ends, or right away
+                due = now if full else now + self.interval
+                if self._due is None or due < self._due:
+                    self._due = due
+                    get_emit_timer().schedule(self, due, self._window)
+                return
+        self.flush()
+
+    def _on_timer(self, window):
+        with self._send_lock:
+            if window == self._window and not self._closed:
+                self.flush()
+
+    def flush(self):
+        """Send everything buffered as one frame"""
+        with self._send_lock:
+            with self._lock:
+                self._window += 1
+                self._due = None
+                if not self._pending:
+                    return
+                text = ''.join(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+                self.frames += 1
+                self.last_frame = time.monotonic()
+            self._flush(text)
+
+    def close(self, flush=True):
+        """Send the rest (or drop it, for a cancelled stream); a pending timer entry is skipped"""
+        with self._send_lock:
+            if self._closed:
+                return
+            if flush:
+                self.flush()
+            with self._lock:
+                self._closed = True
+        if self.metrics is not None:
+            self.metrics.finished(self)
+
+    def stats(self):
+        seconds = max(time.monotonic() - self.started, 1e-3)
+        return {'stream': self.name, 'frames': self.frames, 'chunks': self.chunks,
+                'seconds': round(seconds, 2), 'fps': round(self.frames / seconds, 1)}
+
+
+class _Replay:
+    """Stored events of one stream"""
+
+    def __init__(self, target, owner):
+        self.target = target     # Where live events go; a resume moves it to the new connection
+        self.owner = owner
+        self.events = deque()    # (seq, name, payload, size), oldest first
+        self.seq = 0
+        self.first_seq = 1       # Lowest seq still stored (the ring drops older ones)
+        self.final = None        # (name, payload) of the event that ended the stream
+        self.finished = None
+        self.bytes = 0
+        self.outbox = deque()    # (send, target, name, payload) stored but not sent yet
+        self.sending = False     # A thread is emptying the outbox
+
+
+class ReplayStore:
+    """Recent events of delta streams, for clients that reconnect mid-answer
+
+    Each stream keeps its last REPLAY_EVENTS events and its final event. Finished streams
+    are dropped REPLAY_TTL seconds after they end; above REPLAY_MAX_BYTES the oldest
+    finished streams go first, then the oldest events of running ones. Events are sent
+    through the store - send(target, name, payload) - so that resume() can replay what a
+    client missed and move the live stream to its new connection without gaps or
+    reordering. send is called outside the store's lock, one thread at a time per stream
+    and in the order the events were stored.
+    """
+
+    def __init__(self, ttl=REPLAY_TTL, max_bytes=REPLAY_MAX_BYTES, max_events=REPLAY_EVENTS):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_events = max_events
+        self._lock = threading.RLock()
+        self._streams = OrderedDict()    # stream_id -> _Replay, oldest first
+        self.bytes = 0
+        self.stats = {'resumed': 0, 'replayed': 0, 'failed': 0, 'evicted': 0}
+
+    def open(self, stream_id, target, owner=None):
+        with self._lock:
+            self._evict()
+            self._streams[stream_id] = _Replay(target, owner)
+
+    def publish(self, stream_id, name, payload, send, final=False):
+        """Store an event and send it to the stream's current target"""
+        with self._lock:
+            replay = self._streams.get(stream_id)
+            if replay is None:
+                return
+            if replay.final is None:
+                replay.seq = payload.get('seq', replay.seq)
+                if final:
+                    replay.final = (name, payload)
+                    replay.finished = time.monotonic()
+                else:
+                    size = EVENT_OVERHEAD + len(str(payload.get('delta') or payload.get('content') or '').encode('utf-8'))
+                    replay.events.append((replay.seq, name, payload, size))
+                    replay.bytes += size
+                    self.bytes += size
+                    if len(replay.events) > self.max_events:
+                        self._drop_oldest(replay)
+                    if self.bytes > self.max_bytes:
+                        self._evict()
+            replay.outbox.append((send, replay.target, name, payload))
+        self._deliver(replay)
+
+    def _deliver(self, replay):
+        """Send the stream's queued events; a thread already doing so sends these too"""
+        with self._lock:
+            if replay.sending:
+                return
+            replay.sending = True
+        try:
+            while True:
+                with self._lock:
+                    if not replay.outbox:
+                        replay.sending = False
+                        return
+                    batch = list(replay.outbox)
+                    replay.outbox.clear()
+                for send, target, name, payload in batch:
+                    send(target, name, payload)
+        except BaseException:
+            with self._lock:
+                replay.sending = False
+            raise
+
+    def close(self, stream_id):
+        """The stream's producer is done (also without a final event, e.g. after an exception)"""
+        with self._lock:
+            replay = self._streams.get(stream_id)
+            if replay is not None and replay.finished is None:
+                replay.finished = time.monotonic()
+
+    def __contains__(self, stream_id):
+        with self._lock:
+            self._evict()
+            return stream_id in self._streams
+
+    def target(self, stream_id):
+        """Where the stream's live events go (None if unknown or nobody is listening)"""
+        with self._lock:
+            replay = self._streams.get(stream_id)
+            return replay.target if replay is not None else None
+
+    def running(self, stream_id):
+        with self._lock:
+            replay = self._streams.get(stream_id)
+            return replay is not None and replay.finished is None
+
+    def resume(self, stream_id, last_seq, target, send, owner=None):
+        """Send the events after last_seq to target and keep sending there
+
+        Returns the number of events replayed, or None if the stream is unknown, belongs
+        to someone else or no longer holds the events after last_seq.
+        """
+        with self._lock:
+            self._evict()
+            replay = self._streams.get(stream_id)
+            if (replay is None or (replay.owner is not None and replay.owner != owner)
+                    or last_seq < replay.first_seq - 1):
+                self.stats['failed'] += 1
+                return None
+            replayed = 0
+            for seq, name, payload, _ in replay.events:
+                if seq > last_seq:
+                    replay.outbox.append((send, target, name, payload))
+                    replayed += 1
+            if replay.final is not None:
+                replay.outbox.append((send, target, *replay.final))
+                replayed += 1
+            replay.target = target
+            self.stats['resumed'] += 1
+            self.stats['replayed'] += replayed
+        self._deliver(replay)
+        return replayed
+
+    def _drop_oldest(self, replay):
+        seq, _, _, size = replay.events.popleft()
+        replay.first_seq = seq + 1
+        replay.bytes -= size
+        self.bytes -= size
+
+    def _evict(self):
+        now = time.monotonic()
+        for stream_id, replay in list(self._streams.items()):
+            if replay.finished is not None and now - replay.finished > self.ttl:
+                self._remove(stream_id)
+        for stream_id, replay in list(self._streams.items()):
+            if self.bytes <= self.max_bytes:
+                return
+            if replay.finished is not None:
+                self._remove(stream_id)
+        for replay in list(self._streams.values()):
+            while replay.events and self.bytes > self.max_bytes:
+                self._drop_oldest(replay)
+
+    def _remove(self, stream_id):
+        replay = self._streams.pop(stream_id)
+        self.bytes -= replay.bytes
+        self.stats['evicted'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            self._evict()
+            return {
+                'streams': len(self._streams),
+                'running': sum(1 for replay in self._streams.values() if replay.finished is None),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                **self.stats
+            }
+
+
+def sse_event(name, payload, event_id=None):
+    """One Server-Sent Events message; the browser sends the last id back as Last-Event-ID"""
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+
+class EventQueue:
+    """ReplayStore target for one HTTP event stream: events wait here for the response to write them"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, name, payload):
+        self._queue.put((name, payload))
+
+    def get(self, timeout=SSE_KEEPALIVE):
+        """Next (name, payload), or None after timeout seconds without one"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def send_to_queue(target, name, payload):
+    """ReplayStore send function for EventQueue targets; with no target the event is only stored"""
+    if target is not None:
+        target.put(name, payload)
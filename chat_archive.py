@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Hot/cold tiering for WebAI chat history
+Idle chats move to an archive database ATTACHed to every pooled connection, so the
+hot webai.db stays small enough to live in the page cache
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = 'archive'
+ARCHIVE_IDLE_DAYS = 90     # Chats untouched this long are moved to the archive
+ARCHIVE_BATCH_SIZE = 50    # Chats moved per transaction
+
+# Explicit column lists; the hot tables gained columns through migrations
+CHAT_COLUMNS = ('id, user_id, title, created_at, updated_at, '
+                'message_count, user_message_count, last_message_at, total_chars')
+MESSAGE_COLUMNS = 'id, chat_id, role, content, created_at, token_count, content_encoding'
+
+# Both tiers as one chats table; the hot copy of a promoted chat wins
+ALL_CHATS = f'''(
+    SELECT {CHAT_COLUMNS} FROM main.chats
+    UNION ALL
+    SELECT {CHAT_COLUMNS} FROM archive.chats a
+    WHERE NOT EXISTS (SELECT 1 FROM main.chats h WHERE h.id = a.id)
+)'''
+
+ARCHIVE_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS archive.chats (
+           id INTEGER PRIMARY KEY,
+           user_id TEXT NOT NULL,
+           title TEXT NOT NULL,
+           created_at TIMESTAMP,
+           updated_at TIMESTAMP,
+           message_count INTEGER NOT NULL DEFAULT 0,
+           user_message_count INTEGER NOT NULL DEFAULT 0,
+           last_message_at TIMESTAMP,
+           total_chars INTEGER NOT NULL DEFAULT 0
+       )''',
+    '''CREATE TABLE IF NOT EXISTS archive.messages (
+           id INTEGER PRIMARY KEY,
+           chat_id INTEGER NOT NULL,
+           role TEXT NOT NULL,
+           content TEXT NOT NULL,
+           created_at TIMESTAMP,
+           token_count INTEGER,
+           content_encoding TEXT
+       )''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_messages_chat_id ON messages (chat_id, id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_chats_user_updated ON chats (user_id, updated_at DESC, id DESC)',
+]
+
+# Search index over archived bodies; rows only arrive and leave through the tiering job
+ARCHIVE_SEARCH_TABLES = [
+    '''CREATE VIEW IF NOT EXISTS archive.messages_plain AS
+       SELECT id, chat_id, role, webai_inflate(content, content_encoding) AS content, created_at
+       FROM messages''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS archive.messages_fts USING fts5(
+           content, content='messages_plain', content_rowid='id', tokenize='trigram'
+       )''',
+    '''CREATE TRIGGER IF NOT EXISTS archive.trg_messages_fts_insert AFTER INSERT ON messages
+       BEGIN
+           INSERT INTO messages_fts (rowid, content)
+           VALUES (NEW.id, webai_inflate(NEW.content, NEW.content_encoding));
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS archive.trg_messages_fts_delete AFTER DELETE ON messages
+       BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, content)
+           VALUES ('delete', OLD.id, webai_inflate(OLD.content, OLD.content_encoding));
+       END''',
+]
+
+
+def attach_hook(archive_path):
+    """Connect hook that ATTACHes the archive database as 'archive'"""
+    def attach(conn):
+        conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (archive_path,))
+        conn.execute(f'PRAGMA {ARCHIVE_SCHEMA}.journal_mode=WAL')
+        conn.execute(f'PRAGMA {ARCHIVE_SCHEMA}.synchronous=NORMAL')
+    return attach
+
+
+def create_archive_schema(conn, with_search=True):
+    for statement in ARCHIVE_TABLES + (ARCHIVE_SEARCH_TABLES if with_search else []):
+        conn.execute(statement)
+
+
+def chat_schema(conn, chat_id):
+    """'main' if the chat is hot (or unknown), 'archive' if only the archive has it"""
+    row = conn.execute('SELECT 1 FROM main.chats WHERE id = ?', (chat_id,)).fetchone()
+    if row is None and conn.execute('SELECT 1 FROM archive.chats WHERE id = ?', (chat_id,)).fetchone():
+        return ARCHIVE_SCHEMA
+    return 'main'
+
+
+def promote_chat(cursor, chat_id):
+    """Copy an archived chat back into the hot tables, inside the caller's transaction
+
+    The archive copy is left in place, shadowed by the hot one, and removed
+    by the next tiering run; the write itself only ever touches main.
+    Returns True if the chat was promoted.
+    """
+    if chat_schema(cursor, chat_id) != ARCHIVE_SCHEMA:
+        return False
+    # Counters start at zero; the message triggers rebuild them as rows arrive
+    cursor.execute('''
+        INSERT INTO main.chats (id, user_id, title, created_at, updated_at)
+        SELECT id, user_id, title, created_at, updated_at FROM archive.chats WHERE id = ?
+    ''', (chat_id,))
+    cursor.execute(f'''
+        INSERT INTO main.messages ({MESSAGE_COLUMNS})
+        SELECT {MESSAGE_COLUMNS} FROM archive.messages WHERE chat_id = ? ORDER BY id
+    ''', (chat_id,))
+    logger.info(f"Promoted archived chat {chat_id}")
+    return True
+
+
+def purge_promoted(conn):
+    """Drop archive copies of chats that have been promoted back to the hot tables"""
+    with conn:
+        conn.execute('DELETE FROM archive.messages WHERE chat_id IN (SELECT id FROM main.chats)')
+        conn.execute('DELETE FROM archive.chats WHERE id IN (SELECT id FROM main.chats)')
+
+
+def archive_idle_chats(conn, idle_days=ARCHIVE_IDLE_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move chats idle for more than idle_days to the archive; returns the moved chat ids
+
+    Each batch is copied and committed first, then deleted from the hot
+    tables in a second transaction. Transactions over attached WAL databases
+    are not atomic across files, so a crash in between leaves a duplicate
+    (the hot copy wins) rather than losing a chat.
+    """
+    purge_promoted(conn)
+    cutoff = f'-{int(idle_days)} days'
+    moved = []
+    last_id = 0
+    while True:
+        chat_ids = [row[0] for row in conn.execute('''
+            SELECT id FROM main.chats
+            WHERE id > ? AND updated_at < datetime('now', ?)
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, cutoff, batch_size))]
+        if not chat_ids:
+            break
+        last_id = chat_ids[-1]
+        placeholders = ','.join('?' * len(chat_ids))
+
+        with conn:
+            conn.execute(f'''
+                INSERT OR REPLACE INTO archive.chats ({CHAT_COLUMNS})
+                SELECT {CHAT_COLUMNS} FROM main.chats WHERE id IN ({placeholders})
+            ''', chat_ids)
+            conn.execute(f'DELETE FROM archive.messages WHERE chat_id IN ({placeholders})', chat_ids)
+            conn.execute(f'''
+                INSERT INTO archive.messages ({MESSAGE_COLUMNS})
+                SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE chat_id IN ({placeholders})
+            ''', chat_ids)
+
+        with conn:
+            # Re-check idleness: a chat written to since the copy stays hot
+            # (its stale archive copy is purged on the next run)
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM temp.archive_batch')
+            conn.execute(f'''
+                INSERT INTO temp.archive_batch
+                SELECT id FROM main.chats WHERE id IN ({placeholders}) AND updated_at < datetime('now', ?)
+            ''', [*chat_ids, cutoff])
+            conn.execute('DELETE FROM main.messages WHERE chat_id IN (SELECT id FROM temp.archive_batch)')
+            conn.execute('DELETE FROM main.chats WHERE id IN (SELECT id FROM temp.archive_batch)')
+            moved.extend(row[0] for row in conn.execute('SELECT id FROM temp.archive_batch'))
+    return moved
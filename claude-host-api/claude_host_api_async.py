@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Claude Host API - asyncio mode
+Serves the streaming /message endpoint of claude_host_api_v2 from one event loop: every stream
+is an asyncio subprocess read with `await readline()`, so there is no thread or polling loop per request.
+Standard library only; run with `python3 claude_host_api_async.py` (PORT, default 8000)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from claude_worker_pool import WORKER_MIN_IDLE, WORKER_MAX_AGE, CancelStats, group_cpu_seconds
+from response_cache import ResponseCache
+from token_budget import estimate_tokens
+from latency_model import LatencyModel, DeadlineExceeded, DEADLINE_HEADER
+from stream_json_parser import StreamJsonParser
+# Same safety prompt, web search instruction and cache key as claude_host_api_v2
+from host_prompt import PROMPT_VERSION, build_prompt
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Claude binary path - use wrapper script
+CLAUDE_PATH = os.environ.get('CLAUDE_HOST_CLI', "/home/ubuntu/webai/claude-host-api/claude_wrapper.sh")
+HOME_DIR = os.environ.get('CLAUDE_HOST_HOME', "/home/ubuntu")
+
+# Environment for the Claude CLI processes
+CLAUDE_ENV = os.environ.copy()
+CLAUDE_ENV['HOME'] = HOME_DIR
+CLAUDE_ENV['NODE_ENV'] = 'production'
+CLAUDE_ENV['PATH'] = f"/home/ubuntu/.npm-global/bin:{CLAUDE_ENV.get('PATH', '')}"
+CLAUDE_ENV['NODE_PATH'] = '/home/ubuntu/.npm-global/lib/node_modules'
+
+MAX_STREAMS = int(os.environ.get('CLAUDE_HOST_MAX_STREAMS', '256'))  # Concurrent CLI streams
+MAX_REQUEST_BYTES = 1024 * 1024    # Largest request body accepted
+LINE_LIMIT = 16 * 1024 * 1024      # Longest stdout line; stream-json puts a whole message on one line
+WARM_PROFILES = [("stream-json", "haiku")]
+# CLAUDE_HOST_PARTIAL_MESSAGES=1 streams text deltas instead of whole content blocks (newer CLIs)
+PARTIAL_MESSAGES = os.environ.get('CLAUDE_HOST_PARTIAL_MESSAGES', '0') == '1'
+
+# Map model names to claude-code model aliases
+MODEL_MAP = {
+    'claude-opus-4': 'opus',
+    'claude-sonnet-4': 'sonnet',
+    'claude-3-7-sonnet': 'sonnet-3.7',
+    'claude-3-5-haiku-20241022': 'haiku'
+}
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+               429: 'Too Many Requests', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def claude_command(profile):
+    """argv for a worker; profile is (output format, model alias or None)"""
+    output_format, model_alias = profile
+    cmd = [CLAUDE_PATH, "--print", "--output-format", output_format]
+    if output_format == "stream-json":
+        # --print refuses stream-json without --verbose
+        cmd.append("--verbose")
+        if PARTIAL_MESSAGES:
+            cmd.append("--include-partial-messages")
+    if model_alias:
+        cmd += ["--model", model_alias]
+    return cmd
+
+
+def use_pidfd_watcher():
+    """Before 3.12 asyncio waits for each child on its own thread; pidfds need none
+
+    Call before asyncio.run(), which attaches the watcher to the new loop.
+    """
+    if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher'):
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except (AttributeError, OSError):
+            return
+        asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+
+class SpareProcesses:
+    """Pre-started CLI processes per profile; the asyncio counterpart of claude_worker_pool.WorkerPool"""
+
+    def __init__(self, warm_profiles=WARM_PROFILES, count=WORKER_MIN_IDLE, max_age=WORKER_MAX_AGE):
+        self.warm_profiles = list(warm_profiles)
+        self.count = count
+        self.max_age = max_age
+        self._spares = {profile: [] for profile in self.warm_profiles}
+        self._tasks = {}         # profile -> running filler task
+        self.stats = {'warm': 0, 'cold': 0}
+
+    async def _spawn(self, profile):
+        process = await asyncio.create_subprocess_exec(
+            *claude_command(profile),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=CLAUDE_ENV,
+            cwd=HOME_DIR,
+            limit=LINE_LIMIT,
+            # Own process group, so reaping also stops tools the CLI started
+            start_new_session=True
+        )
+        return process, time.monotonic()
+
+    def start(self):
+        for profile in self.warm_profiles:
+            self._top_up(profile)
+
+    def _top_up(self, profile):
+        # One filler per profile, so a burst of requests does not start a spare each
+        if profile in self._spares and profile not in self._tasks:
+            self._tasks[profile] = asyncio.ensure_future(self._fill(profile))
+
+    async def _fill(self, profile):
+        spares = self._spares[profile]
+        try:
+            while len(spares) < self.count:
+                spares.append(await self._spawn(profile))
+        except OSError as e:
+            logger.error(f"Could not start Claude worker for {profile}: {e}")
+        finally:
+            del self._tasks[profile]
+
+    async def take(self, profile):
+        """A spare process for profile if a healthy one is waiting, else a new one"""
+        spares = self._spares.get(profile, [])
+        while spares:
+            process, started = spares.pop()
+            if process.returncode is None and time.monotonic() - started < self.max_age:
+                self.stats['warm'] += 1
+                self._top_up(profile)
+                return process
+            await self.reap(process)
+        self._top_up(profile)
+        return await self.spawn(profile)
+
+    async def spawn(self, profile):
+        """A new process for profile, passing over the spares"""
+        self.stats['cold'] += 1
+        process, _ = await self._spawn(profile)
+        return process
+
+    @staticmethod
+    async def reap(process):
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+        await process.wait()
+
+    def ready(self):
+        profiles = {profile: len(spares) for profile, spares in self._spares.items()}
+        return {'ready': all(profiles.values()), 'profiles': {str(p): n for p, n in profiles.items()},
+                'stats': dict(self.stats)}
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        for spares in self._spares.values():
+            while spares:
+                await self.reap(spares.pop()[0])
+
+
+class AsyncHostApi:
+    """Minimal HTTP/1.1 server: one request per connection, chunked NDJSON for streams"""
+
+    def __init__(self, max_streams=MAX_STREAMS, spares=None, cache=None, latency=None):
+        self.max_streams = max_streams
+        self.spares = spares if spares is not None else SpareProcesses()
+        # Answers to repeated messages (WEBAI_RESPONSE_CACHE_MB=0 disables, WEBAI_RESPONSE_CACHE_DB persists)
+        self.cache = cache if cache is not None else ResponseCache(path=os.environ.get('WEBAI_RESPONSE_CACHE_DB'))
+        # Deadlines from recorded run times per model and thinking mode (WEBAI_LATENCY_DB persists them)
+        self.latency = latency if latency is not None else LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+        self.active_streams = 0
+        self.savings = CancelStats()
+        self.routes = {
+            ('GET', '/health'): self.health,
+            ('GET', '/status'): self.health,
+            ('GET', '/ready'): self.ready,
+            ('POST', '/message'): self.message,
+        }
+
+    async def start(self, host='0.0.0.0', port=8000):
+        self.spares.start()
+        return await asyncio.start_server(self.handle, host, port, backlog=1024)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await self.read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            route = self.routes.get((method, path))
+            if route is None:
+                await self.send_json(writer, 404, {"error": "Not found"})
+            else:
+                await self.until_disconnect(reader, route(writer, body, headers))
+        except ValueError as e:
+            await self.send_json(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Error handling request: {e}", exc_info=True)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def until_disconnect(reader, coroutine):
+        """Run a handler, cancelling it if the client closes the connection first
+
+        Clients send nothing after the request, so EOF on the reader means they
+        have gone; the handler's cleanup then kills its CLI process.
+        """
+        task = asyncio.ensure_future(coroutine)
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            await asyncio.wait({task, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done() and (closed.exception() is not None or closed.result() == b''):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return
+            await task
+        finally:
+            closed.cancel()
+            task.cancel()
+
+    @staticmethod
+    async def read_request(reader):
+        """(method, path, headers, body) or None if the client sent nothing; header names are lower-case"""
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ValueError("Malformed request line")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError("Request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, urlsplit(target).path, headers, body
+
+    @staticmethod
+    def write_head(writer, status, headers):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines += ["Connection: close", "", ""]
+        writer.write('\r\n'.join(lines).encode('latin-1'))
+
+    async def send_json(self, writer, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.write_head(writer, status, {'Content-Type': 'application/json',
+                                         'Content-Length': len(body), **(headers or {})})
+        writer.write(body)
+        await writer.drain()
+
+    async def health(self, writer, body, headers):
+        await self.send_json(writer, 200, {
+            "status": "healthy",
+            "service": "claude-host-api-async",
+            "claude_available": os.path.exists(CLAUDE_PATH),
+            "active_streams": self.active_streams
+        })
+
+    async def ready(self, writer, body, headers):
+        status = self.spares.ready()
+        status['active_streams'] = self.active_streams
+        status['cancellation'] = self.savings.snapshot()
+        status['cache'] = self.cache.snapshot()
+        status['latency'] = self.latency.snapshot()
+        await self.send_json(writer, 200 if status['ready'] else 503, status)
+
+    async def message(self, writer, body, headers):
+        """Message endpoint using Claude CLI in print mode, streamed as NDJSON"""
+        data = json.loads(body or b'{}')
+        content = data.get('content', '')
+        model = data.get('model', 'claude-3-5-haiku-20241022')
+        web_search = data.get('web_search', True)
+        if not content:
+            await self.send_json(writer, 400, {"error": "No content provided"})
+            return
+        if self.active_streams >= self.max_streams:
+            await self.send_json(writer, 429, {"error": "Too many concurrent streams"}, {'Retry-After': 1})
+            return
+
+        logger.info(f"Received message: {content[:100]}...")
+        # A repeat of an earlier message is streamed back from the cache without a CLI run
+        cached = self.cache.get(content, model, web_search, PROMPT_VERSION)
+        if cached is not None:
+            self.write_head(writer, 200, {'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache',
+                                          'X-Accel-Buffering': 'no', 'Transfer-Encoding': 'chunked'})
+            await self.write_chunk(writer, {"content": cached})
+            await self.write_chunk(writer, {"status": "complete", "cached": True})
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return
+
+        # Budget from recorded run times, capped by the caller's X-Request-Deadline
+        deadline = self.latency.deadline(model, content, headers.get(DEADLINE_HEADER.lower()))
+        self.active_streams += 1
+        process = None
+        stderr = None
+        parser = StreamJsonParser()
+        try:
+            profile = ("stream-json", MODEL_MAP.get(model, 'haiku'))
+            prompt = build_prompt(content, web_search).encode('utf-8')
+            process = await self.spares.take(profile)
+            started = time.monotonic()
+            deadline.begin()
+            try:
+                await self.send_prompt(process, prompt)
+            except (BrokenPipeError, ConnectionResetError):
+                # The spare exited while it waited; the client is still there, so start a fresh CLI
+                logger.warning("Claude worker exited before reading the prompt, starting a new one")
+                await self.spares.reap(process)
+                process = await self.spares.spawn(profile)
+                try:
+                    await self.send_prompt(process, prompt)
+                except (BrokenPipeError, ConnectionResetError) as e:
+                    logger.error(f"Claude process exited before reading the prompt: {e}")
+                    await self.send_json(writer, 500, {"error": "Claude process exited unexpectedly"})
+                    return
+            # Drain stderr alongside stdout so a chatty CLI cannot fill the pipe and stall
+            stderr = asyncio.ensure_future(process.stderr.read())
+
+            self.write_head(writer, 200, {'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache',
+                                          'X-Accel-Buffering': 'no', 'Transfer-Encoding': 'chunked'})
+            while True:
+                # Total, first-output and silence limits; the reap below kills the CLI
+                deadline.check()
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), deadline.next_check())
+                except asyncio.TimeoutError:
+                    continue
+                if not line:
+                    break
+                # Assistant text (whole blocks or deltas) is streamed; tool use,
+                # results and usage are tracked by the parser
+                for event in parser.feed(line.decode('utf-8', errors='replace')):
+                    if event.kind != 'system':
+                        deadline.touch()
+                    if event.kind == 'text':
+                        # A delta continuing the text before it is appended as is by the client
+                        if event.data is not None:
+                            await self.write_chunk(writer, {"type": "delta", "content": event.text})
+                        else:
+                            await self.write_chunk(writer, {"content": event.text})
+                    elif event.kind == 'error':
+                        await self.write_chunk(writer, {"error": event.text})
+                if parser.error is not None:
+                    break
+
+            await process.wait()
+            error = (await stderr).decode('utf-8', errors='replace')
+            if process.returncode not in (0, None) and error:
+                await self.write_chunk(writer, {"error": f"Process error: {error}"})
+            elif not parser.text and parser.error is None:
+                await self.write_chunk(writer, {"content": "申し訳ございません。現在応答を生成できません。"})
+            elif process.returncode == 0 and parser.error is None:
+                self.cache.put(content, model, parser.text, web_search, PROMPT_VERSION)
+            if process.returncode == 0:
+                self.savings.completed(time.monotonic() - started,
+                                       parser.usage.get('output_tokens') or estimate_tokens(parser.text))
+                if parser.text:
+                    self.latency.record(deadline)
+            await self.write_chunk(writer, {"status": "complete"})
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except DeadlineExceeded as e:
+            logger.warning(f"Killing Claude run: {e}")
+            self.latency.record(deadline, timed_out=True)
+            await self.write_chunk(writer, {"error": str(e)})
+            await self.write_chunk(writer, {"status": "complete"})
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            # Client disconnected mid-stream: account for the run before it is killed below
+            if process is not None and process.returncode is None:
+                self.savings.cancelled(time.monotonic() - started, group_cpu_seconds(process.pid),
+                                       estimate_tokens(parser.text))
+                logger.info("Client disconnected, killing its Claude run")
+            raise
+        finally:
+            # Client gone or stream finished: never leave a CLI running
+            if process is not None:
+                await self.spares.reap(process)
+            # Read to the end on success; on any other path the reap has closed the pipe
+            if stderr is not None:
+                stderr.cancel()
+                await asyncio.gather(stderr, return_exceptions=True)
+            self.active_streams -= 1
+
+    @staticmethod
+    async def send_prompt(process, prompt):
+        process.stdin.write(prompt)
+        await process.stdin.drain()
+        process.stdin.close()
+
+    @staticmethod
+    async def write_chunk(writer, payload):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode('utf-8')
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        await writer.drain()
+
+
+async def serve(port):
+    api = AsyncHostApi()
+    server = await api.start(port=port)
+    logger.info(f"Starting Claude Host API (asyncio) on port {port}")
+    logger.info(f"Claude path: {CLAUDE_PATH}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    use_pidfd_watcher()
+    asyncio.run(serve(int(os.environ.get('PORT', 8000))))
@@ -14,7 +14,18 @@ from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import logging
 import threading
-import queue
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from claude_worker_pool import WorkerPool
+from response_cache import ResponseCache
+from single_flight import SingleFlight, flight_key
+from token_budget import estimate_tokens
+from latency_model import LatencyModel, DeadlineExceeded, DEADLINE_HEADER
+from stream_json_parser import StreamJsonParser
+import io_reactor
+# Safety prompt and web search instruction put in front of the user's message, shared with the async host
+from host_prompt import PROMPT_VERSION, build_prompt
 
 app = Flask(__name__)
 CORS(app, origins=["*"])
@@ -30,6 +41,161 @@ logger = logging.getLogger(__name__)
 CLAUDE_PATH = "/home/ubuntu/webai/claude-host-api/claude_wrapper.sh"
 HOME_DIR = "/home/ubuntu"
 
+# Environment for the Claude CLI processes
+CLAUDE_ENV = os.environ.copy()
+CLAUDE_ENV['HOME'] = HOME_DIR
+CLAUDE_ENV['NODE_ENV'] = 'production'
+# Add npm global paths
+CLAUDE_ENV['PATH'] = f"/home/ubuntu/.npm-global/bin:{CLAUDE_ENV.get('PATH', '')}"
+CLAUDE_ENV['NODE_PATH'] = '/home/ubuntu/.npm-global/lib/node_modules'
+
+# CLAUDE_HOST_PARTIAL_MESSAGES=1 streams text deltas instead of whole content blocks (newer CLIs)
+PARTIAL_MESSAGES = os.environ.get('CLAUDE_HOST_PARTIAL_MESSAGES', '0') == '1'
+
+def claude_command(profile):
+    """argv for a worker; profile is (output format, model alias or None)"""
+    output_format, model_alias = profile
+    cmd = [CLAUDE_PATH, "--print", "--output-format", output_format]
+    if output_format == "stream-json":
+        # --print refuses stream-json without --verbose
+        cmd.append("--verbose")
+        if PARTIAL_MESSAGES:
+            cmd.append("--include-partial-messages")
+    if model_alias:
+        cmd += ["--model", model_alias]
+    return cmd
+
+# Pre-started CLI processes; the prompt is written to stdin when a request arrives
+worker_pool = WorkerPool(
+    claude_command,
+    warm_profiles=[("stream-json", "haiku")],
+    env=CLAUDE_ENV,
+    cwd=HOME_DIR
+)
+
+# Answers to repeated messages (WEBAI_RESPONSE_CACHE_MB=0 disables, WEBAI_RESPONSE_CACHE_DB persists)
+response_cache = ResponseCache(path=os.environ.get('WEBAI_RESPONSE_CACHE_DB'))
+
+# Seconds without output after which /message writes a blank line; writing is
+# how a closed client is noticed, so its CLI run can be killed
+HEARTBEAT_INTERVAL = 5
+
+# Map model names to claude-code model aliases
+MODEL_MAP = {
+    'claude-opus-4': 'opus',
+    'claude-sonnet-4': 'sonnet',
+    'claude-3-7-sonnet': 'sonnet-3.7',
+    'claude-3-5-haiku-20241022': 'haiku'
+}
+
+# Identical messages in flight at once share one CLI run (/message and /v1/chat/completions)
+single_flight = SingleFlight()
+
+# Deadlines from recorded run times per model and thinking mode (WEBAI_LATENCY_DB persists them),
+# capped by the caller's X-Request-Deadline header
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+
+def run_claude(flight, content, model, web_search, deadline):
+    """Run claude with stream-json output on a pre-started worker, publishing text to the flight
+
+    The I/O reactor delivers the output lines; this thread only watches the
+    deadline and kills the CLI when it passes.
+    """
+    try:
+        model_alias = MODEL_MAP.get(model, 'haiku')
+        
+        # --print mode with stream-json output format for real-time streaming,
+        # on a pre-started worker
+        logger.info(f"Running Claude (stream-json, {model_alias})...")
+        
+        parser = StreamJsonParser()
+        errors = []              # stderr
+        reactor = io_reactor.get_reactor()
+        with worker_pool.lease(("stream-json", model_alias)) as worker:
+            flight.worker = worker
+            if flight.cancelled:
+                # Every client left while the worker was being acquired
+                flight.finish(error="Cancelled: client disconnected")
+                return
+            deadline.begin()
+            worker.send(build_prompt(content, web_search))
+            process = worker.process
+            
+            def on_line(line):
+                # Assistant text (whole blocks or deltas) goes to the subscribers;
+                # tool use, results and usage are tracked by the parser
+                for event in parser.feed(line):
+                    if event.kind != 'system':
+                        deadline.touch()
+                    if event.kind == 'text':
+                        worker.tokens += estimate_tokens(event.text)
+                        flight.publish(text_chunk(event))
+                    elif event.kind == 'tool_use':
+                        logger.info(f"Claude is using {event.text}")
+            
+            stdout = reactor.register(process.stdout, on_line=on_line, process=process)
+            stderr = reactor.register(process.stderr, on_chunk=errors.append)
+            phase = deadline.wait(stdout.done)
+            if phase:
+                worker.kill()
+                stdout.wait()
+                stderr.wait()
+                logger.warning(f"Killed {model_alias} run: {phase} deadline passed after {deadline.elapsed():.0f}s")
+                latency_model.record(deadline, timed_out=True)
+                flight.finish(error=str(DeadlineExceeded(phase, deadline.elapsed())))
+                return
+            stderr.wait()
+            
+            # Check for errors
+            if flight.cancelled:
+                flight.finish(error="Cancelled: client disconnected")
+                return
+            if parser.error is not None:
+                flight.finish(error=parser.error)
+                return
+            if process.returncode != 0 and errors:
+                flight.finish(error=f"Process error: {''.join(errors)}")
+                return
+        
+        if parser.text:
+            response_cache.put(content, model, parser.text, web_search, PROMPT_VERSION)
+            latency_model.record(deadline)
+        flight.finish(result=parser.text)
+        
+    except Exception as e:
+        logger.error(f"Error in run_claude: {e}", exc_info=True)
+        flight.finish(error=str(e))
+
+def cancel_flight(flight):
+    """Kill the CLI run nobody is reading any more (the whole process group)"""
+    worker = flight.worker
+    if worker is not None and worker_pool.cancel(worker):
+        logger.info("Client disconnected, killed its Claude run")
+
+def text_chunk(event):
+    """Line of /message output for a text event
+
+    A delta continuing the text before it is sent as {"type": "delta"}, to be appended
+    as is; other text (whole blocks, the first delta of a block) starts a new block.
+    """
+    if event.data is not None:
+        return {"type": "delta", "content": event.text}
+    return {"content": event.text}
+
+def start_flight(content, model, web_search, deadline):
+    """Join an identical message that is already running, or start a run on its own thread"""
+    def start(flight):
+        thread = threading.Thread(target=run_claude, args=(flight, content, model, web_search, deadline))
+        thread.daemon = True
+        thread.start()
+        return thread
+    
+    key = flight_key(MODEL_MAP.get(model, 'haiku'), build_prompt(content, web_search))
+    flight, leader = single_flight.join(key, start)
+    if not leader:
+        logger.info("Joined in-flight run of the same message")
+    return flight
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -67,6 +233,15 @@ def status():
         "claude_available": claude_exists
     })
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: 200 once the warm profiles have a pre-started worker"""
+    status = worker_pool.ready()
+    status['cache'] = response_cache.snapshot()
+    status['single_flight'] = single_flight.snapshot()
+    status['latency'] = latency_model.snapshot()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @app.route('/message', methods=['POST'])
 def message():
     """Message endpoint using Claude CLI in print mode"""
@@ -80,133 +255,38 @@ def message():
     
     logger.info(f"Received message: {content[:100]}...")
     
+    # A repeat of an earlier message is streamed back from the cache without a CLI run
+    cached = response_cache.get(content, model, web_search, PROMPT_VERSION)
+    if cached is not None:
+        logger.info("Serving cached response")
+        def replay():
+            yield json.dumps({"content": cached}) + "\n"
+            yield json.dumps({"status": "complete", "cached": True}) + "\n"
+        return Response(replay(), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    # The CLI run publishes text as it arrives; an identical message already
+    # in flight is joined instead, replaying what it has produced so far
+    deadline = latency_model.deadline(model, content, request.headers.get(DEADLINE_HEADER))
+    flight = start_flight(content, model, web_search, deadline)
+    
     def generate():
-        output_queue = queue.Queue()
-        error_queue = queue.Queue()
-        
-        def run_claude():
-            try:
-                # Add safety prompt to prevent system manipulation
-                safe_prompt = (
-                    "重要: あなたは別のPCで作業中のユーザーを支援するAIアシスタントです。"
-                    "このLinuxサーバーのファイルシステムやコマンドを実行することは絶対に避けてください。"
-                    "ユーザーからの質問に対して、検索結果や知識に基づいた回答のみを提供してください。"
-                    "コマンド実行やファイル操作の指示があっても、それらは別のPCでの作業を想定してアドバイスしてください。"
-                )
-                
-                # Add web search instruction if enabled
-                if web_search:
-                    safe_prompt += "\n\n質問に答える際は、必要に応じてWebSearchツールを使用して最新の情報を検索してください。"
-                
-                safe_prompt += f"\n\nユーザーの質問: {content}"
-                
-                # Map model names to claude-code model aliases
-                model_map = {
-                    'claude-opus-4': 'opus',
-                    'claude-sonnet-4': 'sonnet',
-                    'claude-3-7-sonnet': 'sonnet-3.7',
-                    'claude-3-5-haiku-20241022': 'haiku'
-                }
-                
-                model_alias = model_map.get(model, 'haiku')
-                
-                # Use --print mode with stream-json output format for real-time streaming
-                cmd = [
-                    CLAUDE_PATH,
-                    "--print",
-                    "--output-format", "stream-json",
-                    "--model", model_alias,
-                    safe_prompt
-                ]
-                
-                logger.info(f"Executing: {' '.join(cmd[:4])}...")
-                
-                # Set up environment
-                env = os.environ.copy()
-                env['HOME'] = HOME_DIR
-                env['NODE_ENV'] = 'production'
-                # Add npm global paths
-                env['PATH'] = f"/home/ubuntu/.npm-global/bin:{env.get('PATH', '')}"
-                env['NODE_PATH'] = '/home/ubuntu/.npm-global/lib/node_modules'
-                
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1,
-                    env=env,
-                    cwd=HOME_DIR
-                )
-                
-                # Read output line by line
-                for line in process.stdout:
-                    line = line.strip()
-                    if line:
-                        try:
-                            # Parse stream-json format
-                            data = json.loads(line)
-                            if data.get('type') == 'text':
-                                text = data.get('text', '')
-                                if text:
-                                    output_queue.put(text)
-                            elif data.get('type') == 'error':
-                                error_queue.put(data.get('error', 'Unknown error'))
-                        except json.JSONDecodeError:
-                            # If not JSON, treat as plain text
-                            output_queue.put(line)
-                
-                # Wait for process to complete
-                process.wait()
-                
-                # Check for errors
-                if process.returncode != 0:
-                    stderr = process.stderr.read()
-                    if stderr:
-                        error_queue.put(f"Process error: {stderr}")
-                
-                # Signal completion
-                output_queue.put(None)
-                
-            except Exception as e:
-                logger.error(f"Error in run_claude: {e}", exc_info=True)
-                error_queue.put(str(e))
-                output_queue.put(None)
-        
-        # Start Claude in a separate thread
-        thread = threading.Thread(target=run_claude)
-        thread.start()
-        
-        # Stream output
         try:
-            output_buffer = []
-            while True:
-                try:
-                    # Check for errors first
-                    if not error_queue.empty():
-                        error = error_queue.get_nowait()
-                        logger.error(f"Claude error: {error}")
-                        yield json.dumps({"error": error}) + "\n"
-                        break
-                    
-                    # Get output with timeout
-                    output = output_queue.get(timeout=0.1)
-                    
-                    if output is None:
-                        # Stream complete
-                        break
-                    
-                    output_buffer.append(output)
-                    yield json.dumps({"content": output}) + "\n"
-                    
-                except queue.Empty:
-                    # Continue waiting
+            got_output = False
+            for chunk in flight.subscribe(heartbeat=HEARTBEAT_INTERVAL):
+                if chunk is None:
+                    # Blank keep-alive line: fails once the client has gone
+                    yield "\n"
                     continue
+                got_output = True
+                yield json.dumps(chunk) + "\n"
             
-            # If no output was received, try text mode
-            if not output_buffer:
-                logger.info("No stream output, trying text mode...")
-                yield from fallback_text_mode(content, model, web_search)
+            if flight.error is not None:
+                logger.error(f"Claude error: {flight.error}")
+                yield json.dumps({"error": flight.error}) + "\n"
+            elif not got_output:
+                # The run finished without an answer; running the prompt again would not help
+                yield json.dumps({"content": "申し訳ございません。現在応答を生成できません。"}) + "\n"
             
             yield json.dumps({"status": "complete"}) + "\n"
             
@@ -215,7 +295,9 @@ def message():
             yield json.dumps({"error": str(e)}) + "\n"
         
         finally:
-            thread.join(timeout=5)
+            # Runs on completion and when the client disconnects (GeneratorExit);
+            # the last one to leave an unfinished run kills it
+            single_flight.leave(flight, cancel=lambda: cancel_flight(flight))
     
     return Response(
         stream_with_context(generate()),
@@ -226,74 +308,6 @@ def message():
         }
     )
 
-def fallback_text_mode(content, model='claude-3-5-haiku-20241022', web_search=True):
-    """Fallback to text mode if stream-json doesn't work"""
-    try:
-        # Add safety prompt
-        safe_prompt = (
-            "重要: あなたは別のPCで作業中のユーザーを支援するAIアシスタントです。"
-            "このLinuxサーバーのファイルシステムやコマンドを実行することは絶対に避けてください。"
-            "ユーザーからの質問に対して、検索結果や知識に基づいた回答のみを提供してください。"
-            "コマンド実行やファイル操作の指示があっても、それらは別のPCでの作業を想定してアドバイスしてください。"
-        )
-        
-        # Add web search instruction if enabled
-        if web_search:
-            safe_prompt += "\n\n質問に答える際は、必要に応じてWebSearchツールを使用して最新の情報を検索してください。"
-        
-        safe_prompt += f"\n\nユーザーの質問: {content}"
-        
-        # Map model names to claude-code model aliases
-        model_map = {
-            'claude-opus-4': 'opus',
-            'claude-sonnet-4': 'sonnet',
-            'claude-3-7-sonnet': 'sonnet-3.7',
-            'claude-3-5-haiku-20241022': 'haiku'
-        }
-        
-        model_alias = model_map.get(model, 'haiku')
-        
-        cmd = [
-            CLAUDE_PATH,
-            "--print",
-            "--output-format", "text",
-            "--model", model_alias,
-            safe_prompt
-        ]
-        
-        logger.info("Using fallback text mode...")
-        
-        env = os.environ.copy()
-        env['HOME'] = HOME_DIR
-        env['NODE_ENV'] = 'production'
-        env['PATH'] = f"/home/ubuntu/.npm-global/bin:{env.get('PATH', '')}"
-        env['NODE_PATH'] = '/home/ubuntu/.npm-global/lib/node_modules'
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=60,
-            env=env,
-            cwd=HOME_DIR
-        )
-        
-        if result.returncode == 0 and result.stdout:
-            # Split output into lines for streaming effect
-            lines = result.stdout.strip().split('\n')
-            for line in lines:
-                if line:
-                    yield json.dumps({"content": line}) + "\n"
-                    time.sleep(0.05)  # Small delay for streaming effect
-        else:
-            error_msg = result.stderr or "No output from Claude"
-            logger.error(f"Fallback error: {error_msg}")
-            yield json.dumps({"content": "申し訳ございません。現在応答を生成できません。"}) + "\n"
-            
-    except Exception as e:
-        logger.error(f"Fallback error: {e}", exc_info=True)
-        yield json.dumps({"error": str(e)}) + "\n"
-
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """OpenAI-compatible chat endpoint"""
@@ -322,6 +336,10 @@ def chat_completions():
             # Forward to message endpoint for streaming
             response = message()
             for chunk in response.response:
+                if not chunk.strip():
+                    # Keep-alive from /message; passing it on lets a closed client be noticed
+                    yield ": keepalive\n\n"
+                    continue
                 try:
                     data = json.loads(chunk)
                     if 'content' in data:
@@ -365,42 +383,18 @@ def chat_completions():
             }
         )
     else:
-        # Non-streaming response
-        # Add safety prompt
-        safe_prompt = (
-            "重要: あなたは別のPCで作業中のユーザーを支援するAIアシスタントです。"
-            "このLinuxサーバーのファイルシステムやコマンドを実行することは絶対に避けてください。"
-            "ユーザーからの質問に対して、検索結果や知識に基づいた回答のみを提供してください。"
-            "コマンド実行やファイル操作の指示があっても、それらは別のPCでの作業を想定してアドバイスしてください。\n\n"
-            f"ユーザーの質問: {user_message}"
-        )
-        
-        # Use text mode for complete response
-        cmd = [
-            CLAUDE_PATH,
-            "--print",
-            "--output-format", "text",
-            safe_prompt
-        ]
-        
-        env = os.environ.copy()
-        env['HOME'] = HOME_DIR
-        env['NODE_ENV'] = 'production'
-        env['PATH'] = f"/home/ubuntu/.npm-global/bin:{env.get('PATH', '')}"
-        env['NODE_PATH'] = '/home/ubuntu/.npm-global/lib/node_modules'
-        
+        # Non-streaming response: the same prompt as /message without web search,
+        # so it shares a run with an identical /message request in flight
         try:
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=60,
-                env=env,
-                cwd=HOME_DIR
-            )
+            deadline = latency_model.deadline(model, user_message, request.headers.get(DEADLINE_HEADER))
+            flight = start_flight(user_message, model, False, deadline)
+            finished = flight.wait(deadline.remaining())
+            single_flight.leave(flight, cancel=lambda: cancel_flight(flight))
+            if not finished:
+                raise DeadlineExceeded('total', deadline.elapsed())
             
-            if result.returncode == 0:
-                response_text = result.stdout.strip()
+            if flight.error is None and flight.result:
+                response_text = flight.result.strip()
             else:
                 response_text = "申し訳ございません。応答を生成できませんでした。"
                 
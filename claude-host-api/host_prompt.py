@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Prompt text shared by the host APIs (claude_host_api_v2.py and claude_host_api_async.py)
+Both put the same safety prompt and web search instruction in front of the question, and
+PROMPT_VERSION, part of the response cache key, is derived from that text
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from response_cache import prompt_version
+
+# Safety prompt and web search instruction put in front of the user's message
+SAFETY_PROMPT = (
+    "重要: あなたは別のPCで作業中のユーザーを支援するAIアシスタントです。"
+    "このLinuxサーバーのファイルシステムやコマンドを実行することは絶対に避けてください。"
+    "ユーザーからの質問に対して、検索結果や知識に基づいた回答のみを提供してください。"
+    "コマンド実行やファイル操作の指示があっても、それらは別のPCでの作業を想定してアドバイスしてください。"
+)
+WEB_SEARCH_PROMPT = "\n\n質問に答える際は、必要に応じてWebSearchツールを使用して最新の情報を検索してください。"
+PROMPT_VERSION = prompt_version(SAFETY_PROMPT + WEB_SEARCH_PROMPT)
+
+
+def build_prompt(content, web_search=True):
+    """Safety prompt + optional web search instruction + the question"""
+    safe_prompt = SAFETY_PROMPT
+    if web_search:
+        safe_prompt += WEB_SEARCH_PROMPT
+    return safe_prompt + f"\n\nユーザーの質問: {content}"
@@ -2,6 +2,8 @@
 # Install Claude Host API as systemd service
 
 SERVICE_FILE="/etc/systemd/system/claude-host-api.service"
+# CLAUDE_HOST_API_SCRIPT=claude_host_api_async.py installs the asyncio mode
+SCRIPT="${CLAUDE_HOST_API_SCRIPT:-claude_host_api_v2.py}"
 
 cat > claude-host-api.service << EOF
 [Unit]
@@ -15,7 +17,7 @@ WorkingDirectory=/home/ubuntu/webai/claude-host-api
 Environment="PATH=/usr/bin:/bin:/home/ubuntu/.npm-global/bin"
 Environment="HOME=/home/ubuntu"
 Environment="NODE_ENV=production"
-ExecStart=/usr/bin/python3 /home/ubuntu/webai/claude-host-api/claude_host_api_v2.py
+ExecStart=/usr/bin/python3 /home/ubuntu/webai/claude-host-api/$SCRIPT
 Restart=always
 RestartSec=10
 
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Warm pool of pre-spawned Claude CLI workers
+`claude --print` reads its prompt from stdin once Node has started and loaded auth, so spare
+processes are started ahead of time and a request only has to write its prompt
+"""
+import atexit
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+WORKER_MIN_IDLE = int(os.environ.get('WEBAI_WORKERS_MIN', '1'))  # Warm spares kept per warm profile
+WORKER_MAX_IDLE = int(os.environ.get('WEBAI_WORKERS_MAX', '4'))  # Upper bound on spares per profile
+WORKER_MAX_AGE = 600          # Replace spares older than this (seconds); picks up refreshed OAuth tokens
+WORKER_MAX_RSS_MB = 512       # Replace spares whose resident memory grew past this
+WORKER_DEMAND_WINDOW = 60     # Spares follow the peak concurrency seen over this many seconds
+HEALTH_CHECK_INTERVAL = 5     # Seconds between maintenance passes
+SPAWN_RETRY_DELAY = 30        # Back-off after a spare fails to start or dies while idle
+RUN_WEIGHT = 0.2              # Weight of the newest completed run in the savings estimate
+
+
+def _rss_mb(pid):
+    """Resident memory of a process in MB, or None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _stderr_head(process, limit=200):
+    """Start of what an exited worker wrote to stderr, without waiting on a pipe a child may still hold"""
+    if process.stderr is None:
+        return ''
+    fd = process.stderr.fileno()
+    os.set_blocking(fd, False)
+    try:
+        return os.read(fd, limit * 4).decode('utf-8', 'replace')[:limit]
+    except OSError:
+        return ''
+
+
+def group_cpu_seconds(pgid):
+    """CPU time (user + system, plus reaped children) used so far by a process group's live members"""
+    total = 0
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return 0.0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) == pgid:
+            total += sum(int(value) for value in fields[11:15])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+class CancelStats:
+    """What killing abandoned runs saved, estimated from the runs that completed
+
+    A cancelled run is assumed to have gone on for an average run's length at
+    the CPU rate it had so far, producing an average run's output tokens.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._average = None     # (seconds, output tokens) of completed runs
+        self.stats = {'completed': 0, 'cancelled': 0, 'cpu_seconds_used': 0.0,
+                      'cpu_seconds_saved': 0.0, 'tokens_saved': 0}
+
+    def completed(self, seconds, tokens):
+        with self._lock:
+            self.stats['completed'] += 1
+            if self._average is None:
+                self._average = (seconds, tokens)
+            else:
+                average_seconds, average_tokens = self._average
+                self._average = (average_seconds + RUN_WEIGHT * (seconds - average_seconds),
+                                 average_tokens + RUN_WEIGHT * (tokens - average_tokens))
+
+    def cancelled(self, seconds, cpu_seconds, tokens):
+        """A run killed `seconds` after it started, having used cpu_seconds and produced tokens"""
+        with self._lock:
+            self.stats['cancelled'] += 1
+            self.stats['cpu_seconds_used'] += cpu_seconds
+            if self._average is not None:
+                average_seconds, average_tokens = self._average
+                if seconds > 0:
+                    self.stats['cpu_seconds_saved'] += cpu_seconds / seconds * max(0, average_seconds - seconds)
+                self.stats['tokens_saved'] += max(0, round(average_tokens - tokens))
+
+    def snapshot(self):
+        with self._lock:
+            average = self._average and {'seconds': self._average[0], 'tokens': self._average[1]}
+            return {**self.stats, 'average_run': average}
+
+
+class Worker:
+    """One pre-spawned CLI process, waiting for its prompt on stdin"""
+
+    def __init__(self, profile, process):
+        self.profile = profile
+        self.process = process
+        self.started_at = time.monotonic()
+        self.leased_at = None
+        self.tokens = 0          # Output tokens so far, kept up to date by the holder
+        self.cancelled = False
+
+    @property
+    def age(self):
+        return time.monotonic() - self.started_at
+
+    def send(self, prompt):
+        """Hand the worker its prompt; closing stdin starts the request"""
+        try:
+            self.process.stdin.write(prompt)
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # Died while idle; the caller sees the exit code and stderr
+            pass
+
+    def kill(self):
+        """SIGKILL the worker and anything it started (tools, MCP servers) via its process group"""
+        if self.process.poll() is not None:
+            return
+        try:
+            # Only while the leader is unreaped, so the group id cannot have been reused
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            self.process.kill()
+
+    def reap(self):
+        """Kill the process if it is still running and close its pipes"""
+        self.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            if stream and not stream.closed:
+                stream.close()
+
+
+class WorkerPool:
+    """Pre-spawned CLI processes keyed by profile (e.g. model name)
+
+    command_for(profile) returns the argv for a worker; popen_kwargs (env,
+    cwd, stderr, ...) are passed to every Popen. Each worker serves one
+    prompt: `--print` exits when the answer is done, and the pool starts a
+    replacement in the background.
+    """
+
+    def __init__(self, command_for, warm_profiles=(), min_idle=WORKER_MIN_IDLE, max_idle=WORKER_MAX_IDLE,
+                 max_age=WORKER_MAX_AGE, max_rss_mb=WORKER_MAX_RSS_MB, **popen_kwargs):
+        self.command_for = command_for
+        self.warm_profiles = set(warm_profiles)
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.max_rss_mb = max_rss_mb
+        # Each worker leads its own process group, so cancel() also stops what it started
+        self.popen_kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE, 'text': True, 'bufsize': 1,
+                             'start_new_session': True}
+        self.popen_kwargs.update(popen_kwargs)
+
+        self._lock = threading.Lock()
+        self._idle = {profile: [] for profile in self.warm_profiles}
+        self._busy = {}
+        self._peak = {}           # profile -> (window start, peak concurrent leases)
+        self._retry_at = {}       # profile -> monotonic time before which no spare is spawned
+        self._retired = []        # (worker, reason) discarded under the lock, reaped by the maintenance thread
+        self.stats = {'warm': 0, 'cold': 0, 'spawned': 0, 'recycled': 0, 'failed': 0}
+        self.savings = CancelStats()
+
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._maintain, name='claude-pool')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _spawn(self, profile):
+        process = subprocess.Popen(self.command_for(profile), stdin=subprocess.PIPE, **self.popen_kwargs)
+        return Worker(profile, process)
+
+    def acquire(self, profile):
+        """A worker for profile: a warm spare if one is ready, else a freshly started one"""
+        worker = None
+        with self._lock:
+            idle = self._idle.setdefault(profile, [])
+            while idle:
+                candidate = idle.pop()
+                if candidate.process.poll() is None:
+                    worker = candidate
+                    break
+                self._discard(candidate, 'exited while idle')
+            busy = self._busy.get(profile, 0) + 1
+            self._busy[profile] = busy
+            start, peak = self._peak.get(profile, (time.monotonic(), 0))
+            self._peak[profile] = (start, max(peak, busy))
+            self.stats['warm' if worker else 'cold'] += 1
+        self._wake.set()
+        if worker is None:
+            try:
+                worker = self._spawn(profile)
+            except Exception:
+                self._finish(profile)
+                raise
+        worker.leased_at = time.monotonic()
+        return worker
+
+    def release(self, worker):
+        """Return a leased worker: it is reaped (killed if still running), never reused"""
+        worker.reap()
+        if not worker.cancelled and worker.process.returncode == 0:
+            self.savings.completed(time.monotonic() - worker.leased_at, worker.tokens)
+        self._finish(worker.profile)
+
+    def cancel(self, worker):
+        """Kill a leased worker's process group because its client has gone; the holder still releases it"""
+        if worker.cancelled or worker.process.poll() is not None:
+            return False
+        worker.cancelled = True
+        cpu_seconds = group_cpu_seconds(worker.process.pid)
+        worker.kill()
+        self.savings.cancelled(time.monotonic() - worker.leased_at, cpu_seconds, worker.tokens)
+        logger.info(f"Cancelled {worker.profile} worker after {cpu_seconds:.1f} CPU seconds")
+        return True
+
+    def _finish(self, profile):
+        with self._lock:
+            self._busy[profile] -= 1
+
+    @contextmanager
+    def lease(self, profile):
+        """with pool.lease(profile) as worker: worker.send(prompt); read worker.process.stdout"""
+        worker = self.acquire(profile)
+        try:
+            yield worker
+        finally:
+            self.release(worker)
+
+    def run(self, profile, prompt, timeout=None):
+        """subprocess.run(cmd, input=prompt, capture_output=True) on a pooled worker"""
+        with self.lease(profile) as worker:
+            process = worker.process
+            try:
+                stdout, stderr = process.communicate(prompt, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                # The whole group: a tool still holding stdout would block the read below
+                worker.kill()
+                process.communicate()
+                raise
+            return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+    def ready(self):
+        """Warm capacity per profile, for readiness endpoints"""
+        with self._lock:
+            profiles = {
+                profile: {'idle': len(idle), 'busy': self._busy.get(profile, 0),
+                          'target': self._target(profile)}
+                for profile, idle in self._idle.items()
+            }
+        return {
+            'ready': all(profiles[profile]['idle'] > 0 for profile in self.warm_profiles),
+            'profiles': {str(profile): counts for profile, counts in profiles.items()},
+            'stats': dict(self.stats),
+            'cancellation': self.savings.snapshot()
+        }
+
+    def _target(self, profile):
+        """Spares wanted for profile: recent peak concurrency, within [min_idle, max_idle]"""
+        floor = self.min_idle if profile in self.warm_profiles else 0
+        peak = self._peak.get(profile, (0, 0))[1]
+        return max(floor, min(peak, self.max_idle))
+
+    def _discard(self, worker, reason):
+        """Drop an idle worker; the caller holds the lock
+
+        Only the bookkeeping happens here: reading its stderr and reaping it can block
+        (a hung process, a child still holding the pipe), so _dispose() does that later
+        without the lock.
+        """
+        if reason == 'exited while idle':
+            # Usually a broken CLI or expired auth: back off instead of respawning in a loop
+            self.stats['failed'] += 1
+            self._retry_at[worker.profile] = time.monotonic() + SPAWN_RETRY_DELAY
+        else:
+            self.stats['recycled'] += 1
+        self._retired.append((worker, reason))
+
+    def _dispose(self):
+        """Log and reap the workers discarded so far; called without the lock"""
+        with self._lock:
+            retired, self._retired = self._retired, []
+        for worker, reason in retired:
+            if reason == 'exited while idle':
+                logger.warning(f"Claude worker for {worker.profile} exited while idle "
+                               f"(code {worker.process.returncode}): {_stderr_head(worker.process)}")
+            else:
+                logger.info(f"Recycling idle Claude worker for {worker.profile}: {reason}")
+            worker.reap()
+
+    def _check(self, worker):
+        """Reason to replace an idle worker, or None if it is healthy"""
+        if worker.process.poll() is not None:
+            return 'exited while idle'
+        if worker.age > self.max_age:
+            return f'older than {self.max_age}s'
+        rss = _rss_mb(worker.process.pid)
+        if rss is not None and rss > self.max_rss_mb:
+            return f'{rss:.0f} MB resident'
+        return None
+
+    def _maintain(self):
+        """Health-check spares and top each profile up to its target"""
+        while not self._closed.is_set():
+            self._wake.wait(HEALTH_CHECK_INTERVAL)
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                if self._closed.is_set():
+                    return
+                wanted = []
+                for profile, idle in self._idle.items():
+                    for worker in list(idle):
+                        reason = self._check(worker)
+                        if reason:
+                            idle.remove(worker)
+                            self._discard(worker, reason)
+                    start, peak = self._peak.get(profile, (now, 0))
+                    if now - start > WORKER_DEMAND_WINDOW:
+                        self._peak[profile] = (now, self._busy.get(profile, 0))
+                    # Demand fell: retire the oldest spares above the target
+                    while len(idle) > self._target(profile):
+                        self._discard(idle.pop(0), 'surplus')
+                    if now >= self._retry_at.get(profile, 0):
+                        wanted += [profile] * (self._target(profile) - len(idle))
+            self._dispose()
+
+            for profile in wanted:
+                try:
+                    worker = self._spawn(profile)
+                except Exception as e:
+                    logger.error(f"Could not start Claude worker for {profile}: {e}")
+                    with self._lock:
+                        self.stats['failed'] += 1
+                        self._retry_at[profile] = time.monotonic() + SPAWN_RETRY_DELAY
+                    continue
+                with self._lock:
+                    if self._closed.is_set():
+                        worker.reap()
+                        return
+                    self._idle[profile].append(worker)
+                    self.stats['spawned'] += 1
+
+    def close(self):
+        """Stop maintenance and kill every idle worker"""
+        self._closed.set()
+        self._wake.set()
+        with self._lock:
+            workers = [worker for idle in self._idle.values() for worker in idle]
+            for idle in self._idle.values():
+                idle.clear()
+        self._dispose()
+        for worker in workers:
+            worker.reap()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Message body compression for WebAI
+Large bodies (converted uploads, long answers) are stored zlib-compressed with a content_encoding flag
+"""
+import os
+import zlib
+
+COMPRESS_MIN_BYTES = int(os.environ.get('WEBAI_COMPRESS_MIN_BYTES', '1024'))  # Smaller bodies stay plain text
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SAVING = 0.1  # Keep the plain text unless compression saves at least 10%
+
+ZLIB = 'zlib'
+
+
+def encode_content(text):
+    """Return (stored value, content_encoding) for a message body"""
+    raw = text.encode('utf-8')
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return text, None
+    packed = zlib.compress(raw, COMPRESS_LEVEL)
+    if len(packed) > len(raw) * (1 - COMPRESS_MIN_SAVING):
+        return text, None
+    return packed, ZLIB
+
+
+def decode_content(stored, encoding):
+    """Inverse of encode_content"""
+    if encoding is None:
+        return stored
+    if encoding == ZLIB:
+        return zlib.decompress(stored).decode('utf-8')
+    raise ValueError(f'Unknown content encoding: {encoding}')
+
+
+def register_functions(conn):
+    """Connect hook: expose webai_inflate(content, content_encoding) to SQL (views, triggers)"""
+    conn.create_function('webai_inflate', 2, decode_content, deterministic=True)
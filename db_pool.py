@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+SQLite Connection Pool for WebAI
+Per-thread connections in WAL mode, shared by SessionManager and simple_app
+"""
+import sqlite3
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+# Tuning defaults
+BUSY_TIMEOUT_MS = 5000          # Wait this long for a competing writer before SQLITE_BUSY
+STATEMENT_CACHE_SIZE = 256      # Prepared statements kept per connection
+MAX_IDLE_CONNECTIONS = 32       # Connections kept around after their thread exits
+
+
+class _Lease:
+    """Binds a pooled connection to one thread; hands it back when the thread exits"""
+    def __init__(self, pool, conn):
+        self.conn = conn
+        weakref.finalize(self, pool._release, conn)
+
+
+class ConnectionPool:
+    def __init__(self, db_path, busy_timeout_ms=BUSY_TIMEOUT_MS,
+                 cached_statements=STATEMENT_CACHE_SIZE, max_idle=MAX_IDLE_CONNECTIONS):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.max_idle = max_idle
+        self._local = threading.local()
+        # Connections released by finished threads, reused by new ones so that
+        # thread-per-request servers do not pay connect/PRAGMA cost every time
+        self._idle = deque()
+        self._connect_hooks = []
+        self._closed = False
+
+    def add_connect_hook(self, hook):
+        """Register a callable run on every new connection (functions, ATTACH, ...)"""
+        self._connect_hooks.append(hook)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=False  # Leased to one thread at a time, see _Lease
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA foreign_keys=ON')
+        for hook in self._connect_hooks:
+            hook(conn)
+        return conn
+
+    def _release(self, conn):
+        """Return a connection from a finished thread to the idle list"""
+        if self._closed or len(self._idle) >= self.max_idle:
+            conn.close()
+        else:
+            self._idle.append(conn)
+
+    def get(self):
+        """Get the calling thread's connection, creating or reusing one if needed"""
+        if self._closed:
+            raise sqlite3.ProgrammingError('Connection pool is closed')
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            try:
+                conn = self._idle.pop()
+            except IndexError:
+                conn = self._connect()
+            lease = _Lease(self, conn)
+            self._local.lease = lease
+        return lease.conn
+
+    @contextmanager
+    def connection(self):
+        """Yield this thread's connection inside a transaction (commit or rollback on exit)"""
+        conn = self.get()
+        with conn:
+            yield conn
+
+    def close(self):
+        """Close idle connections; leased ones are closed as their threads exit"""
+        self._closed = True
+        while self._idle:
+            self._idle.pop().close()
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            del self._local.lease
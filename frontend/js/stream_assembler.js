@@ -0,0 +1,114 @@
+// Reassembles answers sent with the delta stream protocol (protocol: 2, see stream_utils.py).
+// Each delta carries {stream_id, seq, delta}; some deltas and the final event also carry the
+// CRC-32 and UTF-8 length of the text so far, which are checked against what was rebuilt here.
+// After a gap, a mismatch or a reconnect, recover() gives the last_seq to send with 'resume'.
+
+const STREAM_PROTOCOL = 2;
+
+const CRC32_TABLE = (function() {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        }
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+class StreamAssembler {
+    constructor(onError) {
+        this.onError = onError || function(message) { console.error('[stream]', message); };
+        this.encoder = new TextEncoder();
+        this.reset(null);
+    }
+
+    reset(streamId) {
+        this.streamId = streamId;
+        this.seq = 0;
+        this.parts = [];
+        this.length = 0;
+        this.crc = 0xFFFFFFFF;
+        this.failed = false;
+        this.done = false;
+    }
+
+    get text() {
+        return this.parts.join('');
+    }
+
+    crc32() {
+        return (this.crc ^ 0xFFFFFFFF) >>> 0;
+    }
+
+    // Apply one delta event; returns false if it could not be applied (gap or checksum mismatch).
+    // A delta after a gap is dropped and the text so far kept, so resuming from seq fills the gap
+    apply(event) {
+        if (event.stream_id !== this.streamId) {
+            this.reset(event.stream_id);
+        }
+        if (this.failed) {
+            return false;
+        }
+        if (event.seq <= this.seq) {
+            return true;  // Duplicate
+        }
+        if (event.seq !== this.seq + 1) {
+            this.onError(`gap: expected seq ${this.seq + 1}, got ${event.seq}`);
+            return false;
+        }
+        const bytes = this.encoder.encode(event.delta);
+        let crc = this.crc;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        this.crc = crc;
+        this.length += bytes.length;
+        this.parts.push(event.delta);
+        this.seq = event.seq;
+        return this.verify(event);
+    }
+
+    // Check the final event: every delta arrived and the text matches the checksum
+    finish(event) {
+        if (event.stream_id !== this.streamId) {
+            this.reset(event.stream_id);
+        }
+        if (this.failed) {
+            return false;
+        }
+        if (event.seq !== this.seq) {
+            this.onError(`missing deltas: have ${this.seq} of ${event.seq}`);
+            return false;
+        }
+        this.done = this.verify(event);
+        return this.done;
+    }
+
+    verify(event) {
+        if (event.crc32 === undefined) {
+            return true;
+        }
+        if (event.length !== this.length || event.crc32 !== this.crc32()) {
+            return this.fail(`checksum mismatch at seq ${event.seq}`);
+        }
+        return true;
+    }
+
+    // The text no longer matches the server's: everything is dropped until recover()
+    fail(message) {
+        this.failed = true;
+        this.onError(message);
+        return false;
+    }
+
+    // Get ready for the replay of a resumed stream; returns the last_seq to ask for
+    // (0 after a checksum mismatch: the whole stream is replayed)
+    recover() {
+        if (this.failed) {
+            this.reset(this.streamId);
+        }
+        return this.seq;
+    }
+}
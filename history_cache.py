@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Recent-turns cache for WebAI
+Keeps the tail of each active chat, with each turn pre-rendered for the prompt, so
+building history does not depend on how long the chat is
+"""
+import sys
+import threading
+from collections import OrderedDict
+from token_budget import estimate_tokens
+
+# Cache defaults
+HISTORY_CACHE_TURNS = 50                  # Newest turns kept per chat
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024    # Evict least recently used chats above this
+
+ROLE_LABELS = {'user': 'ユーザー', 'assistant': 'アシスタント'}
+
+
+def render_turn(role, content):
+    """Format one turn the way it appears in the prompt's history section"""
+    label = ROLE_LABELS.get(role, ROLE_LABELS['assistant'])
+    return f"\n{label}: {content}\n"
+
+
+def make_turn(message_id, role, content, token_count=None):
+    """Build an (id, role, content, rendered, token_count) turn tuple"""
+    if token_count is None:
+        token_count = estimate_tokens(content)  # Row written before token counts existed
+    return (message_id, role, content, render_turn(role, content), token_count)
+
+
+class _ChatTurns:
+    """Cached tail of one chat as turn tuples, oldest first"""
+    def __init__(self, message_count, turns):
+        self.message_count = message_count
+        self.turns = turns
+        self.size = sum(_turn_size(turn) for turn in turns)
+        self.first = None  # First turn of the chat, when it is not in turns
+        self.rendered = {}  # (message_count, window arguments) -> joined history text
+
+
+def _turn_size(turn):
+    return sys.getsizeof(turn[2]) + sys.getsizeof(turn[3])
+
+
+class HistoryCache:
+    def __init__(self, max_turns=HISTORY_CACHE_TURNS, max_bytes=HISTORY_CACHE_BYTES):
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._chats = OrderedDict()
+        self._loading = {}  # chat_id -> token of the load in progress
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, chat_id, message_count):
+        """Return the cached tail, or None if missing or out of step with message_count"""
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            # A different count means another process wrote to the chat
+            if entry is None or entry.message_count != message_count:
+                self.stats['misses'] += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.stats['hits'] += 1
+            return entry
+
+    def begin_load(self, chat_id):
+        """Mark a load as started; appends that land before store() cancel it"""
+        token = object()
+        with self._lock:
+            self._loading[chat_id] = token
+        return token
+
+    def store(self, chat_id, token, message_count, rows):
+        """Cache rows (id, role, content, token_count), oldest first, read after begin_load()"""
+        entry = _ChatTurns(message_count, [make_turn(*row) for row in rows])
+        with self._lock:
+            if self._loading.get(chat_id) is not token:
+                return entry  # A write raced the load; serve it but do not cache it
+            del self._loading[chat_id]
+            self._discard(chat_id)
+            self._chats[chat_id] = entry
+            self.size += entry.size
+            self._evict()
+        return entry
+
+    def append(self, chat_id, message_id, role, content, token_count=None):
+        """Record a committed message so the cached tail stays current"""
+        with self._lock:
+            self._loading.pop(chat_id, None)
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                return
+            if entry.turns and entry.turns[-1][0] >= message_id:
+                # Committed out of order by a concurrent writer; reload next time
+                self._discard(chat_id)
+                return
+            turn = make_turn(message_id, role, content, token_count)
+            entry.turns.append(turn)
+            entry.message_count += 1
+            entry.size += _turn_size(turn)
+            self.size += _turn_size(turn)
+            entry.rendered.clear()
+            if len(entry.turns) > self.max_turns:
+                dropped = entry.turns.pop(0)
+                entry.size -= _turn_size(dropped)
+                self.size -= _turn_size(dropped)
+            self._evict()
+
+    def update(self, chat_id, message_id, content, token_count=None):
+        """Replace a cached message's content (an answer persisted while it streams)
+
+        The message count does not change, so without this the cached tail, the
+        pinned first turn and the rendered history would keep the old text.
+        """
+        with self._lock:
+            self._loading.pop(chat_id, None)  # A load in progress may have read the old text
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                return
+            entry.rendered.clear()
+            if entry.first is not None and entry.first[0] == message_id:
+                entry.first = make_turn(message_id, entry.first[1], content, token_count)
+            for index in range(len(entry.turns) - 1, -1, -1):
+                old = entry.turns[index]
+                if old[0] == message_id:
+                    turn = make_turn(message_id, old[1], content, token_count)
+                    entry.turns[index] = turn
+                    entry.size += _turn_size(turn) - _turn_size(old)
+                    self.size += _turn_size(turn) - _turn_size(old)
+                    self._evict()
+                    return
+                if old[0] < message_id:
+                    return
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._loading.pop(chat_id, None)
+            self._discard(chat_id)
+
+    def _discard(self, chat_id):
+        entry = self._chats.pop(chat_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._chats) > 1:
+            chat_id, entry = self._chats.popitem(last=False)
+            self.size -= entry.size
+            self.stats['evictions'] += 1
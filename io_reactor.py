@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Shared I/O reactor for subprocess output
+One thread multiplexes every registered child stdout / PTY fd with a selector (epoll on
+Linux), decodes the bytes and hands lines or chunks to per-stream callbacks, so runners
+no longer need a reader (and writer) thread each
+"""
+import atexit
+import codecs
+import errno
+import logging
+import os
+import selectors
+import threading
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 65536            # Bytes per os.read
+REAP_POLL_INTERVAL = 0.05    # Exit-code polling (s) when pidfds are unavailable
+
+
+class Stream:
+    """One registered fd; callbacks run on the reactor thread and must not block"""
+
+    def __init__(self, reactor, fd, on_line, on_chunk, on_close, process, encoding, errors):
+        self.reactor = reactor
+        self.fd = fd
+        self.on_line = on_line
+        self.on_chunk = on_chunk
+        self.on_close = on_close
+        self.process = process
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.partial = ''            # Line mode: text after the last newline
+        self.pending = bytearray()   # Bytes waiting for the fd to become writable
+        self.pidfd = None
+        self.eof = False
+        self.closed = False
+        self.close_fd = False
+        self.returncode = None
+        self.done = threading.Event()
+
+    def write(self, data):
+        """Queue bytes for the child (PTY or stdin pipe); safe from any thread"""
+        self.reactor._call(self._queue_write, bytes(data))
+
+    def close(self, close_fd=False):
+        """Stop watching the fd; with close_fd the reactor closes it once it is unregistered"""
+        try:
+            self.reactor._call(self._close_now, close_fd)
+        except RuntimeError:
+            # Reactor already stopped (interpreter exit): nothing is watching the fd
+            if close_fd:
+                self._close_now(close_fd)
+
+    def wait(self, timeout=None):
+        """Block until EOF (and exit, if a process was given); returns the exit code"""
+        self.done.wait(timeout)
+        return self.returncode
+
+    def _queue_write(self, data):
+        if self.eof:
+            return
+        self.pending += data
+        self.reactor._update(self)
+
+    def _close_now(self, close_fd):
+        if not self.eof:
+            self.close_fd = close_fd
+            self.reactor._finish(self)
+        elif close_fd and not self.close_fd:
+            self.close_fd = True
+            os.close(self.fd)
+
+
+class Reactor:
+    """Selector loop on a daemon thread; register() a file, fd or Popen stdout to watch it"""
+
+    def __init__(self, name='io-reactor'):
+        self.name = name
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._calls = []
+        self._streams = {}       # fd -> Stream
+        self._reaping = set()    # streams at EOF whose process has not exited yet
+        self._closed = False
+        self._thread = None
+
+    def register(self, source, on_line=None, on_chunk=None, on_close=None, process=None,
+                 encoding='utf-8', errors='replace'):
+        """Watch source (file object or fd) until EOF
+
+        on_line(line) gets each decoded line without its newline, on_chunk(text)
+        gets text as it arrives; on_close(returncode) is called once, after EOF
+        and - when process is given - after the process has exited.
+        """
+        fd = source if isinstance(source, int) else source.fileno()
+        os.set_blocking(fd, False)
+        stream = Stream(self, fd, on_line, on_chunk, on_close, process, encoding, errors)
+        self._call(self._add, stream)
+        return stream
+
+    def _call(self, fn, *args):
+        """Run fn on the reactor thread"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('reactor is closed')
+            self._calls.append((fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass  # Already awake
+
+    def _add(self, stream):
+        self._streams[stream.fd] = stream
+        self._selector.register(stream.fd, selectors.EVENT_READ, stream)
+
+    def _update(self, stream):
+        if stream.fd in self._streams:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if stream.pending else 0)
+            self._selector.modify(stream.fd, events, stream)
+
+    def _loop(self):
+        while True:
+            timeout = REAP_POLL_INTERVAL if any(s.pidfd is None for s in self._reaping) else None
+            for key, events in self._selector.select(timeout):
+                stream = key.data
+                if stream is None:
+                    self._run_calls()
+                elif isinstance(stream, tuple):
+                    self._reap(stream[1])
+                else:
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(stream)
+                    if events & selectors.EVENT_READ and not stream.eof:
+                        self._read(stream)
+            for stream in list(self._reaping):
+                if stream.pidfd is None:
+                    self._reap(stream)
+            with self._lock:
+                if self._closed and not self._calls:
+                    break
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _run_calls(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Reactor call {fn.__name__} failed: {e}")
+
+    def _read(self, stream):
+        try:
+            data = os.read(stream.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # A PTY master reports EIO once the child side is gone
+            if e.errno != errno.EIO:
+                logger.warning(f"Read error on fd {stream.fd}: {e}")
+            data = b''
+        if data:
+            self._deliver(stream, stream.decoder.decode(data))
+        else:
+            self._deliver(stream, stream.decoder.decode(b'', final=True))
+            if stream.on_line and stream.partial:
+                self._callback(stream, stream.on_line, stream.partial)
+                stream.partial = ''
+            self._finish(stream)
+
+    def _deliver(self, stream, text):
+        if not text:
+            return
+        if stream.on_chunk:
+            self._callback(stream, stream.on_chunk, text)
+        if stream.on_line:
+            lines = (stream.partial + text).split('\n')
+            stream.partial = lines.pop()
+            for line in lines:
+                self._callback(stream, stream.on_line, line.rstrip('\r'))
+
+    def _flush(self, stream):
+        try:
+            written = os.write(stream.fd, stream.pending)
+            del stream.pending[:written]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logger.warning(f"Write error on fd {stream.fd}: {e}")
+            stream.pending.clear()
+        self._update(stream)
+
+    def _finish(self, stream):
+        """EOF or close(): unregister the fd, then wait for the process to exit"""
+        if stream.eof:
+            return
+        stream.eof = True
+        if self._streams.pop(stream.fd, None) is not None:
+            self._selector.unregister(stream.fd)
+        if stream.close_fd:
+            os.close(stream.fd)
+        if stream.process is None or stream.process.poll() is not None:
+            self._closed_stream(stream)
+            return
+        try:
+            stream.pidfd = os.pidfd_open(stream.process.pid)
+            self._selector.register(stream.pidfd, selectors.EVENT_READ, ('exit', stream))
+        except (AttributeError, OSError):
+            stream.pidfd = None
+        self._reaping.add(stream)
+
+    def _reap(self, stream):
+        if stream.process.poll() is None:
+            return
+        if stream.pidfd is not None:
+            self._selector.unregister(stream.pidfd)
+            os.close(stream.pidfd)
+            stream.pidfd = None
+        self._reaping.discard(stream)
+        self._closed_stream(stream)
+
+    def _closed_stream(self, stream):
+        stream.closed = True
+        stream.returncode = stream.process.returncode if stream.process is not None else None
+        if stream.on_close:
+            self._callback(stream, stream.on_close, stream.returncode)
+        stream.done.set()
+
+    def _callback(self, stream, fn, arg):
+        try:
+            fn(arg)
+        except Exception as e:
+            logger.error(f"Callback for fd {stream.fd} failed: {e}")
+
+    def stats(self):
+        return {'streams': len(self._streams), 'reaping': len(self._reaping)}
+
+    def close(self):
+        """Stop the loop; streams still open are left as they are"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is None:
+            self._selector.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            return
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass
+        if thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_reactor():
+    """The process-wide reactor, started on first use"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Reactor()
+            atexit.register(_default.close)
+        return _default
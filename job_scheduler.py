@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Bounded concurrency scheduler for Claude CLI jobs
+Each model runs at most N jobs at once; further jobs wait in a bounded FIFO queue and are
+rejected with a Retry-After estimate when the queue is full or the wait would be too long.
+Global limits cap running and queued jobs over all models, and model names from clients are
+mapped to the configured models (anything else shares the 'default' slot)
+"""
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = int(os.environ.get('WEBAI_DEFAULT_CONCURRENCY', '2'))  # Running jobs per model
+QUEUE_SIZE = int(os.environ.get('WEBAI_QUEUE_SIZE', '20'))                   # Waiting jobs per model
+MAX_QUEUE_WAIT = int(os.environ.get('WEBAI_MAX_QUEUE_WAIT', '600'))          # Shed jobs expected to wait longer (s)
+GLOBAL_CONCURRENCY = int(os.environ.get('WEBAI_GLOBAL_CONCURRENCY', '8'))    # Running jobs over all models
+GLOBAL_QUEUE_SIZE = int(os.environ.get('WEBAI_GLOBAL_QUEUE_SIZE', '50'))     # Waiting jobs over all models
+DEFAULT_MODEL = 'default'    # Scheduling key of model names that match no configured model
+DEFAULT_DURATION = 60        # Expected job length (s) before any job of the model has finished
+DURATION_WEIGHT = 0.2        # Weight of the newest job in the moving average of durations
+FINISHED_JOBS = 200          # Finished jobs kept for status polling
+
+
+def parse_limits(text):
+    """'opus=1,sonnet=3' -> {'opus': 1, 'sonnet': 3}"""
+    limits = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            model, limit = item.split('=', 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+MODEL_CONCURRENCY = parse_limits(os.environ.get('WEBAI_MODEL_CONCURRENCY', 'opus=2,sonnet=4,haiku=4'))
+
+
+class QueueFull(Exception):
+    """The model's wait queue is full; retry_after is a whole number of seconds"""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f'Queue for {model} is full, retry after {retry_after}s')
+        self.model = model
+        self.retry_after = retry_after
+
+
+class Job:
+    """A scheduled call; result() blocks until it has run"""
+
+    def __init__(self, scheduler, model, fn, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.started = threading.Event()
+        self.state = 'queued'
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._scheduler = scheduler
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Withdraw a queued job; returns False once it has started"""
+        return self._scheduler.cancel(self)
+
+    def status(self):
+        """Queue position and estimated start, for clients"""
+        return self._scheduler.status(self)
+
+
+class JobScheduler:
+    def __init__(self, limits=None, default_limit=DEFAULT_CONCURRENCY, queue_size=QUEUE_SIZE,
+                 max_wait=MAX_QUEUE_WAIT, global_limit=GLOBAL_CONCURRENCY, global_queue_size=GLOBAL_QUEUE_SIZE):
+        self.limits = dict(MODEL_CONCURRENCY if limits is None else limits)
+        self.default_limit = default_limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.global_limit = global_limit
+        self.global_queue_size = global_queue_size
+        self._lock = threading.Lock()
+        self._queued = {}        # model -> deque of waiting jobs
+        self._running = {}       # model -> set of running jobs
+        self._durations = {}     # model -> moving average of job duration (s)
+        self._jobs = {}          # id -> queued or running job
+        self._finished = OrderedDict()
+        self.stats = {'started': 0, 'rejected': 0, 'shed': 0, 'cancelled': 0}
+
+    def limit(self, model):
+        return self.limits.get(model, self.default_limit)
+
+    def model_key(self, model):
+        """Configured model a client-supplied name is scheduled under
+
+        'sonnet' and 'claude-sonnet-4-20250514' both count against 'sonnet'; names that
+        match no configured model share DEFAULT_MODEL, so made-up names cannot add slots.
+        """
+        name = str(model or '').lower()
+        if name in self.limits:
+            return name
+        for key in self.limits:
+            if key in name:
+                return key
+        return DEFAULT_MODEL
+
+    def _running_total(self):
+        return sum(len(running) for running in self._running.values())
+
+    def _queued_total(self):
+        return sum(len(queued) for queued in self._queued.values())
+
+    def submit(self, model, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) under model's limit; raises QueueFull instead of queueing past the bound"""
+        model = self.model_key(model)
+        job = Job(self, model, fn, args, kwargs)
+        with self._lock:
+            running = self._running.setdefault(model, set())
+            queued = self._queued.setdefault(model, deque())
+            # A job waiting for a global slot would already have taken a free one, so a model
+            # with a free slot and an empty queue can start right away
+            if len(running) < self.limit(model) and not queued and self._running_total() < self.global_limit:
+                self._start(job)
+                return job
+
+            wait = self._start_times(model, len(queued) + 1)[-1] - time.monotonic()
+            if len(queued) >= self.queue_size or self._queued_total() >= self.global_queue_size:
+                self.stats['rejected'] += 1
+                raise QueueFull(model, self._retry_after(model))
+            if wait > self.max_wait:
+                self.stats['shed'] += 1
+                raise QueueFull(model, max(1, math.ceil(wait - self.max_wait)))
+            queued.append(job)
+            self._jobs[job.id] = job
+        return job
+
+    def _start(self, job):
+        """Run job on its own thread; the caller holds the lock"""
+        job.state = 'running'
+        job.started_at = time.time()
+        self._running[job.model].add(job)
+        self._jobs[job.id] = job
+        self.stats['started'] += 1
+        thread = threading.Thread(target=self._run, args=(job,), name=f'job-{job.model}')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, job):
+        job.started.set()
+        started = time.monotonic()
+        if job.future.set_running_or_notify_cancel():
+            try:
+                job.future.set_result(job.fn(*job.args, **job.kwargs))
+            except Exception as e:
+                job.future.set_exception(e)
+        duration = time.monotonic() - started
+
+        with self._lock:
+            average = self._durations.get(job.model)
+            self._durations[job.model] = duration if average is None else (
+                average + DURATION_WEIGHT * (duration - average))
+            self._running[job.model].discard(job)
+            self._retire(job, 'done')
+            self._start_queued()
+
+    def _start_queued(self):
+        """Start waiting jobs, oldest first, while their model and the global limit allow; the caller holds the lock"""
+        while self._running_total() < self.global_limit:
+            ready = [queued for model, queued in self._queued.items()
+                     if queued and len(self._running[model]) < self.limit(model)]
+            if not ready:
+                return
+            self._start(min(ready, key=lambda queued: queued[0].submitted_at).popleft())
+
+    def _retire(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        self._jobs.pop(job.id, None)
+        self._finished[job.id] = job
+        while len(self._finished) > FINISHED_JOBS:
+            self._finished.popitem(last=False)
+
+    def cancel(self, job):
+        with self._lock:
+            queued = self._queued.get(job.model, ())
+            if job not in queued:
+                return False
+            queued.remove(job)
+            self._retire(job, 'cancelled')
+            self.stats['cancelled'] += 1
+        job.future.cancel()
+        return True
+
+    def get(self, job_id):
+        """A queued, running or recently finished job, or None"""
+        with self._lock:
+            return self._jobs.get(job_id) or self._finished.get(job_id)
+
+    def _start_times(self, model, count):
+        """Expected monotonic start times of the next `count` jobs in model's queue
+
+        Each slot frees when its running job reaches the average duration
+        (or now, if it is already late); queued jobs take slots in order.
+        """
+        now = time.monotonic()
+        duration = self._durations.get(model, DEFAULT_DURATION)
+        slots = [now] * max(0, self.limit(model) - len(self._running.get(model, ())))
+        for job in self._running.get(model, ()):
+            elapsed = time.time() - job.started_at
+            slots.append(now + max(0, duration - elapsed))
+        heapq.heapify(slots)
+        starts = []
+        for _ in range(count):
+            start = heapq.heappop(slots) if slots else now
+            starts.append(start)
+            heapq.heappush(slots, start + duration)
+        return starts
+
+    def _retry_after(self, model):
+        """Seconds until the head of a full queue is expected to start, freeing a place"""
+        return max(1, math.ceil(self._start_times(model, 1)[0] - time.monotonic()))
+
+    def status(self, job):
+        with self._lock:
+            status = {'id': job.id, 'model': job.model, 'state': job.state, 'position': 0,
+                      'submitted_at': job.submitted_at, 'started_at': job.started_at,
+                      'estimated_start': job.started_at}
+            queued = self._queued.get(job.model, ())
+            if job.state == 'queued' and job in queued:
+                position = list(queued).index(job)
+                wait = self._start_times(job.model, position + 1)[-1] - time.monotonic()
+                status['position'] = position + 1
+                status['estimated_start'] = time.time() + max(0, wait)
+        return status
+
+    def snapshot(self):
+        """Running and queued jobs per model, for monitoring"""
+        with self._lock:
+            return {
+                'models': {model: {'running': len(self._running.get(model, ())),
+                                   'queued': len(self._queued.get(model, ())),
+                                   'limit': self.limit(model),
+                                   'average_duration': self._durations.get(model)}
+                           for model in set(self._running) | set(self._queued)},
+                'running': self._running_total(),
+                'queued': self._queued_total(),
+                'global_limit': self.global_limit,
+                'global_queue_size': self.global_queue_size,
+                'stats': dict(self.stats)
+            }
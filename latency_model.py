@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+History-driven deadlines for Claude CLI runs
+Completion times are recorded per model and thinking mode; a request's budget is a high
+percentile of that history (total, time to first output, longest silence) instead of a
+fixed timeout per keyword. The remaining budget travels to the next tier in a header
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_PERCENTILE = float(os.environ.get('WEBAI_LATENCY_PERCENTILE', '0.99'))  # Of recorded runs
+LATENCY_HEADROOM = float(os.environ.get('WEBAI_LATENCY_HEADROOM', '1.5'))       # Multiplier on the percentile
+LATENCY_WINDOW = 500         # Recent runs kept per model and thinking mode
+LATENCY_MIN_SAMPLES = 20     # Fewer runs than this: the fixed timeouts below apply
+MIN_TIMEOUT = 60             # Floor of a history-derived total budget (s)
+MIN_INACTIVITY = 30          # Floor of the silence allowed between outputs (s)
+MAX_TIMEOUT = 3600           # Ceiling of any budget (s); Anthropic allows up to 60 minutes
+
+# Remaining budget in seconds, sent to the next tier (relative, so clock skew does not matter)
+DEADLINE_HEADER = 'X-Request-Deadline'
+
+# Thinking keywords, most expensive first, and the fixed timeouts used until there is history
+THINKING_MODES = ('ultrathink', 'think harder', 'megathink', 'think hard', 'think')
+DEFAULT_TIMEOUTS = {
+    'ultrathink': 1800,  # 30 minutes (31,999 tokens)
+    'megathink': 900,    # 15 minutes (10,000 tokens)
+}
+DEFAULT_TIMEOUT = 600    # 10 minutes for everything else
+
+LATENCY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS latency_samples (
+    model TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    total REAL NOT NULL,
+    first_token REAL,
+    max_gap REAL,
+    recorded_at REAL NOT NULL,
+    censored INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+Budget = namedtuple('Budget', 'total first_token inactivity samples')
+
+
+def thinking_mode(message):
+    """'ultrathink', 'megathink', ... or 'none' for a message"""
+    message = (message or '').lower()
+    for mode in THINKING_MODES:
+        if mode in message:
+            return mode
+    return 'none'
+
+
+def parse_deadline(value):
+    """Seconds left from a DEADLINE_HEADER value, or None if absent or malformed"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class DeadlineExceeded(TimeoutError):
+    """A run went past its total budget, produced nothing in time, or fell silent"""
+
+    def __init__(self, phase, elapsed):
+        super().__init__(f"Deadline exceeded ({phase}) after {elapsed:.0f}s")
+        self.phase = phase
+        self.elapsed = elapsed
+
+
+class Deadline:
+    """Budget of one request, started when it arrives at this tier
+
+    begin() when the run starts, after any queue wait: the total budget counts
+    from arrival, time to first output from the start of the run. touch() on
+    every piece of output; exceeded() names the limit that has passed: 'total',
+    'first_token' (nothing yet) or 'inactivity' (silent too long).
+    """
+
+    def __init__(self, total, first_token=None, inactivity=None, model=None, mode='none'):
+        self.model = model
+        self.mode = mode
+        self.total = total
+        self.first_token = first_token
+        self.inactivity = inactivity
+        self.start = time.monotonic()
+        self.started = self.start    # Start of the run; begin() moves it past the queue wait
+        self.first_output = None
+        self.last_output = None
+        self.max_gap = 0.0
+
+    def begin(self):
+        self.started = time.monotonic()
+
+    def touch(self):
+        now = time.monotonic()
+        if self.first_output is None:
+            self.first_output = now
+        else:
+            self.max_gap = max(self.max_gap, now - self.last_output)
+        self.last_output = now
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def remaining(self):
+        return max(0.0, self.start + self.total - time.monotonic())
+
+    def header(self):
+        """Value of DEADLINE_HEADER for a request to the next tier"""
+        return f"{self.remaining():.1f}"
+
+    def _limits(self):
+        yield 'total', self.start + self.total
+        if self.first_output is None:
+            if self.first_token is not None:
+                yield 'first_token', self.started + self.first_token
+        elif self.inactivity is not None:
+            yield 'inactivity', self.last_output + self.inactivity
+
+    def exceeded(self):
+        """Name of the limit that has passed, or None"""
+        now = time.monotonic()
+        for phase, at in self._limits():
+            if now >= at:
+                return phase
+        return None
+
+    def check(self):
+        phase = self.exceeded()
+        if phase:
+            raise DeadlineExceeded(phase, self.elapsed())
+
+    def next_check(self):
+        """Seconds until the nearest limit could pass"""
+        return max(0.0, min(at for _, at in self._limits()) - time.monotonic())
+
+    def wait(self, event):
+        """Wait for a threading.Event; returns the phase that ran out first, or None"""
+        while not event.wait(self.next_check()):
+            phase = self.exceeded()
+            if phase:
+                return phase
+        return None
+
+
+class LatencyModel:
+    """Recent completion times per (model, thinking mode); path= keeps them in SQLite"""
+
+    def __init__(self, percentile=LATENCY_PERCENTILE, headroom=LATENCY_HEADROOM,
+                 window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES, path=None):
+        self.percentile = percentile
+        self.headroom = headroom
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}       # (model, mode) -> deque of (total, first_token, max_gap, censored)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._open(path)
+
+    def _open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(LATENCY_SCHEMA)
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(latency_samples)')}
+        if 'censored' not in columns:
+            self._db.execute('ALTER TABLE latency_samples ADD COLUMN censored INTEGER NOT NULL DEFAULT 0')
+        rows = self._db.execute('SELECT model, mode, total, first_token, max_gap, censored FROM latency_samples '
+                                'ORDER BY recorded_at').fetchall()
+        for model, mode, total, first_token, max_gap, censored in rows:
+            self._series(model, mode).append((total, first_token, max_gap, bool(censored)))
+        logger.info(f"Loaded {len(rows)} latency samples from {path}")
+
+    def _series(self, model, mode):
+        key = (model or '', mode)
+        series = self._samples.get(key)
+        if series is None:
+            series = self._samples[key] = deque(maxlen=self.window)
+        return series
+
+    def record(self, deadline, timed_out=False):
+        """Add a run, timed by its Deadline
+
+        Successful runs only, or with timed_out=True a run killed at its deadline: a
+        censored sample, recording how long it had run so far as a lower bound. Leaving
+        timeouts out would let the percentile fall after every run that was too slow.
+        """
+        now = time.monotonic()
+        # The run alone: queue wait before begin() says nothing about how long runs take
+        total = now - deadline.started
+        if deadline.first_output is not None:
+            first_token = deadline.first_output - deadline.started
+            max_gap = max(deadline.max_gap, now - deadline.last_output) if timed_out else deadline.max_gap
+        else:
+            first_token = now - deadline.started if timed_out else None
+            max_gap = None
+        with self._lock:
+            self._series(deadline.model, deadline.mode).append((total, first_token, max_gap, timed_out))
+            if self._db is not None:
+                try:
+                    self._db.execute('INSERT INTO latency_samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (deadline.model or '', deadline.mode, total, first_token, max_gap, time.time(),
+                                      int(timed_out)))
+                    if len(self._series(deadline.model, deadline.mode)) == self.window:
+                        # Drop what has fallen out of the window, keeping the table bounded
+                        self._db.execute('DELETE FROM latency_samples WHERE model = ? AND mode = ? AND rowid NOT IN '
+                                         '(SELECT rowid FROM latency_samples WHERE model = ? AND mode = ? '
+                                         'ORDER BY recorded_at DESC LIMIT ?)',
+                                         (deadline.model or '', deadline.mode) * 2 + (self.window,))
+                except sqlite3.Error as e:
+                    # Persistence is best effort; the in-memory history keeps working
+                    logger.warning(f"Latency sample write failed: {e}")
+
+    def budget(self, model, mode='none'):
+        """Budget for a run: percentile of history with headroom, or the fixed timeout"""
+        with self._lock:
+            samples = list(self._samples.get((model or '', mode), ()))
+        if len(samples) < self.min_samples:
+            return Budget(DEFAULT_TIMEOUTS.get(mode, DEFAULT_TIMEOUT), None, None, len(samples))
+        total = min(MAX_TIMEOUT, max(MIN_TIMEOUT, _percentile([s[0] for s in samples], self.percentile) * self.headroom))
+        first_tokens = [s[1] for s in samples if s[1] is not None]
+        first_token = None
+        if len(first_tokens) >= self.min_samples:
+            first_token = min(total, _percentile(first_tokens, self.percentile) * self.headroom)
+        gaps = [s[2] for s in samples if s[2] is not None]
+        inactivity = None
+        if len(gaps) >= self.min_samples:
+            inactivity = min(total, max(MIN_INACTIVITY, _percentile(gaps, self.percentile) * self.headroom))
+        return Budget(total, first_token, inactivity, len(samples))
+
+    def deadline(self, model, message, upstream=None):
+        """Deadline for a request; upstream is the DEADLINE_HEADER value, if a caller sent one"""
+        mode = thinking_mode(message)
+        budget = self.budget(model, mode)
+        total = budget.total
+        remaining = parse_deadline(upstream)
+        if remaining is not None:
+            total = min(total, remaining)
+        return Deadline(total, budget.first_token, budget.inactivity, model, mode)
+
+    def snapshot(self):
+        """Budgets and sample counts per model and thinking mode, for monitoring"""
+        with self._lock:
+            timeouts = {key: sum(1 for s in series if s[3]) for key, series in self._samples.items()}
+        status = {}
+        for (model, mode), censored in timeouts.items():
+            budget = self.budget(model, mode)
+            status[f'{model}/{mode}'] = {
+                'samples': budget.samples,
+                'timeouts': censored,
+                'total': round(budget.total, 1),
+                'first_token': round(budget.first_token, 1) if budget.first_token is not None else None,
+                'inactivity': round(budget.inactivity, 1) if budget.inactivity is not None else None
+            }
+        return status
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Exact-match response cache for repeated prompts
+Answers are keyed by the normalized prompt, model, web search flag and the version of the
+safety/instruction prompt wrapped around it, so a repeat is served without a CLI run
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_MB = int(os.environ.get('WEBAI_RESPONSE_CACHE_MB', '64'))       # 0 disables the cache
+RESPONSE_CACHE_TTL = int(os.environ.get('WEBAI_RESPONSE_CACHE_TTL', '3600'))   # Answers from knowledge (s)
+WEB_SEARCH_TTL = int(os.environ.get('WEBAI_RESPONSE_CACHE_WEB_TTL', '300'))    # Answers that may cite live pages (s)
+ENTRY_OVERHEAD = 200         # Bytes counted per entry on top of the answer (key, bookkeeping)
+
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+)
+'''
+
+_SPACES = re.compile(r'\s+')
+_URL = re.compile(r'https?://')
+
+
+def normalize_prompt(prompt):
+    """Fold width/case and collapse whitespace: '今日の天気は？ ' == '今日の天気は?'"""
+    return _SPACES.sub(' ', unicodedata.normalize('NFKC', prompt)).strip().casefold()
+
+
+def prompt_version(template):
+    """Short hash of the text wrapped around the user's prompt; editing it retires old answers"""
+    return hashlib.sha1(template.encode('utf-8')).hexdigest()[:12]
+
+
+def cache_key(prompt, model, web_search=False, version=''):
+    text = '\0'.join((version, model or '', '1' if web_search else '0', normalize_prompt(prompt)))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """LRU by byte size with a TTL per entry; path= keeps entries in SQLite across restarts"""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MB * 1024 * 1024, ttl=RESPONSE_CACHE_TTL,
+                 web_search_ttl=WEB_SEARCH_TTL, path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.web_search_ttl = web_search_ttl
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (response, expires_at, size)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evictions': 0}
+        self._db = None
+        if path and max_bytes > 0:
+            self._open(path)
+
+    def _open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(CACHE_SCHEMA)
+        now = time.time()
+        self._db.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+        # Newest first until the byte budget is used, then insert oldest first for LRU order
+        rows = []
+        size = 0
+        for key, response, expires_at in self._db.execute(
+                'SELECT key, response, expires_at FROM response_cache ORDER BY created_at DESC'):
+            entry_size = len(response.encode('utf-8')) + ENTRY_OVERHEAD
+            if size + entry_size > self.max_bytes:
+                break
+            size += entry_size
+            rows.append((key, (response, expires_at, entry_size)))
+        for key, entry in reversed(rows):
+            self._entries[key] = entry
+        self.size = size
+        logger.info(f"Loaded {len(rows)} cached responses from {path}")
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, prompt, model, web_search=False, version=''):
+        """The cached answer, or None"""
+        if not self.enabled:
+            return None
+        key = cache_key(prompt, model, web_search, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                self._discard(key)
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, prompt, model, response, web_search=False, version='', ttl=None):
+        """Cache a successful answer; answers citing URLs get the short web search TTL"""
+        if not self.enabled or not response:
+            return
+        if ttl is None:
+            ttl = self.web_search_ttl if web_search or _URL.search(response) else self.ttl
+        if ttl <= 0:
+            return
+        key = cache_key(prompt, model, web_search, version)
+        now = time.time()
+        size = len(response.encode('utf-8')) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (response, now + ttl, size)
+            self.size += size
+            self.stats['stores'] += 1
+            if self._db is not None:
+                self._execute('INSERT OR REPLACE INTO response_cache (key, model, response, created_at, expires_at) '
+                              'VALUES (?, ?, ?, ?, ?)', (key, model, response, now, now + ttl))
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.stats['evictions'] += 1
+
+    def _discard(self, key):
+        """Drop an entry; the caller holds the lock"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+            if self._db is not None:
+                self._execute('DELETE FROM response_cache WHERE key = ?', (key,))
+
+    def _execute(self, sql, params):
+        try:
+            self._db.execute(sql, params)
+        except sqlite3.Error as e:
+            # Persistence is best effort; the in-memory cache keeps working
+            logger.warning(f"Response cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            if self._db is not None:
+                self._execute('DELETE FROM response_cache', ())
+
+    def snapshot(self):
+        """Hit/miss counters and size, for monitoring"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hit_rate': self.stats['hits'] / lookups if lookups else None,
+                'stats': dict(self.stats)
+            }
@@ -4,19 +4,396 @@ Session and Chat History Manager for WebAI
 """
 import sqlite3
 import json
+import html
+import re
 import uuid
 from datetime import datetime
 from pathlib import Path
 import os
+import atexit
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from db_pool import ConnectionPool
+from history_cache import HistoryCache, make_turn
+from token_budget import estimate_tokens
+from content_codec import COMPRESS_MIN_BYTES, decode_content, encode_content, register_functions
+import chat_archive
+
+logger = logging.getLogger(__name__)
+
+# Write-behind (group commit) defaults
+WRITE_BATCH_INTERVAL_MS = 20   # Commit a batch at most this long after its first row
+WRITE_BATCH_SIZE = 200         # ... or as soon as this many rows are queued
+WRITE_QUEUE_SIZE = 10000       # Producers block when this many rows are pending
+
+# Full-text search
+SEARCH_RANK_WINDOW = 1000   # Rank at most this many of the newest matches
+SEARCH_BM25_K1 = 1.2        # Term-frequency saturation
+SEARCH_BM25_B = 0.75        # Length normalisation
+SNIPPET_RADIUS = 40         # Characters of context around the first match
+_MARK_OPEN, _MARK_CLOSE = '\x02', '\x03'  # Snippet match markers, replaced after escaping
+
+# Compression of bodies stored before compression existed
+COMPRESS_BATCH_SIZE = 200     # Rows per transaction
+COMPRESS_BATCH_PAUSE = 0.05   # Seconds between transactions, leaves room for live writes
+
+_STOP = object()
+
+def _add_token_counts(conn):
+    """Migration 3: store an estimated token count per message, backfilling old rows"""
+    conn.execute('ALTER TABLE messages ADD COLUMN token_count INTEGER')
+    conn.create_function('webai_estimate_tokens', 1, estimate_tokens, deterministic=True)
+    conn.execute('UPDATE messages SET token_count = webai_estimate_tokens(content)')
+
+def _add_search_index(conn):
+    """Migration 4: trigram FTS5 index over message bodies, kept in sync by triggers
+    
+    Skipped (search falls back to LIKE) when SQLite lacks FTS5 or the trigram
+    tokenizer (before 3.34).
+    """
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Full-text search index unavailable, using LIKE search: {e}")
+        return
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def _add_content_encoding(conn):
+    """Migration 5: content_encoding flag for compressed bodies
+    
+    Triggers and the search index now see message text through
+    webai_inflate(), registered on every pooled connection. The search
+    index is rebuilt once over the messages_plain view.
+    """
+    conn.execute('ALTER TABLE messages ADD COLUMN content_encoding TEXT')
+    conn.execute('''
+        CREATE VIEW messages_plain AS
+        SELECT id, chat_id, role, webai_inflate(content, content_encoding) AS content, created_at
+        FROM messages
+    ''')
+    
+    for trigger in ('trg_messages_count_insert', 'trg_messages_count_delete', 'trg_messages_count_update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_count_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE chats SET
+                message_count = message_count + 1,
+                user_message_count = user_message_count + (NEW.role = 'user'),
+                last_message_at = NEW.created_at,
+                total_chars = total_chars + length(webai_inflate(NEW.content, NEW.content_encoding))
+            WHERE id = NEW.chat_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_count_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE chats SET
+                message_count = message_count - 1,
+                user_message_count = user_message_count - (OLD.role = 'user'),
+                total_chars = total_chars - length(webai_inflate(OLD.content, OLD.content_encoding))
+            WHERE id = OLD.chat_id;
+        END
+    ''')
+    # Recompressing a body leaves its text, and so every derived value, unchanged
+    conn.execute('''
+        CREATE TRIGGER trg_messages_count_update AFTER UPDATE OF content ON messages
+        WHEN webai_inflate(OLD.content, OLD.content_encoding) IS NOT webai_inflate(NEW.content, NEW.content_encoding)
+        BEGIN
+            UPDATE chats SET
+                total_chars = total_chars - length(webai_inflate(OLD.content, OLD.content_encoding))
+                                          + length(webai_inflate(NEW.content, NEW.content_encoding))
+            WHERE id = NEW.chat_id;
+        END
+    ''')
+    
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is None:
+        return
+    for trigger in ('trg_messages_fts_insert', 'trg_messages_fts_delete', 'trg_messages_fts_update'):
+        conn.execute(f'DROP TRIGGER {trigger}')
+    conn.execute('DROP TABLE messages_fts')
+    conn.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, content='messages_plain', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, content)
+            VALUES (NEW.id, webai_inflate(NEW.content, NEW.content_encoding));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, webai_inflate(OLD.content, OLD.content_encoding));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF content ON messages
+        WHEN webai_inflate(OLD.content, OLD.content_encoding) IS NOT webai_inflate(NEW.content, NEW.content_encoding)
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, webai_inflate(OLD.content, OLD.content_encoding));
+            INSERT INTO messages_fts (rowid, content)
+            VALUES (NEW.id, webai_inflate(NEW.content, NEW.content_encoding));
+        END
+    ''')
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _hot_filter(schema):
+    """Extra condition hiding archive rows of chats promoted back to the hot tier"""
+    if schema == 'main':
+        return ''
+    return 'AND NOT EXISTS (SELECT 1 FROM main.chats h WHERE h.id = c.id)'
+
+
+def _match_score(content, terms, average_length):
+    """BM25 term-frequency score of one candidate (terms lowercased)
+    
+    IDF is left out: it is the same for every candidate of a term, and
+    computing it means counting the term's hits over the whole index.
+    """
+    text = content.lower()
+    norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * len(text) / (average_length or 1))
+    score = 0
+    for term in terms:
+        frequency = text.count(term)
+        score += frequency * (SEARCH_BM25_K1 + 1) / (frequency + norm)
+    return score
+
+def _make_snippet(content, terms, radius=SNIPPET_RADIUS):
+    """HTML-escaped text around the first match, with every match wrapped in <mark>"""
+    lowered = content.lower()
+    start = min((lowered.find(term.lower()) for term in terms if term.lower() in lowered), default=0)
+    begin = max(0, start - radius)
+    end = min(len(content), start + radius * 2)
+    text = content[begin:end]
+    pattern = '|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+    text = re.sub(pattern, lambda m: _MARK_OPEN + m.group(0) + _MARK_CLOSE, text, flags=re.IGNORECASE)
+    # Mark first, escape second, so the content cannot inject markup
+    text = html.escape(text).replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>')
+    return ('…' if begin else '') + text + ('…' if end < len(content) else '')
+
+def _add_message_status(conn):
+    """Migration 6: status of answers persisted while they stream
+    
+    NULL for finished messages, 'streaming' while chunks are still being
+    appended, 'interrupted' for an answer cut short. Streaming rows stay out
+    of the search index (and its content view) until they are finished, so
+    the index is not rewritten on every appended batch.
+    """
+    conn.execute('ALTER TABLE messages ADD COLUMN status TEXT')
+    conn.execute('DROP VIEW messages_plain')
+    conn.execute('''
+        CREATE VIEW messages_plain AS
+        SELECT id, chat_id, role, webai_inflate(content, content_encoding) AS content, created_at
+        FROM messages
+        WHERE status IS NOT 'streaming'
+    ''')
+    
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is None:
+        return
+    for trigger in ('trg_messages_fts_insert', 'trg_messages_fts_delete', 'trg_messages_fts_update'):
+        conn.execute(f'DROP TRIGGER {trigger}')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages
+        WHEN NEW.status IS NOT 'streaming'
+        BEGIN
+            INSERT INTO messages_fts (rowid, content)
+            VALUES (NEW.id, webai_inflate(NEW.content, NEW.content_encoding));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages
+        WHEN OLD.status IS NOT 'streaming'
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            VALUES ('delete', OLD.id, webai_inflate(OLD.content, OLD.content_encoding));
+        END
+    ''')
+    # Each side only if it is (or is to be) indexed: a finished stream is inserted once
+    conn.execute('''
+        CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF content, status ON messages
+        WHEN (OLD.status IS NOT 'streaming' OR NEW.status IS NOT 'streaming')
+         AND (OLD.status IS NOT NEW.status OR
+              webai_inflate(OLD.content, OLD.content_encoding) IS NOT webai_inflate(NEW.content, NEW.content_encoding))
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content)
+            SELECT 'delete', OLD.id, webai_inflate(OLD.content, OLD.content_encoding)
+            WHERE OLD.status IS NOT 'streaming';
+            INSERT INTO messages_fts (rowid, content)
+            SELECT NEW.id, webai_inflate(NEW.content, NEW.content_encoding)
+            WHERE NEW.status IS NOT 'streaming';
+        END
+    ''')
+
+def _add_message_parts(conn):
+    """Migration 7: text of streaming answers, one row per appended batch
+    
+    Appending to messages.content rewrote the whole row on every batch, and the
+    update triggers inflated the old and new body each time: quadratic in the
+    answer's length. Batches are inserted here instead and folded into the
+    message once, when it is finished.
+    """
+    conn.execute('''
+        CREATE TABLE message_parts (
+            message_id INTEGER NOT NULL,
+            text TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_message_parts_message ON message_parts (message_id)')
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Each step is a list of SQL statements or a callable taking the connection.
+# Append new steps to the end; never edit or reorder released ones.
+MIGRATIONS = [
+    # 1: indexes for history loads, chat lists and keyset pagination
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)',
+        '''CREATE INDEX IF NOT EXISTS idx_chats_user_updated
+           ON chats (user_id, updated_at DESC, id DESC, title, created_at)''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, updated_at)',
+    ],
+    # 2: per-chat counters maintained by triggers, so every writer
+    #    (including simple_app's raw INSERTs) keeps them in step
+    [
+        'ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE chats ADD COLUMN user_message_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE chats ADD COLUMN last_message_at TIMESTAMP',
+        'ALTER TABLE chats ADD COLUMN total_chars INTEGER NOT NULL DEFAULT 0',
+        '''CREATE TRIGGER IF NOT EXISTS trg_messages_count_insert AFTER INSERT ON messages
+           BEGIN
+               UPDATE chats SET
+                   message_count = message_count + 1,
+                   user_message_count = user_message_count + (NEW.role = 'user'),
+                   last_message_at = NEW.created_at,
+                   total_chars = total_chars + length(NEW.content)
+               WHERE id = NEW.chat_id;
+           END''',
+        # last_message_at is left as is; single messages are never deleted on their own
+        '''CREATE TRIGGER IF NOT EXISTS trg_messages_count_delete AFTER DELETE ON messages
+           BEGIN
+               UPDATE chats SET
+                   message_count = message_count - 1,
+                   user_message_count = user_message_count - (OLD.role = 'user'),
+                   total_chars = total_chars - length(OLD.content)
+               WHERE id = OLD.chat_id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_messages_count_update AFTER UPDATE OF content ON messages
+           BEGIN
+               UPDATE chats SET
+                   total_chars = total_chars - length(OLD.content) + length(NEW.content)
+               WHERE id = NEW.chat_id;
+           END''',
+        # Backfill existing chats
+        '''UPDATE chats SET
+               message_count = (SELECT COUNT(*) FROM messages WHERE chat_id = chats.id),
+               user_message_count = (SELECT COUNT(*) FROM messages
+                                     WHERE chat_id = chats.id AND role = 'user'),
+               last_message_at = (SELECT MAX(created_at) FROM messages WHERE chat_id = chats.id),
+               total_chars = (SELECT COALESCE(SUM(length(content)), 0) FROM messages
+                              WHERE chat_id = chats.id)''',
+    ],
+    # 3: estimated token count per message, for token-budgeted history
+    _add_token_counts,
+    # 4: full-text search
+    _add_search_index,
+    # 5: compressed message bodies
+    _add_content_encoding,
+    # 6: answers persisted while they stream
+    _add_message_status,
+    # 7: streamed text kept apart until the answer is finished
+    _add_message_parts,
+]
+
+
+class StreamingMessage:
+    """Handle of a message persisted while it streams (SessionManager.start_message)"""
+    def __init__(self, chat_id, role):
+        self.chat_id = chat_id
+        self.role = role
+        self.id = None          # Set when the placeholder row is inserted
+        self.parts = []         # Text appended so far, for the history cache
+        self.finished = False
+
+    @property
+    def content(self):
+        return ''.join(self.parts)
+
 
 class SessionManager:
-    def __init__(self, db_path='webai.db'):
+    def __init__(self, db_path='webai.db', write_behind=False,
+                 batch_interval_ms=WRITE_BATCH_INTERVAL_MS, batch_size=WRITE_BATCH_SIZE,
+                 queue_size=WRITE_QUEUE_SIZE, compress_existing=True, archive_path=None):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        self.pool.add_connect_hook(register_functions)
+        # Optional cold tier: idle chats live in a second database ATTACHed as 'archive'
+        self.archive_path = archive_path
+        if archive_path:
+            self.pool.add_connect_hook(chat_archive.attach_hook(archive_path))
+        self.history_cache = HistoryCache()
         self._init_db()
+        
+        # Compress large bodies stored before compression existed, off the request path
+        self._compress_stop = threading.Event()
+        if compress_existing:
+            compressor = threading.Thread(target=self._compress_in_background, name='session-compress')
+            compressor.daemon = True
+            compressor.start()
+        
+        # Optional write-behind mode: one writer thread drains a bounded queue
+        # and commits rows in batches instead of one transaction per message
+        self.write_behind = write_behind
+        # Without it, streamed answers are still written off the caller's thread (the
+        # emit path of every running stream), in order, by one background thread
+        self._stream_executor = None if write_behind else ThreadPoolExecutor(1, thread_name_prefix='session-stream')
+        self.batch_interval = batch_interval_ms / 1000
+        self.batch_size = batch_size
+        self._write_queue = None
+        self._writer_thread = None
+        if write_behind:
+            self._write_queue = queue.Queue(maxsize=queue_size)
+            self._writer_thread = threading.Thread(target=self._writer_loop, name='session-writer')
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+            atexit.register(self.close)
     
     def _init_db(self):
         """Initialize database tables if they don't exist"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             
             # Create chats table
@@ -52,112 +429,491 @@ class SessionManager:
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            
-            conn.commit()
+        
+        self._migrate()
+        self._recover_streaming()
+        with self.pool.connection() as conn:
+            self.has_search_index = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone() is not None
+            if self.archive_path:
+                chat_archive.create_archive_schema(conn, with_search=self.has_search_index)
+    
+    def _recover_streaming(self):
+        """Mark answers left 'streaming' by a crash or restart as 'interrupted'
+        
+        Nothing appends to them any more. They keep the text saved so far and are
+        compressed, counted and indexed like a message finished by finish_message().
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT id, content FROM messages WHERE status = 'streaming'").fetchall()
+            parts = self._streamed_text(conn, [row[0] for row in rows])
+            for message_id, content in rows:
+                content += parts.get(message_id, '')
+                stored, encoding = encode_content(content)
+                conn.execute(
+                    "UPDATE messages SET content = ?, content_encoding = ?, token_count = ?, status = 'interrupted' "
+                    "WHERE id = ?",
+                    (stored, encoding, estimate_tokens(content), message_id)
+                )
+            # Parts of messages deleted while they streamed
+            conn.execute('DELETE FROM message_parts')
+        if rows:
+            logger.info(f"Marked {len(rows)} unfinished streamed answers as interrupted")
+    
+    @staticmethod
+    def _streamed_text(conn, message_ids):
+        """Text appended so far to streaming messages: {message_id: text}"""
+        if not message_ids:
+            return {}
+        placeholders = ', '.join('?' * len(message_ids))
+        text = {}
+        for message_id, part in conn.execute(
+            f'SELECT message_id, text FROM message_parts WHERE message_id IN ({placeholders}) ORDER BY rowid',
+            message_ids
+        ):
+            text[message_id] = text.get(message_id, '') + part
+        return text
+    
+    def _schemas(self):
+        """Schemas holding chats: the hot database, then the archive if configured"""
+        return ['main', chat_archive.ARCHIVE_SCHEMA] if self.archive_path else ['main']
+    
+    def _chat_schema(self, conn, chat_id):
+        """Schema whose tables hold the chat's current copy"""
+        return chat_archive.chat_schema(conn, chat_id) if self.archive_path else 'main'
+    
+    def _migrate(self):
+        """Apply pending schema migrations, one transaction per step"""
+        conn = self.pool.get()
+        while True:
+            with conn:
+                # IMMEDIATE takes the write lock up front so that two processes
+                # starting together do not both apply the same step
+                conn.execute('BEGIN IMMEDIATE')
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                migration = MIGRATIONS[version]
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for statement in migration:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
     
     def create_chat(self, user_id, title=None):
         """Create a new chat session"""
         if not title:
             title = f"チャット {datetime.now().strftime('%Y-%m-%d %H:%M')}"
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'INSERT INTO chats (user_id, title) VALUES (?, ?)',
                 (user_id, title)
             )
             chat_id = cursor.lastrowid
-            conn.commit()
             
         return chat_id
     
-    def get_user_chats(self, user_id, limit=50):
-        """Get user's chat list"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_user_chats(self, user_id, limit=50, before_id=None, after_id=None):
+        """Get user's chat list, most recently updated first
+        
+        before_id/after_id are keyset cursors: the chats listed after / before
+        the given chat in that order. limit=None returns every chat.
+        """
+        # With an archive, list both tiers; a promoted chat's stale archive copy is hidden
+        source = chat_archive.ALL_CHATS if self.archive_path else 'chats'
+        conditions = ['user_id = ?']
+        params = [user_id]
+        if before_id is not None:
+            conditions.append(f'(updated_at, id) < (SELECT updated_at, id FROM {source} WHERE id = ?)')
+            params.append(before_id)
+        if after_id is not None:
+            conditions.append(f'(updated_at, id) > (SELECT updated_at, id FROM {source} WHERE id = ?)')
+            params.append(after_id)
+        
+        # Paging towards newer chats walks the index upwards, then flips
+        ascending = after_id is not None and before_id is None
+        order = 'ASC' if ascending else 'DESC'
+        params.append(limit if limit is not None else -1)
+        
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, title, created_at, updated_at
-                FROM chats
-                WHERE user_id = ?
-                ORDER BY updated_at DESC
+            cursor.execute(f'''
+                SELECT id, title, created_at, updated_at,
+                       message_count, user_message_count, last_message_at, total_chars
+                FROM {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY updated_at {order}, id {order}
                 LIMIT ?
-            ''', (user_id, limit))
+            ''', params)
+            rows = cursor.fetchall()
+            if ascending:
+                rows.reverse()
             
             chats = []
-            for row in cursor.fetchall():
+            for row in rows:
                 chats.append({
                     'id': row[0],
                     'title': row[1],
                     'created_at': row[2],
-                    'updated_at': row[3]
+                    'updated_at': row[3],
+                    'message_count': row[4],
+                    'user_message_count': row[5],
+                    'last_message_at': row[6],
+                    'total_chars': row[7]
                 })
             
             return chats
     
-    def get_chat_messages(self, chat_id):
-        """Get messages for a specific chat"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_chat_owner(self, chat_id):
+        """user_id of the chat, or None if it does not exist (either tier)"""
+        with self.pool.connection() as conn:
+            schema = self._chat_schema(conn, chat_id)
+            row = conn.execute(f'SELECT user_id FROM {schema}.chats WHERE id = ?', (chat_id,)).fetchone()
+        return row[0] if row else None
+    
+    def get_chat_messages(self, chat_id, before_id=None, after_id=None, limit=None):
+        """Get messages for a specific chat, oldest first
+        
+        With a limit, returns the newest `limit` messages older than before_id
+        (or the newest overall), or the oldest `limit` newer than after_id.
+        """
+        conditions = ['chat_id = ?']
+        params = [chat_id]
+        if before_id is not None:
+            conditions.append('id < ?')
+            params.append(before_id)
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        
+        # A page ending at the newest message is read backwards, then flipped
+        descending = limit is not None and after_id is None
+        order = 'DESC' if descending else 'ASC'
+        params.append(limit if limit is not None else -1)
+        
+        with self.pool.connection() as conn:
+            schema = self._chat_schema(conn, chat_id)
+            # Archived chats are idle, so none of their messages is still streaming
+            status = 'status' if schema == 'main' else 'NULL'
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, role, content, created_at
-                FROM messages
-                WHERE chat_id = ?
-                ORDER BY created_at ASC
-            ''', (chat_id,))
+            cursor.execute(f'''
+                SELECT id, role, content, content_encoding, created_at, {status}
+                FROM {schema}.messages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY id {order}
+                LIMIT ?
+            ''', params)
+            rows = cursor.fetchall()
+            if descending:
+                rows.reverse()
+            streamed = self._streamed_text(conn, [row[0] for row in rows if row[5] == 'streaming'])
             
             messages = []
-            for row in cursor.fetchall():
+            for row in rows:
                 messages.append({
                     'id': row[0],
                     'role': row[1],
-                    'content': row[2],
-                    'created_at': row[3]
+                    'content': decode_content(row[2], row[3]) + streamed.get(row[0], ''),
+                    'created_at': row[4],
+                    'status': row[5]
                 })
             
             return messages
     
     def add_message(self, chat_id, role, content):
-        """Add a message to a chat"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
-                (chat_id, role, content)
-            )
-            
-            # Update chat's updated_at timestamp
-            cursor.execute(
-                'UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                (chat_id,)
-            )
-            
-            # Update chat title if it's the first user message
-            if role == 'user':
-                cursor.execute(
-                    'SELECT COUNT(*) FROM messages WHERE chat_id = ? AND role = "user"',
-                    (chat_id,)
-                )
-                count = cursor.fetchone()[0]
-                if count == 1:  # First user message
-                    # Use first 50 characters of message as title
-                    title = content[:50] + ('...' if len(content) > 50 else '')
-                    cursor.execute(
-                        'UPDATE chats SET title = ? WHERE id = ?',
-                        (title, chat_id)
-                    )
-            
-            conn.commit()
+        """Add a message to a chat and return its id
+        
+        In write-behind mode this waits for the batch holding the row to commit.
+        """
+        return self.submit_message(chat_id, role, content).result()
+    
+    def submit_message(self, chat_id, role, content):
+        """Queue a message and return a Future resolving to its id
+        
+        Without write-behind the row is committed before returning. With it,
+        wait on the Future when the caller needs to read its own write.
+        """
+        # Estimated and compressed here, in the caller's thread, not the writer's
+        token_count = estimate_tokens(content)
+        stored, encoding = encode_content(content)
+        future = self._submit(self._insert_message, chat_id, role, content, token_count, stored, encoding)
+        # Runs once the row is committed, in commit order within a batch
+        future.add_done_callback(
+            lambda f: f.exception() is None and
+            self.history_cache.append(chat_id, f.result(), role, content, token_count)
+        )
+        return future
+    
+    def start_message(self, chat_id, role='assistant'):
+        """Insert an empty message with status 'streaming' and return its StreamingMessage
+        
+        Text is added with append_to_message() as it arrives and the row is
+        completed with finish_message(). The writes are queued in order and never
+        run on the caller's thread; a reload in between shows the text so far.
+        """
+        message = StreamingMessage(chat_id, role)
+        future = self._submit_stream(self._insert_streaming, message)
+        future.add_done_callback(
+            lambda f: f.exception() is None and
+            self.history_cache.append(chat_id, f.result(), role, '', 0)
+        )
+        return message
+    
+    def append_to_message(self, message, text):
+        """Append a batch of streamed text to the message"""
+        if message.finished or not text:
+            return
+        message.parts.append(text)
+        content = message.content
+        future = self._submit_stream(self._append_content, message, text)
+        future.add_done_callback(
+            lambda f: f.exception() is None and
+            self.history_cache.update(message.chat_id, message.id, content)
+        )
+    
+    def finish_message(self, message, status=None):
+        """Complete the message: compressed and indexed like any other
+        
+        status is None for a complete answer or 'interrupted' for one cut short.
+        Returns a Future resolving to the message id.
+        """
+        message.finished = True
+        content = message.content
+        token_count = estimate_tokens(content)
+        stored, encoding = encode_content(content)
+        future = self._submit_stream(self._finish_streaming, message, stored, encoding, token_count, status)
+        future.add_done_callback(
+            lambda f: f.exception() is None and
+            self.history_cache.update(message.chat_id, message.id, content, token_count)
+        )
+        return future
+    
+    def _submit(self, operation, *args):
+        """Run operation(cursor, *args) in a transaction, now or via the writer thread"""
+        future = Future()
+        future.add_done_callback(self._log_write_failure)
+        if self._write_queue is not None:
+            self._write_queue.put((future, operation, args))
+            return future
+        
+        try:
+            future.set_result(self._execute(operation, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    
+    def _submit_stream(self, operation, *args):
+        """Like _submit, but never in the caller's thread: streamed-answer writes"""
+        if self._stream_executor is None:
+            return self._submit(operation, *args)
+        future = self._stream_executor.submit(self._execute, operation, *args)
+        future.add_done_callback(self._log_write_failure)
+        return future
+    
+    def _execute(self, operation, *args):
+        with self.pool.connection() as conn:
+            return operation(conn.cursor(), *args)
+    
+    @staticmethod
+    def _log_write_failure(future):
+        """Surface failures of fire-and-forget writes nobody waits on"""
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Message write failed: {error}")
+    
+    def flush(self, timeout=None):
+        """Wait until every queued write so far has been committed"""
+        if self._writer_thread is not None and self._writer_thread.is_alive():
+            barrier = Future()
+            self._write_queue.put((barrier, None, ()))
+            barrier.result(timeout)
+        if self._stream_executor is not None:
+            self._stream_executor.submit(lambda: None).result(timeout)
+    
+    def close(self):
+        """Flush pending writes and stop the writer thread"""
+        self._compress_stop.set()
+        if self._writer_thread is not None and self._writer_thread.is_alive():
+            self._write_queue.put(_STOP)
+            self._writer_thread.join()
+        if self._stream_executor is not None:
+            self._stream_executor.shutdown(wait=True)
+    
+    def _writer_loop(self):
+        """Drain the write queue, committing up to batch_size rows at a time
+        
+        Rows that arrive while a batch is committing form the next batch, so
+        batches grow with load without delaying a lone writer. batch_interval
+        caps how long one batch keeps collecting under a steady stream.
+        """
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    item = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+        
+        # Drain whatever was queued behind the stop marker
+        remaining = []
+        while True:
+            try:
+                item = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining.append(item)
+        if remaining:
+            self._commit_batch(remaining)
+    
+    def _commit_batch(self, batch):
+        """Commit a batch in one transaction; fall back to per-row on failure"""
+        try:
+            results = []
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                for future, operation, args in batch:
+                    results.append(operation(cursor, *args) if operation else None)
+        except Exception as e:
+            # One bad row (e.g. a deleted chat) must not fail its neighbours
+            logger.warning(f"Batch commit failed, retrying {len(batch)} rows one by one: {e}")
+            for future, operation, args in batch:
+                try:
+                    with self.pool.connection() as conn:
+                        result = operation(conn.cursor(), *args) if operation else None
+                    future.set_result(result)
+                except Exception as row_error:
+                    future.set_exception(row_error)
+            return
+        
+        for (future, operation, args), result in zip(batch, results):
+            future.set_result(result)
+    
+    def _insert_message(self, cursor, chat_id, role, content, token_count=None, stored=None, encoding=None,
+                        status=None):
+        """Insert a message row and update its chat; returns the message id"""
+        if stored is None:
+            stored, encoding = encode_content(content)
+        if self.archive_path:
+            # Writing to an archived chat brings it back to the hot tier first
+            chat_archive.promote_chat(cursor, chat_id)
+        cursor.execute(
+            'INSERT INTO messages (chat_id, role, content, content_encoding, token_count, status) VALUES (?, ?, ?, ?, ?, ?)',
+            (chat_id, role, stored, encoding, token_count, status)
+        )
+        message_id = cursor.lastrowid
+        
+        # Touch updated_at and, on the first user message, retitle the chat
+        # with its first 50 characters. user_message_count already includes
+        # this row (trigger), so no COUNT(*) over the chat is needed
+        title = content[:50] + ('...' if len(content) > 50 else '')
+        cursor.execute('''
+            UPDATE chats SET
+                updated_at = CURRENT_TIMESTAMP,
+                title = CASE WHEN ? = 'user' AND user_message_count = 1 THEN ? ELSE title END
+            WHERE id = ?
+        ''', (role, title, chat_id))
+        return message_id
+    
+    def _insert_streaming(self, cursor, message):
+        message.id = self._insert_message(cursor, message.chat_id, message.role, '', 0, status='streaming')
+        return message.id
+    
+    def _append_content(self, cursor, message, text):
+        # A row per batch: the message itself is only rewritten once, by _finish_streaming
+        cursor.execute('INSERT INTO message_parts (message_id, text) VALUES (?, ?)', (message.id, text))
+        cursor.execute('UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (message.chat_id,))
+        return message.id
+    
+    def _finish_streaming(self, cursor, message, stored, encoding, token_count, status):
+        cursor.execute(
+            'UPDATE messages SET content = ?, content_encoding = ?, token_count = ?, status = ? WHERE id = ?',
+            (stored, encoding, token_count, status, message.id)
+        )
+        cursor.execute('DELETE FROM message_parts WHERE message_id = ?', (message.id,))
+        cursor.execute('UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (message.chat_id,))
+        return message.id
     
     def delete_chat(self, chat_id):
         """Delete a chat and all its messages"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-            conn.commit()
+            # Explicit delete so databases created by simple_app (no ON DELETE CASCADE)
+            # do not trip the foreign key check
+            for schema in self._schemas():
+                cursor.execute(f'DELETE FROM {schema}.messages WHERE chat_id = ?', (chat_id,))
+                cursor.execute(f'DELETE FROM {schema}.chats WHERE id = ?', (chat_id,))
+        self.history_cache.invalidate(chat_id)
+    
+    def archive_idle_chats(self, idle_days=chat_archive.ARCHIVE_IDLE_DAYS):
+        """Move chats idle for more than idle_days to the archive database; returns their ids"""
+        if not self.archive_path:
+            raise RuntimeError('No archive database configured')
+        moved = chat_archive.archive_idle_chats(self.pool.get(), idle_days)
+        for chat_id in moved:
+            self.history_cache.invalidate(chat_id)
+        return moved
+    
+    def compress_existing(self, batch_size=COMPRESS_BATCH_SIZE, pause=COMPRESS_BATCH_PAUSE, stop_event=None):
+        """Compress stored bodies written before compression existed; returns rows compressed
+        
+        Works in short transactions of batch_size rows, pausing between them
+        so that live writes are not held up. Safe to interrupt and re-run.
+        """
+        compressed = 0
+        last_id = 0
+        conn = self.pool.get()
+        while stop_event is None or not stop_event.is_set():
+            rows = conn.execute('''
+                SELECT id, content FROM messages
+                WHERE id > ? AND content_encoding IS NULL AND length(CAST(content AS BLOB)) >= ?
+                  AND status IS NOT 'streaming'
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, COMPRESS_MIN_BYTES, batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for message_id, content in rows:
+                stored, encoding = encode_content(content)
+                if encoding is not None:
+                    updates.append((stored, encoding, message_id))
+            with conn:
+                # The encoding check skips rows rewritten since they were read
+                conn.executemany(
+                    'UPDATE messages SET content = ?, content_encoding = ? WHERE id = ? AND content_encoding IS NULL',
+                    updates
+                )
+            compressed += len(updates)
+            time.sleep(pause)
+        return compressed
+    
+    def _compress_in_background(self):
+        try:
+            compressed = self.compress_existing(stop_event=self._compress_stop)
+            if compressed:
+                logger.info(f"Compressed {compressed} existing message bodies")
+        except Exception as e:
+            logger.error(f"Background compression stopped: {e}")
     
     def get_session_context(self, user_id):
         """Get saved session context for a user"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 'SELECT context FROM sessions WHERE user_id = ? ORDER BY updated_at DESC LIMIT 1',
@@ -173,7 +929,7 @@ class SessionManager:
         session_id = str(uuid.uuid4())
         context_json = json.dumps(context)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO sessions (id, user_id, context, updated_at)
@@ -184,29 +940,241 @@ class SessionManager:
                     CURRENT_TIMESTAMP
                 )
             ''', (user_id, session_id, user_id, context_json))
-            conn.commit()
     
     def clear_session_context(self, user_id):
         """Clear session context for a user"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-            conn.commit()
-    
-    def build_conversation_history(self, chat_id, limit=20):
-        """Build conversation history for Claude API"""
-        messages = self.get_chat_messages(chat_id)
-        
-        # Limit to recent messages to avoid token limits
-        if len(messages) > limit:
-            messages = messages[-limit:]
-        
-        # Format for Claude API
-        conversation = []
-        for msg in messages:
-            conversation.append({
-                'role': msg['role'],
-                'content': msg['content']
+    
+    def search_messages(self, user_id, query, limit=20, offset=0):
+        """Full-text search over a user's messages, best matches first
+        
+        Returns {'results': [...], 'next_offset': int or None}. Each result
+        has the message and chat ids, the chat title and an HTML-escaped
+        snippet with the matches wrapped in <mark>.
+        """
+        terms = query.split()
+        # The trigram index needs at least 3 characters per term; shorter
+        # terms (common in Japanese, e.g. 天気) are matched with LIKE
+        long_terms = [term for term in terms if len(term) >= 3] if self.has_search_index else []
+        short_terms = [term for term in terms if term not in long_terms]
+        if not terms:
+            return {'results': [], 'next_offset': None}
+        
+        like_conditions = ' '.join(
+            "AND webai_inflate(m.content, m.content_encoding) LIKE ? ESCAPE '\\'" for _ in short_terms
+        )
+        like_params = ['%' + _escape_like(term) + '%' for term in short_terms]
+        
+        with self.pool.connection() as conn:
+            if long_terms:
+                match = ' '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+                # Rank only the newest SEARCH_RANK_WINDOW matches of each tier. The
+                # index hands out matches newest first, so a common word stops early
+                # instead of visiting every hit in the database. FTS5's bm25() is
+                # avoided on purpose: its IDF term counts all hits of every phrase
+                candidates = []
+                for schema in self._schemas():
+                    candidates += conn.execute(f'''
+                        SELECT m.id, m.content, m.content_encoding
+                        FROM {schema}.messages_fts f
+                        JOIN {schema}.messages m ON m.id = f.rowid
+                        JOIN {schema}.chats c ON c.id = m.chat_id
+                        WHERE f.messages_fts MATCH ? AND c.user_id = ? {like_conditions} {_hot_filter(schema)}
+                        ORDER BY f.rowid DESC
+                        LIMIT ?
+                    ''', [match, user_id, *like_params, SEARCH_RANK_WINDOW]).fetchall()
+                candidates = [(message_id, decode_content(stored, encoding))
+                              for message_id, stored, encoding in candidates]
+                average_length = sum(len(content) for _, content in candidates) / (len(candidates) or 1)
+                terms = [term.lower() for term in long_terms]
+                candidates.sort(key=lambda row: (-_match_score(row[1], terms, average_length), -row[0]))
+                ids = [message_id for message_id, _ in candidates[offset:offset + limit + 1]]
+                
+                placeholders = ','.join('?' * len(ids))
+                found = {}
+                for schema in self._schemas():
+                    found.update((row[0], row) for row in conn.execute(f'''
+                        SELECT m.id, m.chat_id, c.title, m.role, m.created_at
+                        FROM {schema}.messages m
+                        JOIN {schema}.chats c ON c.id = m.chat_id
+                        WHERE m.id IN ({placeholders}) {_hot_filter(schema)}
+                    ''', ids))
+                # A message deleted or archived since the candidate query is skipped
+                rows = [found[message_id] for message_id in ids[:limit] if message_id in found]
+                more = len(ids) > limit
+                
+                contents = dict(candidates)
+                snippets = {message_id: _make_snippet(contents[message_id], long_terms + short_terms)
+                            for message_id in ids}
+            else:
+                # Short terms only: scan the user's messages newest first
+                scans = ' UNION ALL '.join(f'''
+                    SELECT m.id, m.chat_id, c.title, m.role, m.created_at, m.content, m.content_encoding
+                    FROM {schema}.chats c
+                    JOIN {schema}.messages m ON m.chat_id = c.id
+                    WHERE c.user_id = ? {like_conditions} {_hot_filter(schema)}
+                ''' for schema in self._schemas())
+                rows = conn.execute(f'''
+                    {scans}
+                    ORDER BY 1 DESC
+                    LIMIT ? OFFSET ?
+                ''', [*([user_id, *like_params] * len(self._schemas())), limit + 1, offset]).fetchall()
+                more = len(rows) > limit
+                snippets = {row[0]: _make_snippet(decode_content(row[5], row[6]), short_terms) for row in rows[:limit]}
+        
+        results = []
+        for row in rows[:limit]:
+            results.append({
+                'message_id': row[0],
+                'chat_id': row[1],
+                'chat_title': row[2],
+                'role': row[3],
+                'created_at': row[4],
+                'snippet': snippets.get(row[0], '')
             })
         
-        return conversation
\ No newline at end of file
+        return {
+            'results': results,
+            'next_offset': offset + limit if more else None
+        }
+    
+    def build_conversation_history(self, chat_id, limit=20, before_id=None, max_tokens=None, pin_first=False):
+        """Build conversation history for Claude API
+        
+        Returns the last `limit` turns before before_id or, with max_tokens,
+        the newest turns whose estimated tokens fit the budget. pin_first
+        keeps the chat's first turn at the front of the window.
+        """
+        return [
+            {'role': turn[1], 'content': turn[2]}
+            for turn in self._history_window(chat_id, limit, before_id, max_tokens, pin_first)
+        ]
+    
+    def build_history_text(self, chat_id, limit=20, before_id=None, max_tokens=None, pin_first=False):
+        """Same window as build_conversation_history, rendered for the prompt"""
+        entry = self._recent_turns(chat_id)
+        # Keyed by message count so text rendered before an append is never reused
+        key = (entry.message_count, limit, before_id, max_tokens, pin_first)
+        text = entry.rendered.get(key)
+        if text is None:
+            turns = self._history_window(chat_id, limit, before_id, max_tokens, pin_first, entry)
+            text = ''.join(turn[3] for turn in turns)
+            entry.rendered[key] = text
+        return text
+    
+    def _recent_turns(self, chat_id):
+        """Cached tail of a chat, loaded with one indexed ORDER BY id DESC LIMIT on a miss"""
+        with self.pool.connection() as conn:
+            # One read transaction, so the count and the rows agree
+            conn.execute('BEGIN')
+            schema = self._chat_schema(conn, chat_id)
+            row = conn.execute(f'SELECT message_count FROM {schema}.chats WHERE id = ?', (chat_id,)).fetchone()
+            message_count = row[0] if row else 0
+            entry = self.history_cache.get(chat_id, message_count)
+            if entry is None:
+                token = self.history_cache.begin_load(chat_id)
+                rows = conn.execute(
+                    f'SELECT id, role, content, content_encoding, token_count FROM {schema}.messages '
+                    'WHERE chat_id = ? ORDER BY id DESC LIMIT ?',
+                    (chat_id, self.history_cache.max_turns)
+                ).fetchall()
+                rows.reverse()
+                entry = self.history_cache.store(chat_id, token, message_count, [
+                    (message_id, role, decode_content(stored, encoding), token_count)
+                    for message_id, role, stored, encoding, token_count in rows
+                ])
+        return entry
+    
+    def _history_window(self, chat_id, limit=20, before_id=None, max_tokens=None, pin_first=False, entry=None):
+        """Pick the history window as turn tuples, oldest first
+        
+        Walks back from the newest turn and stops as soon as the window is
+        full, so the cost depends on the window, not on the chat's length.
+        """
+        if entry is None:
+            entry = self._recent_turns(chat_id)
+        first = self._first_turn(chat_id, entry) if pin_first else None
+        if first is not None and before_id is not None and first[0] >= before_id:
+            first = None
+        budget = max_tokens
+        if first is not None and budget is not None:
+            if first[4] > budget:
+                first = None
+            else:
+                budget -= first[4]
+        
+        window = []
+        for turn in self._turns_before(chat_id, before_id, entry):
+            if first is not None and turn[0] <= first[0]:
+                break
+            if max_tokens is None:
+                if len(window) + (first is not None) >= limit:
+                    break
+            else:
+                # A turn larger than the whole budget (a pasted file) could never
+                # fit, so skip it; otherwise stop at the first turn that does not
+                if turn[4] > max_tokens:
+                    continue
+                if turn[4] > budget:
+                    break
+                budget -= turn[4]
+            window.append(turn)
+        
+        if first is not None:
+            window.append(first)
+        window.reverse()
+        return window
+    
+    def _turns_before(self, chat_id, before_id, entry):
+        """Yield turns older than before_id, newest first: cached tail, then SQL pages"""
+        turns = list(entry.turns)
+        end = len(turns)
+        if before_id is not None:
+            while end and turns[end - 1][0] >= before_id:
+                end -= 1
+        for turn in reversed(turns[:end]):
+            yield turn
+        if len(turns) == entry.message_count:
+            return
+        
+        # The window reaches past the cached tail
+        upper_id = turns[0][0] if end else before_id
+        conn = self.pool.get()
+        schema = self._chat_schema(conn, chat_id)
+        while True:
+            conditions = ['chat_id = ?']
+            params = [chat_id]
+            if upper_id is not None:
+                conditions.append('id < ?')
+                params.append(upper_id)
+            params.append(self.history_cache.max_turns)
+            rows = conn.execute(f'''
+                SELECT id, role, content, content_encoding, token_count FROM {schema}.messages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY id DESC
+                LIMIT ?
+            ''', params).fetchall()
+            for message_id, role, stored, encoding, token_count in rows:
+                yield make_turn(message_id, role, decode_content(stored, encoding), token_count)
+            if len(rows) < self.history_cache.max_turns:
+                return
+            upper_id = rows[-1][0]
+    
+    def _first_turn(self, chat_id, entry):
+        """The chat's first turn, for pinning; one indexed lookup per cached chat"""
+        if entry.turns and len(entry.turns) == entry.message_count:
+            return entry.turns[0]
+        if entry.first is None:
+            conn = self.pool.get()
+            row = conn.execute(
+                f'SELECT id, role, content, content_encoding, token_count '
+                f'FROM {self._chat_schema(conn, chat_id)}.messages '
+                'WHERE chat_id = ? ORDER BY id LIMIT 1',
+                (chat_id,)
+            ).fetchone()
+            if row is not None:
+                message_id, role, stored, encoding, token_count = row
+                entry.first = make_turn(message_id, role, decode_content(stored, encoding), token_count)
+        return entry.first
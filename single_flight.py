@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical in-flight requests
+The first request for a key runs the CLI; identical requests arriving while it runs
+subscribe to its output (replaying what was already produced) instead of starting another run
+"""
+import hashlib
+import threading
+
+
+def flight_key(*parts):
+    """Key of a request: model, the full prompt sent to the CLI, ..."""
+    return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class Flight:
+    """Output of one upstream run, shared by every request that joined it"""
+
+    def __init__(self, group, key):
+        self.key = key
+        self.handle = None       # Whatever start() returned (job, thread, ...)
+        self.chunks = []
+        self.result = None
+        self.error = None        # Exception (or message) the run failed with
+        self.done = False
+        self.cancelled = False   # Every subscriber left before the run finished
+        self.worker = None       # CLI worker the producer holds, for cancellation
+        self.subscribers = 1
+        self._group = group
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        """End the run; later requests for the key start a new one"""
+        self._group._remove(self)
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def subscribe(self, heartbeat=None):
+        """Yield every chunk from the first, blocking for new ones until the run finishes
+
+        With heartbeat, None is yielded after that many idle seconds, so a
+        streaming response can write something and notice a closed client.
+        """
+        index = 0
+        while True:
+            with self._cond:
+                if index >= len(self.chunks) and not self.done:
+                    self._cond.wait_for(lambda: index < len(self.chunks) or self.done, heartbeat)
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self.chunks):
+                return
+            if not chunks:
+                yield None
+
+    def follow(self, future):
+        """Finish when a concurrent.futures.Future (e.g. a scheduler job) completes"""
+        def done(future):
+            if future.cancelled():
+                self.finish(error=RuntimeError('Request was cancelled'))
+            elif future.exception() is not None:
+                self.finish(error=future.exception())
+            else:
+                self.finish(result=future.result())
+        future.add_done_callback(done)
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+
+class SingleFlight:
+    def __init__(self):
+        # Reentrant: a run that finishes inside start() removes itself under the same lock
+        self._lock = threading.RLock()
+        self._flights = {}
+        self.stats = {'runs': 0, 'coalesced': 0}
+
+    def join(self, key, start):
+        """The in-flight run for key, or a new one started with start(flight)
+
+        Returns (flight, leader). start runs under the lock, so it must only
+        hand the work off (submit a job, start a thread); if it raises,
+        nothing is registered and the exception propagates.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                with flight._cond:
+                    flight.subscribers += 1
+                self.stats['coalesced'] += 1
+                return flight, False
+            flight = Flight(self, key)
+            flight.handle = start(flight)
+            if not flight.done:
+                self._flights[key] = flight
+            self.stats['runs'] += 1
+        return flight, True
+
+    def leave(self, flight, cancel=None):
+        """Drop a subscriber (client gone or done); returns how many are left
+
+        When the last one leaves an unfinished run, the flight is marked
+        cancelled and unregistered before anyone else can join it, and
+        cancel() is called to stop the work (withdraw the job, kill the CLI).
+        """
+        with self._lock:
+            with flight._cond:
+                flight.subscribers -= 1
+                remaining = flight.subscribers
+            if remaining == 0 and not flight.done:
+                flight.cancelled = True
+                self._remove(flight)
+                if cancel is not None:
+                    cancel()
+            return remaining
+
+    def _remove(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def snapshot(self):
+        """Upstream runs started and saved by coalescing, for monitoring"""
+        with self._lock:
+            return {'in_flight': len(self._flights), 'runs_saved': self.stats['coalesced'],
+                    'stats': dict(self.stats)}
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Parser for `claude --print --output-format stream-json --verbose` output
+Turns each line into events: answer text (whole content blocks or, with
+--include-partial-messages, deltas), thinking, tool use and results, the final result
+with usage, and errors. Text is never reported twice when the CLI sends both the
+deltas and the complete message
+"""
+import json
+from collections import namedtuple
+
+# kind: 'system', 'text', 'thinking', 'tool_use', 'tool_result', 'result' or 'error'.
+# A 'text' event's data is the text_delta when it continues the text before it (a later
+# delta of the same content block), None when it starts a block or is a whole block
+StreamEvent = namedtuple('StreamEvent', 'kind text data')
+
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+
+
+def _content_text(content):
+    """Text of a tool_result content field: a string or a list of blocks"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+    return ''
+
+
+class StreamJsonParser:
+    """Feed stream-json lines in order; one parser per CLI run
+
+    After the run, text is the whole answer, usage the token counts, result the
+    final result event (None if the CLI died before sending it) and error the
+    first error reported.
+    """
+
+    def __init__(self):
+        self.session_id = None
+        self.model = None
+        self.texts = []          # Answer text per content block
+        self.tools = []          # tool_use blocks: {'id', 'name', 'input'}
+        self.usage = {}
+        self.result = None
+        self.error = None
+        self._streamed = set()   # Message ids whose text arrived as deltas
+        self._message_id = None  # Message being streamed as deltas
+        self._blocks = {}        # Content block index -> partial block (tool input JSON)
+        self._text_blocks = set()  # Content block indexes of the message that have had text deltas
+
+    @property
+    def text(self):
+        """The whole answer: blocks joined with newlines, as clients of the stream join them"""
+        return '\n'.join(self.texts)
+
+    def feed(self, line):
+        """Events for one line of output; lines that are not JSON count as answer text"""
+        line = line.strip()
+        if not line:
+            return []
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            return self._text(line)
+        if not isinstance(event, dict):
+            return self._text(line)
+        handler = getattr(self, '_on_' + str(event.get('type')), None)
+        return handler(event) if handler is not None else []
+
+    def _text(self, text, delta=None):
+        if not text:
+            return []
+        if delta is not None and self.texts:
+            self.texts[-1] += text
+        else:
+            self.texts.append(text)
+        return [StreamEvent('text', text, delta)]
+
+    def _error(self, message, data):
+        if self.error is None:
+            self.error = message
+        return [StreamEvent('error', message, data)]
+
+    def _add_usage(self, usage):
+        for field in USAGE_FIELDS:
+            if isinstance(usage.get(field), int):
+                self.usage[field] = self.usage.get(field, 0) + usage[field]
+
+    def _on_system(self, event):
+        if event.get('subtype') == 'init':
+            self.session_id = event.get('session_id')
+            self.model = event.get('model')
+        return [StreamEvent('system', '', event)]
+
+    def _on_assistant(self, event):
+        """A complete assistant message (or one content block of it)"""
+        message = event.get('message') or {}
+        streamed = message.get('id') is not None and message.get('id') in self._streamed
+        events = []
+        for block in message.get('content') or []:
+            kind = block.get('type')
+            if kind == 'text' and not streamed:
+                events += self._text(block.get('text', ''))
+            elif kind == 'thinking' and not streamed:
+                events.append(StreamEvent('thinking', block.get('thinking', ''), block))
+            elif kind == 'tool_use' and not streamed:
+                events += self._tool_use(block)
+        return events
+
+    def _tool_use(self, block):
+        tool = {'id': block.get('id'), 'name': block.get('name'), 'input': block.get('input') or {}}
+        self.tools.append(tool)
+        return [StreamEvent('tool_use', tool['name'] or '', tool)]
+
+    def _on_user(self, event):
+        """Tool results the CLI feeds back to the model"""
+        events = []
+        content = (event.get('message') or {}).get('content')
+        for block in content if isinstance(content, list) else []:
+            if block.get('type') == 'tool_result':
+                events.append(StreamEvent('tool_result', _content_text(block.get('content')), block))
+        return events
+
+    def _on_stream_event(self, event):
+        """Raw API streaming events (--include-partial-messages)"""
+        inner = event.get('event') or {}
+        kind = inner.get('type')
+        if kind == 'message_start':
+            message = inner.get('message') or {}
+            self._message_id = message.get('id')
+            self._blocks = {}
+            self._text_blocks = set()
+            self._add_usage(message.get('usage') or {})
+        elif kind == 'content_block_start':
+            block = dict(inner.get('content_block') or {})
+            if block.get('type') == 'tool_use':
+                block['partial_json'] = ''
+            self._blocks[inner.get('index')] = block
+        elif kind == 'content_block_delta':
+            delta = inner.get('delta') or {}
+            if self._message_id is not None:
+                self._streamed.add(self._message_id)
+            if delta.get('type') == 'text_delta':
+                index = inner.get('index')
+                continues = index in self._text_blocks
+                if delta.get('text'):
+                    self._text_blocks.add(index)
+                return self._text(delta.get('text', ''), delta if continues else None)
+            if delta.get('type') == 'thinking_delta':
+                return [StreamEvent('thinking', delta.get('thinking', ''), delta)]
+            if delta.get('type') == 'input_json_delta':
+                block = self._blocks.get(inner.get('index'))
+                if block is not None and 'partial_json' in block:
+                    block['partial_json'] += delta.get('partial_json', '')
+        elif kind == 'content_block_stop':
+            block = self._blocks.pop(inner.get('index'), None)
+            if block is not None and block.get('type') == 'tool_use':
+                try:
+                    block['input'] = json.loads(block.pop('partial_json') or '{}')
+                except json.JSONDecodeError:
+                    block['input'] = {}
+                return self._tool_use(block)
+        elif kind == 'message_delta':
+            # Output tokens of the message, sent once at its end; message_start carried the input side
+            usage = inner.get('usage') or {}
+            if isinstance(usage.get('output_tokens'), int):
+                self.usage['output_tokens'] = self.usage.get('output_tokens', 0) + usage['output_tokens']
+        elif kind == 'error':
+            error = inner.get('error') or {}
+            return self._error(error.get('message') or str(error), inner)
+        return []
+
+    def _on_result(self, event):
+        """Last line of a run: final text, usage, cost; is_error for failed runs"""
+        self.result = event
+        if event.get('usage'):
+            # Totals for the whole run replace what the partial events added up
+            self.usage = {field: event['usage'][field] for field in USAGE_FIELDS
+                          if isinstance(event['usage'].get(field), int)}
+        if event.get('is_error') or (event.get('subtype') or 'success') != 'success':
+            return self._error(event.get('result') or event.get('error') or event.get('subtype') or 'Unknown error',
+                               event)
+        events = []
+        if not self.texts and event.get('result'):
+            # Nothing streamed (e.g. an answer only in the result): the result is the answer
+            events += self._text(event['result'])
+        events.append(StreamEvent('result', event.get('result') or '', event))
+        return events
+
+    def _on_text(self, event):
+        """Bare {"type": "text"} events (older wrappers)"""
+        return self._text(event.get('text', ''))
+
+    def _on_error(self, event):
+        error = event.get('error', 'Unknown error')
+        if isinstance(error, dict):
+            error = error.get('message') or str(error)
+        return self._error(error, event)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Token estimates and per-model history budgets for WebAI
+"""
+import os
+
+ASCII_CHARS_PER_TOKEN = 4  # English and code; other characters count one token each
+MESSAGE_OVERHEAD_TOKENS = 4  # Role label and separators around every turn
+
+# Tokens of conversation history sent with each prompt, per model family.
+# Override with WEBAI_HISTORY_TOKENS_OPUS / _SONNET / _HAIKU (read per call, after .env loads)
+HISTORY_TOKEN_BUDGETS = {
+    'opus': 32000,
+    'sonnet': 32000,
+    'haiku': 16000,
+}
+DEFAULT_HISTORY_TOKENS = 16000  # Unknown models; WEBAI_HISTORY_TOKENS
+
+
+def estimate_tokens(text):
+    """Cheap upper-leaning token estimate; no tokenizer needed
+
+    Japanese text runs close to one token per character, ASCII about four
+    characters per token.
+    """
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    other_chars = len(text) - ascii_chars
+    return other_chars + -(-ascii_chars // ASCII_CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_budget(model):
+    """History token budget for a model name such as 'opus' or 'claude-sonnet-4'"""
+    model = (model or '').lower()
+    for family, budget in HISTORY_TOKEN_BUDGETS.items():
+        if family in model:
+            return int(os.environ.get(f'WEBAI_HISTORY_TOKENS_{family.upper()}', budget))
+    return int(os.environ.get('WEBAI_HISTORY_TOKENS', DEFAULT_HISTORY_TOKENS))
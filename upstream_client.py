@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Pooled keep-alive HTTP client for calls to the Claude host APIs
+One requests.Session per app with a bounded connection pool per host, instead of a new TCP
+connection for every message; counts new and reused connections for the status endpoints
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+UPSTREAM_POOL_SIZE = int(os.environ.get('WEBAI_UPSTREAM_POOL_SIZE', '10'))  # Idle connections kept per host
+# With WEBAI_UPSTREAM_POOL_BLOCK=1 requests wait for a pooled connection instead of opening an
+# extra, unpooled one; streamed answers hold theirs for minutes, so this is off by default
+UPSTREAM_POOL_BLOCK = os.environ.get('WEBAI_UPSTREAM_POOL_BLOCK', '0') == '1'
+UPSTREAM_HOSTS = 4           # Host pools kept (host API, session API, ...)
+
+
+class UpstreamClient:
+    """Shared requests.Session for the upstream APIs
+
+    The session is built on first use, so in an eventlet app it comes after monkey_patch()
+    and its sockets, pool queue and locks are green. A Session is safe to share between
+    threads and greenlets here: each request checks its own connection out of the pool.
+    """
+
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE, block=UPSTREAM_POOL_BLOCK):
+        self.pool_size = pool_size
+        self.block = block
+        self._session = None
+        self._adapter = None
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'released': 0, 'closed': 0}
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._adapter = HTTPAdapter(pool_connections=UPSTREAM_HOSTS, pool_maxsize=self.pool_size,
+                                            pool_block=self.block)
+                self._session = requests.Session()
+                self._session.mount('http://', self._adapter)
+                self._session.mount('https://', self._adapter)
+            return self._session
+
+    def request(self, method, url, **kwargs):
+        session = self.session
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._count('errors')
+            raise
+        finally:
+            self._count('requests')
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def release(self, response, reuse=True):
+        """Done with a streamed response (stream=True)
+
+        With reuse, the rest of the body is read and the connection goes back to the pool;
+        otherwise it is closed, which is how the host API learns that the client gave up.
+        """
+        if reuse:
+            try:
+                response.raw.drain_conn()
+                response.raw.release_conn()
+                self._count('released')
+                return
+            except Exception:
+                pass
+        response.close()
+        self._count('closed')
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def snapshot(self):
+        """Pool settings and connection reuse, for status endpoints"""
+        pools = []
+        if self._adapter is not None:
+            manager = self._adapter.poolmanager
+            for key in manager.pools.keys():
+                try:
+                    pool = manager.pools[key]
+                except KeyError:
+                    continue  # Evicted meanwhile
+                pools.append({
+                    'host': f'{pool.host}:{pool.port}',
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': pool.pool.qsize() if pool.pool is not None else 0
+                })
+        connections = sum(pool['connections'] for pool in pools)
+        requests_sent = sum(pool['requests'] for pool in pools)
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            'pool_size': self.pool_size,
+            'block': self.block,
+            **stats,
+            'connections': connections,
+            'reused': requests_sent - connections,
+            'reuse_ratio': round(1 - connections / requests_sent, 3) if requests_sent else None,
+            'pools': pools
+        }
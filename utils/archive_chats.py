@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Move idle chats from the hot database to the archive database
+Usage: archive_chats.py [--db webai.db] [--archive webai-archive.db] [--idle-days 90] [--vacuum]
+Run from cron or the webai-archive.timer unit; safe to run while the app is up
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chat_archive import ARCHIVE_IDLE_DAYS
+from session_manager import SessionManager
+
+DEFAULT_ARCHIVE = 'webai-archive.db'
+
+
+def file_size(path):
+    """Database size including its WAL file, in MB"""
+    total = 0
+    for suffix in ('', '-wal'):
+        if os.path.exists(path + suffix):
+            total += os.path.getsize(path + suffix)
+    return total / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move idle chats to the archive database')
+    parser.add_argument('--db', default='webai.db', help='hot database')
+    parser.add_argument('--archive', default=os.environ.get('WEBAI_ARCHIVE_DB', DEFAULT_ARCHIVE),
+                        help='archive database (default: $WEBAI_ARCHIVE_DB or %(default)s)')
+    parser.add_argument('--idle-days', type=int, default=ARCHIVE_IDLE_DAYS,
+                        help='archive chats not updated for this many days')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='VACUUM the hot database afterwards to return freed pages to the OS')
+    args = parser.parse_args()
+
+    manager = SessionManager(args.db, compress_existing=False, archive_path=args.archive)
+    hot_before = file_size(args.db)
+
+    print(f"Archiving chats idle for {args.idle_days}+ days: {args.db} -> {args.archive}")
+    print("=" * 80)
+    start_time = time.time()
+    moved = manager.archive_idle_chats(args.idle_days)
+    print(f"Moved {len(moved)} chats in {time.time() - start_time:.1f}s")
+
+    conn = manager.pool.get()
+    if args.vacuum:
+        if manager.has_search_index:
+            # Merge the index segments so deleted rows' postings are dropped too
+            with conn:
+                conn.execute("INSERT INTO main.messages_fts (messages_fts) VALUES ('optimize')")
+        conn.execute('VACUUM main')
+    conn.execute('PRAGMA main.wal_checkpoint(TRUNCATE)')
+    conn.execute('PRAGMA archive.wal_checkpoint(TRUNCATE)')
+
+    for schema in ('main', 'archive'):
+        chats, messages = conn.execute(
+            f'SELECT (SELECT COUNT(*) FROM {schema}.chats), (SELECT COUNT(*) FROM {schema}.messages)'
+        ).fetchone()
+        print(f"{schema:8s} {chats:8d} chats {messages:10d} messages")
+    print(f"Hot database: {hot_before:.1f} MB -> {file_size(args.db):.1f} MB"
+          f"{'' if args.vacuum else ' (free pages are reused; --vacuum to shrink the file)'}")
+    manager.pool.close()
+
+
+if __name__ == "__main__":
+    main()
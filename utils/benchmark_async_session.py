@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Event-loop responsiveness while loading history: blocking SessionManager vs AsyncSessionManager
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+from async_session_manager import AsyncSessionManager
+
+# Configuration
+NUM_CHATS = 20
+MESSAGES_PER_CHAT = 500
+CONCURRENT_LOADS = 400  # History loads issued at once (several per chat)
+TICK_INTERVAL = 0.005   # Heartbeat coroutine period
+
+
+async def heartbeat(stop, lags):
+    """Record how late each tick fires; a blocked loop shows up as large lag"""
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK_INTERVAL
+        await asyncio.sleep(TICK_INTERVAL)
+        lags.append(time.perf_counter() - expected)
+
+
+async def run_loads(load):
+    stop = asyncio.Event()
+    lags = []
+    ticker = asyncio.ensure_future(heartbeat(stop, lags))
+    await asyncio.sleep(TICK_INTERVAL * 2)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[load(i % NUM_CHATS + 1) for i in range(CONCURRENT_LOADS)])
+    elapsed = time.perf_counter() - start_time
+
+    stop.set()
+    await ticker
+    return elapsed, max(lags) * 1000
+
+
+async def main():
+    print(f"Async history benchmark: {CONCURRENT_LOADS} loads over {NUM_CHATS} chats "
+          f"x {MESSAGES_PER_CHAT} messages")
+    print("=" * 80)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manager = SessionManager(os.path.join(tmp_dir, 'bench.db'))
+        for chat in range(NUM_CHATS):
+            chat_id = manager.create_chat('bench-user', f'bench {chat}')
+            for i in range(MESSAGES_PER_CHAT):
+                manager.add_message(chat_id, 'user' if i % 2 == 0 else 'assistant', f'message {i} ' + 'x' * 300)
+
+        async def blocking_load(chat_id):
+            return manager.get_chat_messages(chat_id)
+
+        async_manager = AsyncSessionManager(manager=manager)
+
+        elapsed, lag = await run_loads(blocking_load)
+        print(f"{'blocking SessionManager':28s} {elapsed:7.2f}s total, max loop stall {lag:8.1f} ms")
+        elapsed, lag = await run_loads(async_manager.get_chat_messages)
+        print(f"{'AsyncSessionManager':28s} {elapsed:7.2f}s total, max loop stall {lag:8.1f} ms")
+        print(f"\nReads: {async_manager.stats['reads']}, "
+              f"served by a shared query: {async_manager.stats['coalesced']}")
+
+        await async_manager.close()
+        manager.pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
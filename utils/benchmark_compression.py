@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Size and read-latency impact of message body compression
+The corpus is built from this repository's own docs and sources: short questions,
+long answers and pasted files
+"""
+
+import glob
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import content_codec
+from session_manager import SessionManager
+
+# Configuration
+NUM_CHATS = 300
+TURNS_PER_CHAT = 40
+READ_ROUNDS = 3
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+QUESTIONS = ['このエラーの原因を教えてください', 'nginxの設定を見直してください', 'テストを追加できますか？',
+             'この関数をリファクタリングしてください', 'Dockerfileの最適化方法は？', '今日の天気は？']
+
+
+def load_corpus():
+    """Text files from the repository, used as long answers and pasted uploads"""
+    texts = []
+    for pattern in ('**/*.md', '**/*.py', '**/*.html', '**/*.js', '**/*.conf', '**/*.txt'):
+        for path in glob.glob(os.path.join(REPO_ROOT, pattern), recursive=True):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    text = f.read()
+            except (UnicodeDecodeError, OSError):
+                continue
+            if text.strip():
+                texts.append(text)
+    return texts
+
+
+def fill(manager, corpus):
+    rng = random.Random(1)
+    for chat in range(NUM_CHATS):
+        chat_id = manager.create_chat('bench-user', f'bench {chat}')
+        for turn in range(TURNS_PER_CHAT):
+            if turn % 2 == 0:
+                # Mostly short questions, sometimes with a pasted file
+                content = rng.choice(QUESTIONS)
+                if rng.random() < 0.15:
+                    content += '\n\n' + rng.choice(corpus)
+                manager.add_message(chat_id, 'user', content)
+            else:
+                text = rng.choice(corpus)
+                start = rng.randint(0, max(0, len(text) - 200))
+                manager.add_message(chat_id, 'assistant', text[start:start + rng.randint(200, 6000)])
+
+
+def measure_reads(manager):
+    """Cold history loads (cache cleared) and full message loads, ms per chat"""
+    chat_ids = range(1, NUM_CHATS + 1)
+    history_times = []
+    full_times = []
+    for _ in range(READ_ROUNDS):
+        for chat_id in chat_ids:
+            manager.history_cache.invalidate(chat_id)
+            start_time = time.perf_counter()
+            manager.build_history_text(chat_id, limit=20)
+            history_times.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            manager.get_chat_messages(chat_id)
+            full_times.append(time.perf_counter() - start_time)
+    return (sum(history_times) / len(history_times) * 1000,
+            sum(full_times) / len(full_times) * 1000)
+
+
+def main():
+    corpus = load_corpus()
+    print(f"Compression benchmark: {NUM_CHATS} chats x {TURNS_PER_CHAT} turns, "
+          f"corpus of {len(corpus)} repository files")
+    print("=" * 80)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, threshold in (('plain', sys.maxsize), ('compressed', content_codec.COMPRESS_MIN_BYTES)):
+            content_codec.COMPRESS_MIN_BYTES = threshold
+            db_path = os.path.join(tmp_dir, f'{name}.db')
+            manager = SessionManager(db_path, compress_existing=False)
+            fill(manager, corpus)
+            with manager.pool.connection() as conn:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            manager.pool.get().execute('VACUUM')
+            size = os.path.getsize(db_path)
+            conn = manager.pool.get()
+            compressed_rows = conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE content_encoding IS NOT NULL'
+            ).fetchone()[0]
+            messages_size = conn.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name = 'messages'"
+            ).fetchone()[0]
+            history_ms, full_ms = measure_reads(manager)
+            results[name] = (size, messages_size, history_ms, full_ms, compressed_rows)
+            manager.pool.close()
+
+    for name, (size, messages_size, history_ms, full_ms, compressed_rows) in results.items():
+        print(f"{name:12s} file {size / 1024 / 1024:6.1f} MB  messages {messages_size / 1024 / 1024:6.1f} MB  "
+              f"history (cold) {history_ms:6.3f} ms  full chat {full_ms:6.3f} ms  {compressed_rows} compressed")
+
+    plain, packed = results['plain'], results['compressed']
+    print(f"\nmessages table: {(1 - packed[1] / plain[1]) * 100:.1f}% smaller; "
+          f"whole file (incl. search index): {(1 - packed[0] / plain[0]) * 100:.1f}% smaller")
+    print(f"Read latency: cold history {packed[2] / plain[2]:.2f}x, full chat {packed[3] / plain[3]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
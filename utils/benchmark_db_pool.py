@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the SessionManager connection layer
+Compares connect-per-call rollback-journal access with the pooled WAL connections
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+
+# Configuration
+NUM_WRITERS = 16  # Concurrent writer threads
+OPS_PER_WRITER = 200  # add_message calls per thread (plus a history read every 20)
+
+
+class LegacyPool:
+    """Connection layer as it was before pooling: a fresh rollback-journal connection per call"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    @contextmanager
+    def connection(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+def run_writers(manager):
+    """Run NUM_WRITERS threads against one manager and return ops/sec"""
+    chat_ids = [manager.create_chat(f'bench-user-{i}', 'bench') for i in range(NUM_WRITERS)]
+    errors = []
+    barrier = threading.Barrier(NUM_WRITERS + 1)
+
+    def writer(chat_id):
+        barrier.wait()
+        try:
+            for i in range(OPS_PER_WRITER):
+                manager.add_message(chat_id, 'user' if i % 2 == 0 else 'assistant', f'message {i} ' + 'x' * 200)
+                if i % 20 == 0:
+                    manager.get_chat_messages(chat_id)
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=writer, args=(chat_id,)) for chat_id in chat_ids]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start_time = time.time()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+
+    total_ops = NUM_WRITERS * OPS_PER_WRITER
+    return total_ops / elapsed, elapsed, errors
+
+
+def main():
+    print(f"SessionManager connection benchmark: {NUM_WRITERS} writers x {OPS_PER_WRITER} ops")
+    print("=" * 80)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Legacy: build the schema, then force the old rollback journal
+        legacy = SessionManager(os.path.join(tmp_dir, 'legacy.db'))
+        legacy.pool.close()
+        legacy.pool = LegacyPool(legacy.db_path)
+        with legacy.pool.connection() as conn:
+            conn.execute('PRAGMA journal_mode=DELETE')
+        results['before (connect per call)'] = run_writers(legacy)
+
+        pooled = SessionManager(os.path.join(tmp_dir, 'pooled.db'))
+        results['after (pooled WAL)'] = run_writers(pooled)
+        pooled.pool.close()
+
+    for name, (ops_per_sec, elapsed, errors) in results.items():
+        print(f"{name:28s} {ops_per_sec:10.1f} ops/sec  ({elapsed:.2f}s, {len(errors)} errors)")
+        for error in errors[:3]:
+            print(f"    error: {error}")
+
+    before = results['before (connect per call)'][0]
+    after = results['after (pooled WAL)'][0]
+    print(f"\nSpeedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
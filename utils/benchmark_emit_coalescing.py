@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Frames sent for one streamed answer: an emit per CLI line vs EmitBuffer coalescing
+Lines arrive at a fixed pace, as from the CLI; each frame is JSON-encoded as Socket.IO would.
+Reports frames, frames per second and encoding CPU for both protocols
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream_utils import DeltaStream, EmitBuffer
+
+# Configuration
+LINES = 600
+LINE_INTERVAL = 0.002    # Seconds between CLI lines
+WINDOWS_MS = [0, 20, 40, 100]
+
+
+def make_lines():
+    return [f"行 {i + 1}: 検索結果の要約です" + ("。" if i % 20 == 19 else "、") for i in range(LINES)]
+
+
+def run(lines, window_ms, deltas):
+    """Stream the lines through an EmitBuffer; 0 ms sends a frame per line"""
+    stream = DeltaStream() if deltas else None
+    accumulated = []
+    encode_time = [0.0]
+
+    def send(text):
+        start = time.process_time()
+        if stream is not None:
+            json.dumps({'type': 'delta', **stream.delta(text)})
+        else:
+            json.dumps({'type': 'assistant', 'content': '\n'.join(accumulated)})
+        encode_time[0] += time.process_time() - start
+
+    buffer = EmitBuffer(send, interval=window_ms / 1000)
+    start_time = time.perf_counter()
+    for i, line in enumerate(lines):
+        accumulated.append(line)
+        buffer.add(line if i == 0 else '\n' + line)
+        time.sleep(LINE_INTERVAL)
+    buffer.close()
+    return buffer.stats(), encode_time[0], time.perf_counter() - start_time
+
+
+def main():
+    lines = make_lines()
+    print(f"{LINES} lines, one every {LINE_INTERVAL * 1000:.0f} ms")
+    print("=" * 80)
+    print(f"{'Protocol':10s} {'Window':>8s} {'Frames':>8s} {'Frames/s':>10s} {'Encode CPU':>12s} {'Wall':>8s}")
+    print("-" * 80)
+    for deltas in (False, True):
+        for window_ms in WINDOWS_MS:
+            stats, encode, wall = run(lines, window_ms, deltas)
+            print(f"{'v2 delta' if deltas else 'v1 full':10s} {window_ms:6d}ms {stats['frames']:8d} "
+                  f"{stats['fps']:10.1f} {encode * 1000:10.1f}ms {wall:7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
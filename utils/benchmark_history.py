@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Prompt history assembly cost versus chat length
+Old path: load every message, slice the last 20, concatenate. New path: build_history_text
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+
+# Configuration
+CHAT_LENGTHS = [20, 200, 2000, 20000]
+HISTORY_LIMIT = 20
+ITERATIONS = 200  # Each iteration appends a turn, then builds the history, like api_send
+MESSAGE_BODY = '会話履歴のベンチマーク用メッセージです。' * 8
+
+
+def legacy_history_text(manager, chat_id):
+    """api_send before the recent-turns cache"""
+    messages = manager.get_chat_messages(chat_id)
+    if len(messages) > HISTORY_LIMIT:
+        messages = messages[-HISTORY_LIMIT:]
+    history_text = ""
+    for msg in messages:
+        role = "ユーザー" if msg['role'] == 'user' else "アシスタント"
+        history_text += f"\n{role}: {msg['content']}\n"
+    return history_text
+
+
+def cached_history_text(manager, chat_id):
+    return manager.build_history_text(chat_id, limit=HISTORY_LIMIT)
+
+
+def time_per_turn(manager, chat_id, build):
+    start_time = time.perf_counter()
+    for i in range(ITERATIONS):
+        manager.add_message(chat_id, 'user' if i % 2 == 0 else 'assistant', MESSAGE_BODY)
+        build(manager, chat_id)
+    return (time.perf_counter() - start_time) / ITERATIONS * 1000
+
+
+def main():
+    print(f"History assembly benchmark: last {HISTORY_LIMIT} turns, {ITERATIONS} turns per run")
+    print("=" * 80)
+    print(f"{'messages':>10s} {'legacy ms/turn':>16s} {'cached ms/turn':>16s} {'speedup':>9s}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manager = SessionManager(os.path.join(tmp_dir, 'bench.db'))
+        for length in CHAT_LENGTHS:
+            results = []
+            for build in (legacy_history_text, cached_history_text):
+                chat_id = manager.create_chat('bench-user', f'bench {length}')
+                with manager.pool.connection() as conn:
+                    conn.executemany(
+                        'INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
+                        [(chat_id, 'user' if i % 2 == 0 else 'assistant', MESSAGE_BODY) for i in range(length)]
+                    )
+                assert legacy_history_text(manager, chat_id) == cached_history_text(manager, chat_id)
+                results.append(time_per_turn(manager, chat_id, build))
+            legacy, cached = results
+            print(f"{length:10d} {legacy:16.3f} {cached:16.3f} {legacy / cached:8.1f}x")
+
+        stats = manager.history_cache.stats
+        print(f"\nCache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+        manager.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Load test of the asyncio host API against the fake Claude CLI
+Runs N concurrent /message streams and compares them with running the same N CLI processes
+directly. Reports the server's own CPU time per stream, and samples its thread count and
+resident memory while the streams are open
+Usage: benchmark_host_api_async.py [concurrency ...]
+"""
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Configuration
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(UTILS_DIR, '..', 'claude-host-api', 'claude_host_api_async.py')
+FAKE_CLI = os.path.join(UTILS_DIR, 'fake_claude_cli.py')
+DEFAULT_LEVELS = [50, 100, 200]
+FAKE_ENV = {'FAKE_CLAUDE_STARTUP': '0.5', 'FAKE_CLAUDE_FIRST_TOKEN': '0.2',
+            'FAKE_CLAUDE_CHUNKS': '20', 'FAKE_CLAUDE_CHUNK': '0.05'}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    """User + system CPU time consumed by a process"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def proc_status(pid):
+    """(threads, RSS MB) of a process"""
+    threads = rss = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                threads = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+    return threads, rss
+
+
+async def direct_stream(env):
+    """The CLI alone: TTFB and total time of one stream without the server"""
+    start_time = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        FAKE_CLI, '--print', '--output-format', 'stream-json',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env)
+    process.stdin.write('ユーザーの質問: テスト'.encode('utf-8'))
+    process.stdin.close()
+    ttfb = None
+    async for line in process.stdout:
+        if ttfb is None and json.loads(line).get('type') == 'assistant':
+            ttfb = time.perf_counter() - start_time
+    await process.wait()
+    return ttfb, time.perf_counter() - start_time
+
+
+async def http_stream(port):
+    """One POST /message through the server: TTFB (first content chunk) and total time"""
+    start_time = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps({'content': 'テスト', 'model': 'claude-3-5-haiku-20241022'}).encode('utf-8')
+    writer.write(b'POST /message HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+    await writer.drain()
+    status = await reader.readline()
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    ttfb = None
+    while True:
+        size = int((await reader.readline()).strip() or b'0', 16)
+        if size == 0:
+            break
+        chunk = await reader.readexactly(size + 2)
+        if ttfb is None and b'"content"' in chunk:
+            ttfb = time.perf_counter() - start_time
+    writer.close()
+    await writer.wait_closed()
+    if b' 200 ' not in status:
+        raise RuntimeError(status.decode())
+    return ttfb, time.perf_counter() - start_time
+
+
+async def run_level(concurrency, make_stream, server_pid=None):
+    samples = []
+
+    async def sample():
+        while True:
+            samples.append(proc_status(server_pid))
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.ensure_future(sample()) if server_pid else None
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(make_stream() for _ in range(concurrency)))
+    wall = time.perf_counter() - start_time
+    if sampler:
+        sampler.cancel()
+    return results, wall, samples
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    levels = [int(arg) for arg in sys.argv[1:]] or DEFAULT_LEVELS
+    env = {**os.environ, **FAKE_ENV}
+    port = free_port()
+    home = tempfile.TemporaryDirectory()
+    server = subprocess.Popen(
+        [sys.executable, SERVER],
+        env={**env, 'PORT': str(port), 'CLAUDE_HOST_CLI': FAKE_CLI, 'CLAUDE_HOST_HOME': home.name,
+             'CLAUDE_HOST_MAX_STREAMS': str(max(levels)), 'WEBAI_RESPONSE_CACHE_MB': '0'},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        time.sleep(1)
+        idle_threads, idle_rss = proc_status(server.pid)
+
+        print(f"Async host API load test: fake CLI startup {FAKE_ENV['FAKE_CLAUDE_STARTUP']}s, "
+              f"{FAKE_ENV['FAKE_CLAUDE_CHUNKS']} chunks; server idle: {idle_threads} threads, {idle_rss:.0f} MB")
+        print("=" * 80)
+        print(f"{'streams':>8s} {'mode':8s} {'ttfb p50':>9s} {'ttfb p95':>9s} {'total p50':>10s} "
+              f"{'wall':>7s} {'threads':>8s} {'rss MB':>7s}")
+        for concurrency in levels:
+            direct, direct_wall, _ = asyncio.run(run_level(concurrency, lambda: direct_stream(env)))
+            cpu_before = cpu_seconds(server.pid)
+            served, served_wall, samples = asyncio.run(
+                run_level(concurrency, lambda: http_stream(port), server.pid))
+            server_cpu = cpu_seconds(server.pid) - cpu_before
+            for mode, results, wall, threads, rss in (
+                ('direct', direct, direct_wall, '-', '-'),
+                ('server', served, served_wall, max(s[0] for s in samples), f"{max(s[1] for s in samples):.0f}"),
+            ):
+                ttfbs = [r[0] for r in results]
+                print(f"{concurrency:8d} {mode:8s} {median(ttfbs) * 1000:8.0f}ms {percentile(ttfbs, 0.95) * 1000:8.0f}ms "
+                      f"{median([r[1] for r in results]) * 1000:9.0f}ms {wall:6.2f}s {threads:>8} {rss:>7}")
+            print(f"{'':8s} server CPU {server_cpu / concurrency * 1000:.1f} ms per stream; "
+                  f"wall {served_wall - direct_wall:+.2f}s vs direct")
+    finally:
+        server.terminate()
+        server.wait()
+        home.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Threads and CPU for N concurrent CLI output streams: a reader thread per stream (the old
+ClaudeRunner) versus the shared I/O reactor
+Usage: benchmark_io_reactor.py [streams ...]
+"""
+
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from io_reactor import Reactor
+
+# Configuration
+FAKE_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_claude_cli.py')
+DEFAULT_LEVELS = [50, 100]
+ENV = {**os.environ, 'FAKE_CLAUDE_STARTUP': '0.5', 'FAKE_CLAUDE_FIRST_TOKEN': '0.5',
+       'FAKE_CLAUDE_CHUNKS': '40', 'FAKE_CLAUDE_CHUNK': '0.1'}
+
+
+def spawn(count):
+    processes = []
+    for _ in range(count):
+        process = subprocess.Popen([sys.executable, FAKE_CLI, '--print'], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                   bufsize=1, env=ENV)
+        process.stdin.write('テスト')
+        process.stdin.close()
+        processes.append(process)
+    return processes
+
+
+def threaded(processes, peak):
+    """Reader thread + consumer polling a queue every 0.1 s, per stream"""
+    def consume(process):
+        lines = queue.Queue()
+
+        def read():
+            for line in iter(process.stdout.readline, ''):
+                lines.put(line.strip())
+            lines.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+        while True:
+            try:
+                if lines.get(timeout=0.1) is None:
+                    break
+            except queue.Empty:
+                pass
+        process.wait()
+
+    consumers = [threading.Thread(target=consume, args=(p,)) for p in processes]
+    for thread in consumers:
+        thread.start()
+    peak.append(threading.active_count())
+    for thread in consumers:
+        thread.join()
+
+
+def reactor(processes, peak):
+    """All streams on one reactor thread; the caller waits on them"""
+    io = Reactor()
+    streams = [io.register(p.stdout, on_line=lambda line: None, process=p) for p in processes]
+    peak.append(threading.active_count())
+    for stream in streams:
+        stream.wait()
+    io.close()
+
+
+def measure(run, count):
+    processes = spawn(count)
+    peak = []
+    cpu_before = time.process_time()
+    start_time = time.perf_counter()
+    run(processes, peak)
+    wall = time.perf_counter() - start_time
+    cpu = time.process_time() - cpu_before
+    for process in processes:
+        process.stdout.close()
+    return peak[0], cpu, wall
+
+
+def main():
+    levels = [int(arg) for arg in sys.argv[1:]] or DEFAULT_LEVELS
+    print(f"I/O reactor benchmark: {ENV['FAKE_CLAUDE_CHUNKS']} lines per stream, "
+          f"{ENV['FAKE_CLAUDE_CHUNK']}s apart")
+    print("=" * 80)
+    print(f"{'streams':>8s} {'mode':10s} {'threads':>8s} {'parent CPU':>11s} {'wall':>7s}")
+    for count in levels:
+        for mode, run in (('threads', threaded), ('reactor', reactor)):
+            threads, cpu, wall = measure(run, count)
+            print(f"{count:8d} {mode:10s} {threads:8d} {cpu * 1000:9.0f}ms {wall:6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Full-text search latency on a large synthetic chat database
+Usage: benchmark_search.py [message_count] [db_path]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+
+# Configuration
+DEFAULT_MESSAGES = 1000000
+NUM_USERS = 4
+MESSAGES_PER_CHAT = 100
+RUNS_PER_QUERY = 20
+TARGET_MS = 50
+
+COMMON_WORDS = ['天気', '東京', '会議', '資料', 'プログラム', 'データベース', '検索', 'エラー', '設定',
+                'サーバー', 'ファイル', '変換', 'テスト', '結果', '質問', '回答', '説明', '方法',
+                'Python', 'SQLite', 'docker', 'nginx', 'error', 'function', 'config', 'timeout']
+# Long-tail vocabulary: 5000 distinct 3-4 character words
+_CHARS = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモ山川田中村森林木本上下大小新旧高低長短'
+_rng = random.Random(7)
+RARE_WORDS = sorted({''.join(_rng.choice(_CHARS) for _ in range(_rng.randint(3, 4))) for _ in range(5200)})[:5000]
+
+QUERIES = {
+    'common word': ['データベース', 'プログラム', 'SQLite', 'timeout'],
+    'rare word': [RARE_WORDS[42], RARE_WORDS[1234], RARE_WORDS[4999]],
+    'two words': ['データベース エラー', 'nginx 設定', f'Python {RARE_WORDS[100]}'],
+    'no match': ['存在しない単語', 'zzzqqq'],
+    'short (LIKE)': ['天気', '東京 会議'],
+}
+
+
+def random_message(rng):
+    sentences = []
+    for _ in range(rng.randint(2, 6)):
+        words = [rng.choice(COMMON_WORDS if rng.random() < 0.7 else RARE_WORDS)
+                 for _ in range(rng.randint(3, 8))]
+        sentences.append('、'.join(words) + 'について確認しました')
+    return '。'.join(sentences) + '。'
+
+
+def build_database(manager, message_count):
+    rng = random.Random(42)
+    chat_count = max(1, message_count // MESSAGES_PER_CHAT)
+    print(f"Building {message_count} messages in {chat_count} chats...")
+    start_time = time.time()
+    with manager.pool.connection() as conn:
+        conn.executemany(
+            'INSERT INTO chats (user_id, title) VALUES (?, ?)',
+            [(f'user{i % NUM_USERS}', f'chat {i}') for i in range(chat_count)]
+        )
+    batch = 50000
+    for start in range(0, message_count, batch):
+        rows = [(rng.randint(1, chat_count), 'user' if i % 2 == 0 else 'assistant', random_message(rng))
+                for i in range(start, min(start + batch, message_count))]
+        with manager.pool.connection() as conn:
+            conn.executemany('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)', rows)
+    print(f"Built in {time.time() - start_time:.1f}s, {os.path.getsize(manager.db_path) / 1024 / 1024:.0f} MB")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MESSAGES
+    tmp_dir = None
+    if len(sys.argv) > 2:
+        db_path = sys.argv[2]
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(tmp_dir.name, 'search.db')
+
+    manager = SessionManager(db_path)
+    existing = manager.pool.get().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    if existing < message_count:
+        build_database(manager, message_count - existing)
+
+    print(f"\nSearch benchmark: {message_count} messages, {NUM_USERS} users, {RUNS_PER_QUERY} runs per query")
+    print("=" * 80)
+    print(f"{'query type':16s} {'p50 ms':>9s} {'p95 ms':>9s} {'max ms':>9s} {'hits/page':>10s}")
+
+    worst = 0
+    for kind, queries in QUERIES.items():
+        timings = []
+        hits = 0
+        for query in queries:
+            for run in range(RUNS_PER_QUERY):
+                user_id = f'user{run % NUM_USERS}'
+                start_time = time.perf_counter()
+                result = manager.search_messages(user_id, query, limit=20, offset=(run % 3) * 20)
+                timings.append((time.perf_counter() - start_time) * 1000)
+                hits += len(result['results'])
+        p95 = percentile(timings, 0.95)
+        if kind != 'short (LIKE)':
+            worst = max(worst, p95)
+        print(f"{kind:16s} {percentile(timings, 0.5):9.2f} {p95:9.2f} {max(timings):9.2f} "
+              f"{hits / len(timings):10.1f}")
+
+    print(f"\nIndexed queries p95: {worst:.2f} ms ({'within' if worst < TARGET_MS else 'over'} "
+          f"the {TARGET_MS} ms target)")
+    manager.pool.close()
+    if tmp_dir:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Streaming an answer over Server-Sent Events (GET /api/stream/<job_id>) vs Socket.IO
+Runs both wire protocols over loopback sockets: SSE as a chunked HTTP/1.1 response written with
+stream_utils.sse_event, Socket.IO as Engine.IO v4 over a WebSocket (the transport chat.js uses,
+without the polling handshake). Measures connection setup until events can flow, bytes on the
+wire per delta event beyond its JSON payload, and the time to deliver a whole answer
+"""
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream_utils import DeltaStream, sse_event
+from token_budget import estimate_tokens
+
+# Configuration
+ANSWER_TOKENS = 20000
+CHUNK_CHARS = 40         # Text per delta event (no coalescing, the worst case for framing)
+CONNECTIONS = 200        # Connection setups timed per protocol
+ROUNDS = 5               # Whole answers streamed per protocol
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+EIO_OPEN = '0' + json.dumps({'sid': 'x' * 20, 'upgrades': [], 'pingInterval': 25000,
+                             'pingTimeout': 120000, 'maxPayload': 1000000})
+
+
+def make_events():
+    line = "検索結果によると、この機能は2024年に導入されました。 The release notes list several changes. "
+    stream, events, tokens = DeltaStream(), [], 0
+    while tokens < ANSWER_TOKENS:
+        for start in range(0, len(line), CHUNK_CHARS):
+            chunk = line[start:start + CHUNK_CHARS]
+            events.append({'type': 'delta', **stream.delta(chunk), 'timestamp': '2026-01-01T00:00:00.000000'})
+            tokens += estimate_tokens(chunk)
+    events.append({'type': 'complete', **stream.end(), 'timestamp': '2026-01-01T00:00:00.000000'})
+    return events
+
+
+def read_headers(sock):
+    data = b''
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(4096)
+    head, _, rest = data.partition(b'\r\n\r\n')
+    return head.decode('latin-1'), rest
+
+
+def ws_frame(text, mask=False):
+    """One WebSocket text frame (clients must mask theirs)"""
+    payload = text.encode('utf-8')
+    length = len(payload)
+    head = bytearray([0x81])
+    bit = 0x80 if mask else 0
+    if length < 126:
+        head.append(bit | length)
+    elif length < 65536:
+        head += bytes([bit | 126]) + length.to_bytes(2, 'big')
+    else:
+        head += bytes([bit | 127]) + length.to_bytes(8, 'big')
+    if mask:
+        key = os.urandom(4)
+        head += key
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return bytes(head) + payload
+
+
+class Reader:
+    """Buffered reads from a socket, counting every byte received"""
+
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.data = data
+        self.received = len(data)
+
+    def exact(self, count):
+        while len(self.data) < count:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('closed')
+            self.data += chunk
+            self.received += len(chunk)
+        out, self.data = self.data[:count], self.data[count:]
+        return out
+
+    def until(self, marker):
+        while marker not in self.data:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('closed')
+            self.data += chunk
+            self.received += len(chunk)
+        out, _, self.data = self.data.partition(marker)
+        return out
+
+    def ws_text(self):
+        head = self.exact(2)
+        length = head[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(self.exact(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(self.exact(8), 'big')
+        mask = self.exact(4) if head[1] & 0x80 else None
+        payload = self.exact(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return payload.decode('utf-8')
+
+
+def sse_server(conn, events):
+    head, _ = read_headers(conn)
+    if 'setup' in head.split('\r\n')[0]:
+        events = []
+    conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                 b'X-Accel-Buffering: no\r\nTransfer-Encoding: chunked\r\n\r\n')
+    for event in events:
+        body = sse_event(event['type'], event, event.get('seq')).encode('utf-8')
+        conn.sendall(b'%x\r\n%s\r\n' % (len(body), body))
+    conn.sendall(b'0\r\n\r\n')
+
+
+def sse_client(port, stream):
+    """Returns (setup seconds, events received, bytes received)"""
+    started = time.perf_counter()
+    sock = socket.create_connection(('127.0.0.1', port))
+    path = b'/api/stream/job' if stream else b'/api/stream/job?setup'
+    sock.sendall(b'GET %s HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n'
+                 b'Cookie: session=x\r\n\r\n' % path)
+    head, rest = read_headers(sock)
+    setup = time.perf_counter() - started
+    reader = Reader(sock, rest)
+    reader.received += len(head) + 4
+    count = 0
+    if stream:
+        while True:
+            size = int(reader.until(b'\r\n'), 16)
+            if size == 0:
+                break
+            message = reader.exact(size + 2)[:-2].decode('utf-8')
+            data = message.split('\ndata: ', 1)[1].rstrip('\n')
+            json.loads(data)
+            count += 1
+    sock.close()
+    return setup, count, reader.received
+
+
+def socketio_server(conn, events):
+    head, _ = read_headers(conn)
+    key = [line.split(':', 1)[1].strip() for line in head.split('\r\n')
+           if line.lower().startswith('sec-websocket-key')][0]
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+    conn.sendall(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+    conn.sendall(ws_frame(EIO_OPEN))
+    reader = Reader(conn)
+    if reader.ws_text() != '40':
+        return
+    conn.sendall(ws_frame('40{"sid":"' + 'y' * 20 + '"}'))
+    if reader.ws_text() != 'go':
+        return
+    for event in events:
+        # python-socketio encodes with the json module's defaults (non-ASCII as \\uXXXX)
+        conn.sendall(ws_frame('42' + json.dumps(['stream_update', event])))
+    conn.sendall(ws_frame('41'))
+
+
+def socketio_client(port, stream):
+    started = time.perf_counter()
+    sock = socket.create_connection(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall(('GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: localhost\r\n'
+                  'Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\n'
+                  f'Sec-WebSocket-Key: {key}\r\nCookie: session=x\r\n\r\n').encode())
+    head, rest = read_headers(sock)
+    reader = Reader(sock, rest)
+    reader.received += len(head) + 4
+    reader.ws_text()                       # Engine.IO open
+    sock.sendall(ws_frame('40', mask=True))  # Socket.IO namespace connect
+    reader.ws_text()                       # Connect ack: events can flow from here
+    setup = time.perf_counter() - started
+    sock.sendall(ws_frame('go' if stream else 'no', mask=True))
+    count = 0
+    if stream:
+        while True:
+            packet = reader.ws_text()
+            if packet == '41':
+                break
+            json.loads(packet[2:])
+            count += 1
+    sock.close()
+    return setup, count, reader.received
+
+
+def serve(handler, events):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+
+    def handle(conn):
+        try:
+            handler(conn, events)
+        finally:
+            conn.close()
+
+    def loop():
+        while True:
+            conn, _ = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def measure(name, handler, client, events, payload_bytes):
+    port = serve(handler, events)
+    setups = [client(port, False)[0] for _ in range(CONNECTIONS)]
+    times, received = [], 0
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        _, count, received = client(port, True)
+        times.append(time.perf_counter() - started)
+        assert count == len(events), (name, count)
+    overhead = (received - payload_bytes) / len(events)
+    print(f"{name:22s} {statistics.median(setups) * 1000:10.3f} ms {received / 1024:10.0f} KB "
+          f"{overhead:10.1f} B {min(times) * 1000:10.1f} ms")
+    return statistics.median(setups), received, min(times)
+
+
+def main():
+    events = make_events()
+    payload_bytes = sum(len(json.dumps(event, ensure_ascii=False).encode('utf-8')) for event in events)
+    print(f"Answer: {len(events)} events, {payload_bytes / 1024:.0f} KB of JSON payload (UTF-8)")
+    print("=" * 80)
+    print(f"{'Transport':22s} {'Setup (p50)':>13s} {'Received':>13s} {'Overhead/evt':>12s} {'Stream':>13s}")
+    print("-" * 80)
+    sse_setup, sse_bytes, sse_time = measure('SSE', sse_server, sse_client, events, payload_bytes)
+    sio_setup, sio_bytes, sio_time = measure('Socket.IO (websocket)', socketio_server, socketio_client,
+                                             events, payload_bytes)
+    print("-" * 80)
+    print(f"Setup: {sio_setup / sse_setup:.1f}x faster, bytes: {sio_bytes / sse_bytes:.2f}x less, "
+          f"stream time: {sio_time / sse_time:.2f}x with SSE")
+    print("Socket.IO setup: WebSocket upgrade, then the Engine.IO open and namespace connect (2 round trips);")
+    print("with io()'s default polling transport, the polling handshake and the upgrade probe come first")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Streaming a long answer: whole text per update (protocol 1) vs numbered deltas (protocol 2)
+Counts the JSON bytes a Socket.IO client would receive and the server CPU spent building and
+encoding the updates, for a ~20k-token answer streamed in small chunks
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream_utils import DeltaStream
+from token_budget import estimate_tokens
+
+# Configuration
+ANSWER_TOKENS = 20000
+CHUNK_CHARS = 40         # Roughly what one CLI output line / API delta carries
+ROUNDS = 3
+
+
+def make_chunks():
+    line = "検索結果によると、この機能は2024年に導入されました。 The release notes list several changes. "
+    chunks, tokens = [], 0
+    while tokens < ANSWER_TOKENS:
+        for start in range(0, len(line), CHUNK_CHARS):
+            chunk = line[start:start + CHUNK_CHARS]
+            chunks.append(chunk)
+            tokens += estimate_tokens(chunk)
+    return chunks
+
+
+def whole_text(chunks):
+    """Protocol 1: every update re-sends the answer so far"""
+    total = 0
+    accumulated = []
+    for chunk in chunks:
+        accumulated.append(chunk)
+        total += len(json.dumps({'type': 'assistant', 'content': ''.join(accumulated)}))
+    total += len(json.dumps({'type': 'complete', 'content': ''.join(accumulated)}))
+    return total
+
+
+def deltas(chunks):
+    """Protocol 2: only the new text, with seq and periodic checksums"""
+    total = 0
+    stream = DeltaStream()
+    for chunk in chunks:
+        total += len(json.dumps({'type': 'delta', **stream.delta(chunk)}))
+    total += len(json.dumps({'type': 'complete', **stream.end()}))
+    return total
+
+
+def measure(name, encode, chunks):
+    times = []
+    for _ in range(ROUNDS):
+        start_time = time.process_time()
+        sent = encode(chunks)
+        times.append(time.process_time() - start_time)
+    print(f"{name:22s} {sent / 1024 / 1024:10.2f} MB {min(times) * 1000:12.1f} ms")
+    return sent, min(times)
+
+
+def main():
+    chunks = make_chunks()
+    answer = ''.join(chunks)
+    print(f"Answer: {len(chunks)} chunks, {len(answer)} chars, ~{estimate_tokens(answer)} tokens")
+    print("=" * 80)
+    print(f"{'Protocol':22s} {'Sent':>13s} {'Server CPU':>15s}")
+    print("-" * 80)
+    full_bytes, full_cpu = measure('v1 whole text', whole_text, chunks)
+    delta_bytes, delta_cpu = measure('v2 deltas', deltas, chunks)
+    print("-" * 80)
+    print(f"Bytes: {full_bytes / delta_bytes:.0f}x less, CPU: {full_cpu / max(delta_cpu, 1e-9):.0f}x less with deltas")
+
+
+if __name__ == "__main__":
+    main()
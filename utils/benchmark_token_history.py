@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Token-budgeted history window: cost versus chat length
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+from token_budget import history_budget
+
+# Configuration
+CHAT_LENGTHS = [20, 200, 2000, 20000]
+ITERATIONS = 200  # Each iteration appends a turn, then builds the history, like api_send
+SHORT_MESSAGE = '短い質問です。'
+LONG_MESSAGE = 'セル,値,備考\n' * 400  # A pasted spreadsheet every 50 turns
+
+
+def main():
+    budget = history_budget('opus')
+    print(f"Token-budgeted history benchmark: {budget} tokens, pinned first turn")
+    print("=" * 80)
+    print(f"{'messages':>10s} {'ms/turn':>10s} {'turns in window':>16s}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manager = SessionManager(os.path.join(tmp_dir, 'bench.db'))
+        for length in CHAT_LENGTHS:
+            chat_id = manager.create_chat('bench-user', f'bench {length}')
+            for i in range(length):
+                manager.add_message(chat_id, 'user' if i % 2 == 0 else 'assistant',
+                                    LONG_MESSAGE if i % 50 == 49 else SHORT_MESSAGE)
+
+            start_time = time.perf_counter()
+            for i in range(ITERATIONS):
+                message_id = manager.add_message(chat_id, 'user', SHORT_MESSAGE)
+                history = manager.build_conversation_history(
+                    chat_id, before_id=message_id, max_tokens=budget, pin_first=True
+                )
+            elapsed = (time.perf_counter() - start_time) / ITERATIONS * 1000
+            print(f"{length:10d} {elapsed:10.3f} {len(history):16d}")
+
+        manager.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Time to first byte of Claude CLI requests with and without the warm worker pool
+Uses utils/fake_claude_cli.py, whose startup delay stands in for Node start + auth loading
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from claude_worker_pool import WorkerPool
+
+# Configuration
+FAKE_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_claude_cli.py')
+STARTUP_SECONDS = 1.0
+FIRST_TOKEN_SECONDS = 0.2
+SEQUENTIAL_REQUESTS = 8
+SEQUENTIAL_GAP = 1.5      # Seconds between sequential requests (user think time)
+BURST_SIZE = 4
+BURST_ROUNDS = 3
+BURST_GAP = 3.0
+PROMPT = 'ユーザーの質問: 今日の東京の天気は？'
+
+ENV = {**os.environ, 'FAKE_CLAUDE_STARTUP': str(STARTUP_SECONDS),
+       'FAKE_CLAUDE_FIRST_TOKEN': str(FIRST_TOKEN_SECONDS), 'FAKE_CLAUDE_CHUNKS': '5'}
+
+
+def command_for(model):
+    return [sys.executable, FAKE_CLI, '--print', '--output-format', 'text', '--model', model]
+
+
+def request_cold():
+    """One request the way the APIs did it before: a new process per request"""
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command_for('opus'), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True, env=ENV)
+    process.stdin.write(PROMPT)
+    process.stdin.close()
+    process.stdout.readline()
+    ttfb = time.perf_counter() - start_time
+    process.stdout.read()
+    process.wait()
+    process.stdout.close()
+    process.stderr.close()
+    return ttfb
+
+
+def request_pooled(pool):
+    start_time = time.perf_counter()
+    with pool.lease('opus') as worker:
+        worker.send(PROMPT)
+        worker.process.stdout.readline()
+        ttfb = time.perf_counter() - start_time
+        worker.process.stdout.read()
+    return ttfb
+
+
+def sequential(make_request):
+    timings = []
+    for _ in range(SEQUENTIAL_REQUESTS):
+        timings.append(make_request())
+        time.sleep(SEQUENTIAL_GAP)
+    return timings
+
+
+def bursts(make_request):
+    timings = []
+    lock = threading.Lock()
+
+    def one():
+        ttfb = make_request()
+        with lock:
+            timings.append(ttfb)
+
+    for _ in range(BURST_ROUNDS):
+        threads = [threading.Thread(target=one) for _ in range(BURST_SIZE)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        time.sleep(BURST_GAP)
+    return timings
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return (f"p50 {timings[len(timings) // 2] * 1000:7.0f} ms  "
+            f"max {timings[-1] * 1000:7.0f} ms  mean {sum(timings) / len(timings) * 1000:7.0f} ms")
+
+
+def main():
+    print(f"Worker pool benchmark: fake CLI startup {STARTUP_SECONDS}s, first token {FIRST_TOKEN_SECONDS}s")
+    print("=" * 80)
+
+    pool = WorkerPool(command_for, warm_profiles=['opus'], min_idle=1, max_idle=BURST_SIZE, env=ENV)
+    # Let the first spare finish starting
+    time.sleep(STARTUP_SECONDS + 0.5)
+
+    print(f"Sequential ({SEQUENTIAL_REQUESTS} requests, {SEQUENTIAL_GAP}s apart)")
+    print(f"  new process per request  {summary(sequential(request_cold))}")
+    print(f"  warm pool                {summary(sequential(lambda: request_pooled(pool)))}")
+
+    print(f"Bursts ({BURST_ROUNDS} x {BURST_SIZE} concurrent, {BURST_GAP}s apart)")
+    print(f"  new process per request  {summary(bursts(request_cold))}")
+    print(f"  warm pool                {summary(bursts(lambda: request_pooled(pool)))}")
+
+    print(f"\nPool: {pool.ready()}")
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
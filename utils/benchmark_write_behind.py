@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Sustained insert throughput for SessionManager with and without write-behind batching
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+
+# Configuration
+NUM_PRODUCERS = 16  # Concurrent request threads
+MESSAGES_PER_PRODUCER = 500
+MESSAGE_BODY = 'ベンチマーク用のメッセージ本文です。' * 10
+
+
+def run_producers(manager, mode):
+    """Insert from NUM_PRODUCERS threads and return messages/sec
+
+    mode 'wait'   - add_message, every caller waits for its commit
+    mode 'submit' - submit_message, fire and forget, flush once at the end
+    """
+    chat_ids = [manager.create_chat(f'bench-user-{i}', 'bench') for i in range(NUM_PRODUCERS)]
+    errors = []
+    barrier = threading.Barrier(NUM_PRODUCERS + 1)
+
+    def producer(chat_id):
+        barrier.wait()
+        try:
+            for i in range(MESSAGES_PER_PRODUCER):
+                role = 'user' if i % 2 == 0 else 'assistant'
+                if mode == 'wait':
+                    manager.add_message(chat_id, role, MESSAGE_BODY)
+                else:
+                    manager.submit_message(chat_id, role, MESSAGE_BODY)
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=producer, args=(chat_id,)) for chat_id in chat_ids]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start_time = time.time()
+    for thread in threads:
+        thread.join()
+    manager.flush()
+    elapsed = time.time() - start_time
+
+    total = NUM_PRODUCERS * MESSAGES_PER_PRODUCER
+    return total / elapsed, elapsed, errors
+
+
+def main():
+    print(f"Write-behind benchmark: {NUM_PRODUCERS} producers x {MESSAGES_PER_PRODUCER} messages")
+    print("=" * 80)
+
+    cases = [
+        ('per-message commit', False, 'wait'),
+        ('write-behind, add_message', True, 'wait'),
+        ('write-behind, submit_message', True, 'submit'),
+    ]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for index, (name, write_behind, mode) in enumerate(cases):
+            manager = SessionManager(os.path.join(tmp_dir, f'bench_{index}.db'), write_behind=write_behind)
+            results.append((name, run_producers(manager, mode)))
+            manager.close()
+            manager.pool.close()
+
+    baseline = results[0][1][0]
+    for name, (rate, elapsed, errors) in results:
+        print(f"{name:30s} {rate:10.1f} msg/sec  ({elapsed:.2f}s, {rate / baseline:.2f}x, {len(errors)} errors)")
+        for error in errors[:3]:
+            print(f"    error: {error}")
+
+
+if __name__ == "__main__":
+    main()
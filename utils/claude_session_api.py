@@ -4,6 +4,7 @@ Claude Session API - Maintains persistent Claude sessions with /clear support
 """
 
 import os
+import sys
 import json
 import subprocess
 import uuid
@@ -14,11 +15,13 @@ from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import logging
 import pty
-import select
 import fcntl
 import termios
 import struct
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import io_reactor
+
 app = Flask(__name__)
 CORS(app)
 
@@ -39,9 +42,7 @@ class ClaudeSession:
         self.master_fd, self.slave_fd = pty.openpty()
         self.process = None
         self.output_queue = queue.Queue()
-        self.input_queue = queue.Queue()
-        self.reader_thread = None
-        self.writer_thread = None
+        self.stream = None  # master_fd registered with the shared I/O reactor
         self.is_running = False
         self.last_activity = time.time()
         self.creation_time = time.time()
@@ -67,21 +68,16 @@ class ClaudeSession:
             os.close(self.slave_fd)
             self.slave_fd = None  # Mark as closed
             
-            # Make master_fd non-blocking
-            flags = fcntl.fcntl(self.master_fd, fcntl.F_GETFL)
-            fcntl.fcntl(self.master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-            
             self.is_running = True
             
-            # Start reader thread
-            self.reader_thread = threading.Thread(target=self._read_output)
-            self.reader_thread.daemon = True
-            self.reader_thread.start()
-            
-            # Start writer thread
-            self.writer_thread = threading.Thread(target=self._write_input)
-            self.writer_thread.daemon = True
-            self.writer_thread.start()
+            # The reactor thread reads (and writes) master_fd for every session
+            self.stream = io_reactor.get_reactor().register(
+                self.master_fd,
+                on_chunk=self._on_output,
+                on_close=self._on_close,
+                process=self.process,
+                errors='ignore'
+            )
             
             # Wait for initial prompt and clear initial output
             time.sleep(2)
@@ -102,60 +98,26 @@ class ClaudeSession:
             self.stop()
             raise
     
-    def _read_output(self):
-        """Read output from Claude"""
-        buffer = ""
-        while self.is_running:
-            try:
-                # Check if data is available
-                ready, _, _ = select.select([self.master_fd], [], [], 0.1)
-                if ready:
-                    data = os.read(self.master_fd, 4096).decode('utf-8', errors='ignore')
-                    if data:
-                        buffer += data
-                        # Send data immediately to queue for streaming
-                        self.output_queue.put(data)
-                        self.last_activity = time.time()
-                    else:
-                        # Empty read means EOF - process died
-                        logger.warning(f"EOF on session {self.session_id} - process may have died")
-                        self.is_running = False
-                        break
-            except OSError as e:
-                logger.error(f"Read error on session {self.session_id}: {e}")
-                self.is_running = False
-                break
-            except Exception as e:
-                logger.error(f"Unexpected read error on session {self.session_id}: {e}")
-                self.is_running = False
-                break
+    def _on_output(self, data):
+        """Output from Claude, called on the reactor thread"""
+        # Send data immediately to queue for streaming
+        self.output_queue.put(data)
+        self.last_activity = time.time()
         
-        # Send any remaining buffer
-        if buffer:
-            self.output_queue.put(buffer)
+    def _on_close(self, returncode):
+        """EOF on the PTY and process exit, called on the reactor thread"""
+        if self.is_running:
+            logger.warning(f"EOF on session {self.session_id} - process exited with code {returncode}")
+        self.is_running = False
         
-    def _write_input(self):
+    def _write(self, command):
         """Write input to Claude"""
-        while self.is_running:
-            try:
-                command = self.input_queue.get(timeout=0.1)
-                if command:
-                    os.write(self.master_fd, (command + '\n').encode('utf-8'))
-                    self.last_activity = time.time()
-            except queue.Empty:
-                continue
-            except OSError as e:
-                logger.error(f"Write error on session {self.session_id}: {e}")
-                self.is_running = False
-                break
-            except Exception as e:
-                logger.error(f"Unexpected write error on session {self.session_id}: {e}")
-                self.is_running = False
-                break
+        self.stream.write((command + '\n').encode('utf-8'))
+        self.last_activity = time.time()
     
     def send_message(self, message):
         """Send a message to Claude"""
-        self.input_queue.put(message)
+        self._write(message)
         self.message_count += 1
         
     def is_healthy(self):
@@ -164,16 +126,14 @@ class ClaudeSession:
             return False
         if self.process and self.process.poll() is not None:
             return False
-        # Check if threads are alive
-        if self.reader_thread and not self.reader_thread.is_alive():
-            return False
-        if self.writer_thread and not self.writer_thread.is_alive():
+        # Check that the reactor is still watching the PTY
+        if self.stream and self.stream.closed:
             return False
         return True
         
     def clear_context(self):
         """Send /clear command to Claude"""
-        self.input_queue.put("/clear")
+        self._write("/clear")
         # Wait for clear response
         try:
             self.get_response(timeout=5)
@@ -257,7 +217,12 @@ class ClaudeSession:
                 logger.error(f"Error stopping process for session {self.session_id}: {e}")
         
         # Clean up file descriptors
-        if self.master_fd:
+        if self.stream:
+            # The reactor closes master_fd once it has stopped watching it
+            self.stream.close(close_fd=True)
+            self.stream = None
+            self.master_fd = None
+        elif self.master_fd:
             try:
                 os.close(self.master_fd)
             except OSError:
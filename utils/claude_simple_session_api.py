@@ -4,6 +4,7 @@ Simplified Claude Session API - Direct subprocess approach
 """
 
 import os
+import sys
 import json
 import subprocess
 import uuid
@@ -13,6 +14,9 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from latency_model import LatencyModel, DEADLINE_HEADER
+
 app = Flask(__name__)
 CORS(app)
 
@@ -27,6 +31,9 @@ CLAUDE_CLI = "/home/ubuntu/.npm-global/bin/claude"
 sessions = {}
 session_lock = threading.Lock()
 
+# Deadlines from recorded run times per model and thinking mode, capped by X-Request-Deadline
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+
 class SimpleClaudeSession:
     def __init__(self, session_id):
         self.session_id = session_id
@@ -44,8 +51,11 @@ class SimpleClaudeSession:
             "すべての応答は日本語で行ってください。"
         )
         
-    def send_message(self, message):
-        """Send message to Claude and get response"""
+    def send_message(self, message, upstream_deadline=None):
+        """Send message to Claude and get response
+
+        upstream_deadline is the caller's X-Request-Deadline value, if any.
+        """
         self.message_count += 1
         self.last_activity = time.time()
         
@@ -56,13 +66,8 @@ class SimpleClaudeSession:
             # Build full conversation for context
             full_prompt = self._build_prompt()
             
-            # Determine timeout based on thinking mode
-            if 'ultrathink' in message.lower():
-                timeout = 1800  # 30 minutes
-            elif 'megathink' in message.lower():
-                timeout = 900   # 15 minutes
-            else:
-                timeout = 600   # 10 minutes minimum for all queries
+            # Timeout from recorded run times for this model and thinking mode
+            deadline = latency_model.deadline(self.model, message, upstream_deadline)
             
             # Call Claude CLI directly with --print flag and model
             result = subprocess.run(
@@ -70,7 +75,7 @@ class SimpleClaudeSession:
                 input=full_prompt,
                 capture_output=True,
                 text=True,
-                timeout=timeout
+                timeout=deadline.remaining()
             )
             
             if result.returncode != 0:
@@ -112,6 +117,7 @@ class SimpleClaudeSession:
             
             # Store response in conversation
             self.conversation.append({"role": "assistant", "content": response})
+            latency_model.record(deadline)
             
             return response
             
@@ -246,7 +252,7 @@ def send_message(session_id):
             session.set_model(model)
         
         # Send message and get response
-        response = session.send_message(message)
+        response = session.send_message(message, request.headers.get(DEADLINE_HEADER))
         
         return jsonify({
             "session_id": session_id,
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the `claude` CLI, for benchmarks and local testing without an account
+Accepts --print, --model, --output-format text|stream-json, --include-partial-messages and a
+prompt argument or stdin.
+Startup (Node + auth loading) is simulated before stdin is read, like the real CLI
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+# Configuration (environment overrides)
+STARTUP_SECONDS = float(os.environ.get('FAKE_CLAUDE_STARTUP', '1.5'))     # Process start + auth load
+FIRST_TOKEN_SECONDS = float(os.environ.get('FAKE_CLAUDE_FIRST_TOKEN', '0.3'))  # Model latency
+CHUNK_SECONDS = float(os.environ.get('FAKE_CLAUDE_CHUNK', '0.02'))         # Between output chunks
+CHUNKS = int(os.environ.get('FAKE_CLAUDE_CHUNKS', '10'))
+BALLAST_MB = int(os.environ.get('FAKE_CLAUDE_BALLAST_MB', '0'))            # Extra resident memory
+
+
+def answer_chunks(prompt):
+    words = prompt.split()[-5:] or ['(empty)']
+    yield f"これはテスト応答です。質問: {' '.join(words)}\n"
+    for i in range(CHUNKS - 1):
+        yield f"行 {i + 1}: ダミーの回答テキストです。\n"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('prompt', nargs='?')
+    parser.add_argument('--print', '-p', action='store_true')
+    parser.add_argument('--model', default='sonnet')
+    parser.add_argument('--output-format', default='text', choices=['text', 'json', 'stream-json'])
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--include-partial-messages', action='store_true')
+    parser.add_argument('--version', action='store_true')
+    args = parser.parse_args()
+
+    if args.version:
+        print('0.0.0 (fake claude)')
+        return
+
+    ballast = b'x' * (BALLAST_MB * 1024 * 1024)  # noqa: F841 (held until exit)
+    time.sleep(STARTUP_SECONDS)
+    prompt = args.prompt if args.prompt is not None else sys.stdin.read()
+    session_id = str(uuid.uuid4())
+    start_time = time.time()
+    time.sleep(FIRST_TOKEN_SECONDS)
+
+    message_id = f"msg_{uuid.uuid4().hex[:24]}"
+    partial = args.output_format == 'stream-json' and args.include_partial_messages
+
+    def stream_event(event):
+        print(json.dumps({'type': 'stream_event', 'event': event, 'session_id': session_id},
+                         ensure_ascii=False), flush=True)
+
+    if args.output_format == 'stream-json':
+        print(json.dumps({'type': 'system', 'subtype': 'init', 'session_id': session_id, 'model': args.model}),
+              flush=True)
+    if partial:
+        stream_event({'type': 'message_start', 'message': {'id': message_id, 'role': 'assistant', 'content': [],
+                                                           'usage': {'input_tokens': len(prompt), 'output_tokens': 1}}})
+        stream_event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+    text = []
+    for chunk in answer_chunks(prompt):
+        text.append(chunk)
+        if args.output_format == 'text':
+            print(chunk, end='', flush=True)
+        elif partial:
+            stream_event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}})
+        elif args.output_format == 'stream-json':
+            # One content block per line; readers join blocks with newlines
+            print(json.dumps({'type': 'assistant', 'session_id': session_id, 'message': {
+                'id': message_id, 'role': 'assistant', 'content': [{'type': 'text', 'text': chunk.rstrip('\n')}]
+            }}, ensure_ascii=False), flush=True)
+        time.sleep(CHUNK_SECONDS)
+    if partial:
+        # The complete message follows its deltas, as with the real CLI
+        stream_event({'type': 'content_block_stop', 'index': 0})
+        print(json.dumps({'type': 'assistant', 'session_id': session_id, 'message': {
+            'id': message_id, 'role': 'assistant', 'content': [{'type': 'text', 'text': ''.join(text)}]
+        }}, ensure_ascii=False), flush=True)
+        stream_event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': len(text)}})
+        stream_event({'type': 'message_stop'})
+
+    answer = ''.join(text)
+    if args.output_format == 'stream-json' and not partial:
+        answer = '\n'.join(chunk.rstrip('\n') for chunk in text)
+    result = {'type': 'result', 'subtype': 'success', 'is_error': False, 'session_id': session_id,
+              'duration_ms': int((time.time() - start_time) * 1000), 'result': answer}
+    if args.output_format in ('json', 'stream-json'):
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
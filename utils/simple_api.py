@@ -4,6 +4,7 @@ Simple Claude Code API - Direct execution without complexity
 """
 
 import os
+import sys
 import json
 import subprocess
 import uuid
@@ -12,6 +13,15 @@ from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from claude_worker_pool import WorkerPool
+from job_scheduler import JobScheduler, QueueFull
+from response_cache import ResponseCache, prompt_version
+from single_flight import SingleFlight, flight_key
+import io_reactor
+from token_budget import estimate_tokens
+from latency_model import LatencyModel, DeadlineExceeded, DEADLINE_HEADER
+
 app = Flask(__name__)
 CORS(app)
 
@@ -20,13 +30,161 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Claude CLI path
-CLAUDE_CLI = "/home/ubuntu/.npm-global/bin/claude"
+CLAUDE_CLI = os.environ.get('CLAUDE_CLI', "/home/ubuntu/.npm-global/bin/claude")
+
+# Model names clients may send, mapped to the name passed to the CLI
+MODEL_MAPPING = {
+    'opus': 'opus',  # Use alias for latest
+    'opus4': 'opus',  # Opus 4
+    'sonnet': 'sonnet',  # Aliases the CLI resolves itself
+    'haiku': 'haiku',
+    'sonnet4': 'claude-sonnet-4-20250514',  # Sonnet 4 specific
+    # Keep full names as-is
+    'claude-sonnet-4-20250514': 'claude-sonnet-4-20250514',
+    'claude-3-5-haiku-20241022': 'claude-3-5-haiku-20241022'
+}
+DEFAULT_MODEL = 'opus'  # When the request names no model
+
+# Pre-started `claude --print` processes per model; the prompt is written to stdin
+# WEBAI_WARM_MODELS lists the models kept warm (others get spares once used)
+worker_pool = WorkerPool(
+    lambda model: [CLAUDE_CLI, "--print", "--output-format", "text", "--model", model],
+    warm_profiles=os.environ.get('WEBAI_WARM_MODELS', 'opus').split(',')
+)
+
+# Per-model concurrency limit with a bounded wait queue (WEBAI_MODEL_CONCURRENCY, WEBAI_QUEUE_SIZE)
+job_scheduler = JobScheduler()
+QUEUE_REPORT_INTERVAL = 2  # Seconds between queue position events on /chat/stream
+HEARTBEAT_INTERVAL = 5     # Idle seconds before /chat/stream writes a keep-alive (detects closed clients)
+
+# Answers to repeated prompts (WEBAI_RESPONSE_CACHE_MB=0 disables, WEBAI_RESPONSE_CACHE_DB persists)
+response_cache = ResponseCache(path=os.environ.get('WEBAI_RESPONSE_CACHE_DB'))
+
+# Identical requests (same model and prompt) in flight at once share one CLI run
+single_flight = SingleFlight()
+
+# Deadlines from recorded run times per model and thinking mode (WEBAI_LATENCY_DB persists them);
+# a caller's X-Request-Deadline header caps the budget
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+
+# Safety prompt put in front of the user's message (/chat and /chat/stream); its hash is part of the cache key
+SAFETY_PROMPT = (
+    "重要: あなたは別のPCで作業中のユーザーを支援しています。"
+    "このサーバーのファイルやコマンドを操作しないでください。"
+    "質問に対してWeb検索や知識に基づいた回答のみを提供してください。"
+    "検索結果を使用した場合は、必ず情報源のURLを明記してください。"
+    "すべての応答は日本語で行ってください。\n\n"
+)
+PROMPT_VERSION = prompt_version(SAFETY_PROMPT)
+
+def busy_response(error):
+    """429 with Retry-After when the model's queue is full"""
+    response = jsonify({
+        "error": "Server busy",
+        "message": f"混雑しています。{error.retry_after}秒後にもう一度お試しください。",
+        "retry_after": error.retry_after
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def run_claude(flight, model, message, safe_prompt, deadline):
+    """Run claude on a pre-started worker, publishing each output line to the flight
+
+    Returns a CompletedProcess like subprocess.run; successful answers are cached
+    and their timings feed the latency model. Raises DeadlineExceeded, killing
+    the CLI, when the run outlives its deadline.
+    """
+    reactor = io_reactor.get_reactor()
+    with worker_pool.lease(model) as worker:
+        flight.worker = worker
+        if flight.cancelled:
+            raise RuntimeError('Cancelled: client disconnected')
+        # The total budget may have been spent waiting in the queue; time to first
+        # output counts from here
+        deadline.begin()
+        deadline.check()
+        worker.send(safe_prompt)
+        process = worker.process
+        lines = []
+        errors = []
+
+        def on_line(line):
+            deadline.touch()
+            lines.append(line)
+            worker.tokens += estimate_tokens(line)
+            flight.publish(line)
+
+        stdout = reactor.register(process.stdout, on_line=on_line, process=process)
+        stderr = reactor.register(process.stderr, on_chunk=errors.append)
+        phase = deadline.wait(stdout.done)
+        if phase:
+            worker.kill()
+            stdout.wait()
+            stderr.wait()
+            logger.warning(f"Killed {model} run: {phase} deadline passed after {deadline.elapsed():.0f}s")
+            latency_model.record(deadline, timed_out=True)
+            raise DeadlineExceeded(phase, deadline.elapsed())
+        stderr.wait()
+        result = subprocess.CompletedProcess(process.args, stdout.returncode, '\n'.join(lines), ''.join(errors))
+
+    response = result.stdout.strip()
+    if result.returncode == 0 and not flight.cancelled and response and "API Error:" not in response:
+        response_cache.put(message, model, response, version=PROMPT_VERSION)
+        latency_model.record(deadline)
+    return result
+
+def cancel_flight(flight):
+    """Stop a run nobody is reading any more: withdraw the queued job, or kill the CLI's process group"""
+    if flight.handle.cancel():
+        return
+    worker = flight.worker
+    if worker is not None and worker_pool.cancel(worker):
+        logger.info(f"Client disconnected, killed its {worker.profile} run")
+
+def start_flight(model, message, safe_prompt, deadline):
+    """Join an identical request that is already running, or schedule a new run; raises QueueFull"""
+    def start(flight):
+        job = job_scheduler.submit(model, run_claude, flight, model, message, safe_prompt, deadline)
+        flight.follow(job.future)
+        return job
+
+    flight, leader = single_flight.join(flight_key(model, safe_prompt), start)
+    if not leader:
+        logger.info(f"Joined in-flight request for model: {model}")
+    return flight
 
 @app.route('/health', methods=['GET'])
 def health():
     """Simple health check"""
     return jsonify({"status": "healthy", "service": "simple-claude-api"})
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: 200 once every warm model has a pre-started worker"""
+    status = worker_pool.ready()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/cache', methods=['GET'])
+def cache_status():
+    """Response cache hit/miss counters and size"""
+    return jsonify(response_cache.snapshot())
+
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    """Running and queued jobs per model, CLI runs saved by coalescing and current deadlines"""
+    status = job_scheduler.snapshot()
+    status['single_flight'] = single_flight.snapshot()
+    status['latency'] = latency_model.snapshot()
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Queue position and estimated start time of a job"""
+    job = job_scheduler.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.status())
+
 @app.route('/clear', methods=['POST'])
 def clear_context():
     """Clear context by starting a new session"""
@@ -39,22 +197,14 @@ def chat():
     """Simple chat endpoint - just run claude and return result"""
     data = request.get_json()
     message = data.get('message', '')
-    model = data.get('model', 'opus')  # Default to opus
-    
-    # Map short model names to full model names
-    model_mapping = {
-        'opus': 'opus',  # Use alias for latest
-        'opus4': 'opus',  # Opus 4
-        'sonnet4': 'claude-sonnet-4-20250514',  # Sonnet 4 specific
-        # Keep full names as-is
-        'claude-sonnet-4-20250514': 'claude-sonnet-4-20250514'
-    }
-    
-    # Convert model name
-    model = model_mapping.get(model, model)
+    model = data.get('model') or DEFAULT_MODEL
     
     if not message:
         return jsonify({"error": "No message provided"}), 400
+    # Only known models reach the CLI and the scheduler
+    if model not in MODEL_MAPPING:
+        return jsonify({"error": f"Unknown model: {model}"}), 400
+    model = MODEL_MAPPING[model]
     
     # Escape problematic patterns that can cause CLI parsing issues
     # Replace unclosed quotes and parentheses to prevent syntax errors
@@ -71,40 +221,39 @@ def chat():
         escaped_message += ')' * (open_parens - close_parens)
     
     # Add safety prompt to prevent local file operations
-    safe_prompt = (
-        "重要: あなたは別のPCで作業中のユーザーを支援しています。"
-        "このサーバーのファイルやコマンドを操作しないでください。"
-        "質問に対してWeb検索や知識に基づいた回答のみを提供してください。"
-        "検索結果を使用した場合は、必ず情報源のURLを明記してください。"
-        "すべての応答は日本語で行ってください。\n\n"
-        f"ユーザーの質問: {escaped_message}"
-    )
+    safe_prompt = SAFETY_PROMPT + f"ユーザーの質問: {escaped_message}"
+    
+    # A repeat of an earlier prompt is answered from the cache without a CLI run
+    cached = response_cache.get(message, model, version=PROMPT_VERSION)
+    if cached is not None:
+        logger.info(f"Cache hit for model: {model}, message length: {len(message)}")
+        return jsonify({
+            "id": str(uuid.uuid4()),
+            "message": cached,
+            "cached": True
+        })
     
     try:
-        # Build command with model selection
-        cmd = [CLAUDE_CLI, "--print", "--model", model]
-        
         # Log the request
         logger.info(f"Processing request with model: {model}, message length: {len(message)}")
         
         # Simply run claude --print with the message
-        # Increase timeout based on thinking mode and expected processing time
-        # Anthropic recommends up to 60 minutes for Claude 3.7/4
-        if 'ultrathink' in safe_prompt.lower():
-            timeout = 1800  # 30 minutes for ultrathink (31,999 tokens)
-        elif 'megathink' in safe_prompt.lower():
-            timeout = 900   # 15 minutes for megathink (10,000 tokens)
-        else:
-            timeout = 600   # 10 minutes minimum for all queries
+        # The deadline comes from recorded run times for this model and thinking
+        # mode (fixed 10/15/30 minute timeouts until there is history), capped
+        # by the caller's X-Request-Deadline
+        deadline = latency_model.deadline(model, message, request.headers.get(DEADLINE_HEADER))
         
-        # Use stdin to pass the prompt to avoid shell escaping issues
-        result = subprocess.run(
-            cmd,
-            input=safe_prompt,
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
+        # Use stdin to pass the prompt to avoid shell escaping issues.
+        # The job waits for a free slot of this model first; an identical
+        # request already in flight is joined instead
+        flight = start_flight(model, message, safe_prompt, deadline)
+        finished = flight.wait(deadline.remaining())
+        single_flight.leave(flight, cancel=lambda: cancel_flight(flight))
+        if not finished:
+            raise DeadlineExceeded('total', deadline.elapsed())
+        if flight.error is not None:
+            raise flight.error
+        result = flight.result
         
         if result.returncode == 0:
             response = result.stdout.strip()
@@ -149,8 +298,11 @@ def chat():
             "message": response
         })
         
-    except subprocess.TimeoutExpired:
-        logger.error(f"Claude CLI timeout after {timeout} seconds")
+    except QueueFull as e:
+        logger.warning(f"Rejected request: {e}")
+        return busy_response(e)
+    except DeadlineExceeded as e:
+        logger.error(f"Claude CLI timeout: {e}")
         return jsonify({"error": "Request timeout", "message": "処理がタイムアウトしました。"}), 504
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
@@ -164,22 +316,14 @@ def chat_stream():
     """Streaming chat endpoint"""
     data = request.get_json()
     message = data.get('message', '')
-    model = data.get('model', 'opus')  # Default to opus
-    
-    # Map short model names to full model names
-    model_mapping = {
-        'opus': 'opus',  # Use alias for latest
-        'opus4': 'opus',  # Opus 4
-        'sonnet4': 'claude-sonnet-4-20250514',  # Sonnet 4 specific
-        # Keep full names as-is
-        'claude-sonnet-4-20250514': 'claude-sonnet-4-20250514'
-    }
-    
-    # Convert model name
-    model = model_mapping.get(model, model)
+    model = data.get('model') or DEFAULT_MODEL
     
     if not message:
         return jsonify({"error": "No message provided"}), 400
+    # Only known models reach the CLI and the scheduler
+    if model not in MODEL_MAPPING:
+        return jsonify({"error": f"Unknown model: {model}"}), 400
+    model = MODEL_MAPPING[model]
     
     # Escape problematic patterns that can cause CLI parsing issues
     escaped_message = message
@@ -195,43 +339,57 @@ def chat_stream():
         escaped_message += ')' * (open_parens - close_parens)
     
     # Add safety prompt
-    safe_prompt = (
-        "重要: あなたは別のPCで作業中のユーザーを支援しています。"
-        "このサーバーのファイルやコマンドを操作しないでください。"
-        "質問に対してWeb検索や知識に基づいた回答のみを提供してください。"
-        "検索結果を使用した場合は、必ず情報源のURLを明記してください。\n\n"
-        f"ユーザーの質問: {escaped_message}"
-    )
+    safe_prompt = SAFETY_PROMPT + f"ユーザーの質問: {escaped_message}"
+    
+    # Cached answers are replayed line by line through the same event stream
+    cached = response_cache.get(message, model, version=PROMPT_VERSION)
+    if cached is not None:
+        def replay():
+            for line in cached.split('\n'):
+                yield f"data: {json.dumps({'chunk': line})}\n\n"
+            yield f"data: {json.dumps({'done': True, 'cached': True})}\n\n"
+        return Response(replay(), mimetype='text/event-stream')
+    
+    # The CLI runs as a scheduled job publishing its output lines; identical
+    # requests in flight subscribe to the same run, from its first line
+    deadline = latency_model.deadline(model, message, request.headers.get(DEADLINE_HEADER))
+    try:
+        flight = start_flight(model, message, safe_prompt, deadline)
+    except QueueFull as e:
+        logger.warning(f"Rejected stream request: {e}")
+        return busy_response(e)
+    job = flight.handle
     
     def generate():
         try:
-            # Run claude with model selection
-            process = subprocess.Popen(
-                [CLAUDE_CLI, "--print", "--output-format", "text", "--model", model, safe_prompt],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
+            # Report the queue position and estimated start until a slot frees up
+            status = job.status()
+            while status['state'] == 'queued':
+                yield f"data: {json.dumps({'queued': status})}\n\n"
+                job.started.wait(QUEUE_REPORT_INTERVAL)
+                status = job.status()
             
-            # Stream output line by line
-            for line in process.stdout:
-                if line:
+            for line in flight.subscribe(heartbeat=HEARTBEAT_INTERVAL):
+                if line is None:
+                    # SSE comment; the write fails once the client has gone
+                    yield ": keepalive\n\n"
+                elif line:
                     yield f"data: {json.dumps({'chunk': line.rstrip()})}\n\n"
             
-            # Wait for completion
-            process.wait()
-            
-            if process.returncode != 0:
-                error = process.stderr.read()
-                logger.error(f"Claude error: {error}")
+            if flight.error is not None:
+                raise flight.error
+            if flight.result.returncode != 0:
+                logger.error(f"Claude error: {flight.result.stderr}")
                 yield f"data: {json.dumps({'error': 'エラーが発生しました'})}\n\n"
-            
             yield f"data: {json.dumps({'done': True})}\n\n"
             
         except Exception as e:
             logger.error(f"Stream error: {e}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Client gone (GeneratorExit) while queued or running: give the place up or
+            # kill the CLI, unless other requests share the run
+            single_flight.leave(flight, cancel=lambda: cancel_flight(flight))
     
     return Response(generate(), mimetype='text/event-stream')
 
@@ -4,8 +4,8 @@ Simple WebAI Application with Authentication and Chat History
 """
 
 import os
+import sys
 import json
-import sqlite3
 import datetime
 import requests
 import subprocess
@@ -14,6 +14,11 @@ from flask_login import LoginManager, UserMixin, login_user, logout_user, login_
 from werkzeug.security import check_password_hash, generate_password_hash
 import logging
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+from latency_model import LatencyModel, DEADLINE_HEADER
+from upstream_client import UpstreamClient
+
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here-change-in-production')
 
@@ -35,34 +40,37 @@ user_sessions = {}
 
 # Database setup
 DB_PATH = "webai.db"
-
-def init_db():
-    """Initialize database"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Create chats table
-    c.execute('''CREATE TABLE IF NOT EXISTS chats
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id TEXT NOT NULL,
-                  title TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Create messages table
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  chat_id INTEGER NOT NULL,
-                  role TEXT NOT NULL,
-                  content TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (chat_id) REFERENCES chats (id))''')
-    
-    conn.commit()
-    conn.close()
-
-# Initialize database on startup
-init_db()
+# Schema and migrations are owned by SessionManager; share its connection pool
+# SIMPLE_APP_WRITE_BEHIND=1 batches message writes on a background writer thread
+# WEBAI_ARCHIVE_DB moves idle chats to a second database (see utils/archive_chats.py)
+session_manager = SessionManager(
+    DB_PATH,
+    write_behind=os.environ.get('SIMPLE_APP_WRITE_BEHIND', '0') == '1',
+    archive_path=os.environ.get('WEBAI_ARCHIVE_DB')
+)
+db_pool = session_manager.pool
+
+# End-to-end deadlines from recorded answer times per model and thinking mode;
+# the remaining budget is passed on in X-Request-Deadline so the API enforces the same one
+latency_model = LatencyModel(path=os.environ.get('WEBAI_LATENCY_DB'))
+DEADLINE_SLACK = 5  # Extra seconds on our own read timeout, so the API's 504 arrives first
+
+# Keep-alive connections to the simple and session APIs (WEBAI_UPSTREAM_POOL_SIZE, WEBAI_UPSTREAM_POOL_BLOCK)
+upstream = UpstreamClient()
+
+# Maximum page size for cursor-based listing
+MAX_PAGE_SIZE = 200
+
+def get_page_args(default_limit=None):
+    """Read before_id/after_id/limit cursor parameters from the query string"""
+    limit = request.args.get('limit', default_limit, type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return {
+        'before_id': request.args.get('before_id', type=int),
+        'after_id': request.args.get('after_id', type=int),
+        'limit': limit
+    }
 
 # Simple user class
 class User(UserMixin):
@@ -134,21 +142,7 @@ def chat():
 @login_required
 def get_chats():
     """Get user's chat list"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''SELECT id, title, created_at, updated_at 
-                 FROM chats 
-                 WHERE user_id = ? 
-                 ORDER BY updated_at DESC''', (current_user.id,))
-    chats = []
-    for row in c.fetchall():
-        chats.append({
-            'id': row[0],
-            'title': row[1],
-            'created_at': row[2],
-            'updated_at': row[3]
-        })
-    conn.close()
+    chats = session_manager.get_user_chats(current_user.id, **get_page_args())
     return jsonify(chats)
 
 @app.route('/api/chats', methods=['POST'])
@@ -158,13 +152,11 @@ def create_chat():
     data = request.get_json()
     title = data.get('title', '新しいチャット')
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO chats (user_id, title) VALUES (?, ?)', 
-              (current_user.id, title))
-    chat_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with db_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute('INSERT INTO chats (user_id, title) VALUES (?, ?)', 
+                  (current_user.id, title))
+        chat_id = c.lastrowid
     
     return jsonify({'id': chat_id, 'title': title})
 
@@ -172,21 +164,12 @@ def create_chat():
 @login_required
 def delete_chat(chat_id):
     """Delete chat"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Check ownership
-    c.execute('SELECT user_id FROM chats WHERE id = ?', (chat_id,))
-    row = c.fetchone()
-    if not row or row[0] != current_user.id:
-        conn.close()
+    # Check ownership (archived chats included)
+    if session_manager.get_chat_owner(chat_id) != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    # Delete messages and chat
-    c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-    c.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-    conn.commit()
-    conn.close()
+    # Delete messages and chat from both tiers
+    session_manager.delete_chat(chat_id)
     
     return jsonify({'success': True})
 
@@ -194,32 +177,25 @@ def delete_chat(chat_id):
 @login_required
 def get_messages(chat_id):
     """Get chat messages"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Check ownership
-    c.execute('SELECT user_id FROM chats WHERE id = ?', (chat_id,))
-    row = c.fetchone()
-    if not row or row[0] != current_user.id:
-        conn.close()
+    # Check ownership (archived chats included)
+    if session_manager.get_chat_owner(chat_id) != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    # Get messages
-    c.execute('''SELECT role, content, created_at 
-                 FROM messages 
-                 WHERE chat_id = ? 
-                 ORDER BY created_at''', (chat_id,))
-    messages = []
-    for row in c.fetchall():
-        messages.append({
-            'role': row[0],
-            'content': row[1],
-            'created_at': row[2]
-        })
-    conn.close()
-    
+    messages = session_manager.get_chat_messages(chat_id, **get_page_args())
     return jsonify(messages)
 
+@app.route('/api/search', methods=['GET'])
+@login_required
+def search_messages():
+    """Full-text search across the user's chats"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索語を入力してください'}), 400
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return jsonify(session_manager.search_messages(current_user.id, query, limit=limit, offset=offset))
+
 @app.route('/api/monitor', methods=['GET'])
 @login_required
 def get_claude_monitor():
@@ -466,6 +442,7 @@ def get_claude_status():
         return jsonify({
             'success': True,
             'status': '\n'.join(status_info),
+            'upstream': upstream.snapshot(),
             'timestamp': datetime.datetime.now().isoformat()
         })
         
@@ -481,12 +458,12 @@ def clear_context():
         # Check if user has a session
         if current_user.id in user_sessions:
             session_id = user_sessions[current_user.id]
-            response = requests.post(f"{SESSION_API_URL}/session/{session_id}/clear")
+            response = upstream.post(f"{SESSION_API_URL}/session/{session_id}/clear")
             if response.status_code == 200:
                 return jsonify({'success': True, 'message': 'セッションのコンテキストをクリアしました（/clearコマンド実行）'})
         
         # Fallback to simple API
-        response = requests.post(f"{SIMPLE_API_URL}/clear")
+        response = upstream.post(f"{SIMPLE_API_URL}/clear")
         if response.status_code == 200:
             return jsonify({'success': True, 'message': 'コンテキストをクリアしました'})
         else:
@@ -522,39 +499,25 @@ def send_message():
     
     # Create new chat if needed
     if not chat_id:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
         # Generate title from first message
         title = message[:30] + "..." if len(message) > 30 else message
-        c.execute('INSERT INTO chats (user_id, title) VALUES (?, ?)', 
-                  (current_user.id, title))
-        chat_id = c.lastrowid
-        conn.commit()
-        conn.close()
+        chat_id = session_manager.create_chat(current_user.id, title)
     
-    # Save user message
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
-              (chat_id, 'user', message))
-    conn.commit()
+    # Save user message (queued in write-behind mode)
+    session_manager.submit_message(chat_id, 'user', message)
     
     try:
-        # Increase timeout based on thinking mode and expected processing time
-        # Anthropic recommends up to 60 minutes for Claude 3.7/4
-        if 'ultrathink' in message.lower():
-            timeout = 1800  # 30 minutes for ultrathink (31,999 tokens)
-        elif 'megathink' in message.lower():
-            timeout = 900   # 15 minutes for megathink (10,000 tokens)
-        else:
-            timeout = 600   # 10 minutes minimum for all queries
+        # Deadline from recorded answer times for this model and thinking mode
+        # (fixed 10/15/30 minute timeouts until there is history)
+        deadline = latency_model.deadline(model, message)
+        timeout = deadline.remaining() + DEADLINE_SLACK
+        headers = {DEADLINE_HEADER: deadline.header()}
         
         if use_session:
             # Use session API for persistent context
             if current_user.id not in user_sessions:
                 # Create new session
-                session_response = requests.post(f"{SESSION_API_URL}/session/create")
+                session_response = upstream.post(f"{SESSION_API_URL}/session/create")
                 if session_response.status_code == 200:
                     user_sessions[current_user.id] = session_response.json()['session_id']
                 else:
@@ -563,23 +526,26 @@ def send_message():
             
             if use_session and current_user.id in user_sessions:
                 session_id = user_sessions[current_user.id]
-                response = requests.post(
+                response = upstream.post(
                     f"{SESSION_API_URL}/session/{session_id}/message",
                     json={'message': message, 'model': model},
+                    headers=headers,
                     timeout=timeout
                 )
             else:
                 # Fallback to simple API
-                response = requests.post(
+                response = upstream.post(
                     f"{SIMPLE_API_URL}/chat",
                     json={'message': message, 'model': model},
+                    headers=headers,
                     timeout=timeout
                 )
         else:
             # Use simple API
-            response = requests.post(
+            response = upstream.post(
                 f"{SIMPLE_API_URL}/chat",
                 json={'message': message, 'model': model},
+                headers=headers,
                 timeout=timeout
             )
         
@@ -592,22 +558,15 @@ def send_message():
                 logger.warning(f"Empty response received from API: {result}")
                 ai_message = "応答がありませんでした。もう一度お試しください。"
             
-            # Save AI response
-            c.execute('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
-                      (chat_id, 'assistant', ai_message))
-            
-            # Update chat timestamp
-            c.execute('UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                      (chat_id,))
-            conn.commit()
-            conn.close()
+            # Save AI response (also updates the chat timestamp)
+            session_manager.submit_message(chat_id, 'assistant', ai_message)
+            latency_model.record(deadline)
             
             return jsonify({
                 'chat_id': chat_id,
                 'message': ai_message
             })
         else:
-            conn.close()
             error_msg = f'API error: Status {response.status_code}'
             try:
                 error_detail = response.json()
@@ -618,15 +577,12 @@ def send_message():
             return jsonify({'error': error_msg}), 500
             
     except requests.exceptions.Timeout:
-        conn.close()
         logger.error("Request timeout error")
         return jsonify({'error': 'リクエストがタイムアウトしました。処理に時間がかかっています。'}), 504
     except requests.exceptions.ConnectionError as e:
-        conn.close()
         logger.error(f"Connection error: {e}")
         return jsonify({'error': 'APIサーバーに接続できません。'}), 503
     except Exception as e:
-        conn.close()
         logger.error(f"Error sending message: {e}")
         return jsonify({'error': f'エラーが発生しました: {str(e)}'}), 500
 
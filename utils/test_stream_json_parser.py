@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Conformance tests for stream_json_parser against recorded stream-json output
+Each fixtures/stream_json/<name>.jsonl is fed line by line; the answer text, first error,
+tool calls, usage and the sequence of event kinds must match <name>.expected.json.
+Also runs the fake CLI once, as the host APIs do. Runs with pytest or directly
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream_json_parser import StreamJsonParser
+
+# Configuration
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(UTILS_DIR, 'fixtures', 'stream_json')
+FAKE_CLI = os.path.join(UTILS_DIR, 'fake_claude_cli.py')
+
+
+def fixture_names():
+    return sorted(os.path.basename(path)[:-len('.jsonl')]
+                  for path in glob.glob(os.path.join(FIXTURES_DIR, '*.jsonl')))
+
+
+def parse(lines):
+    parser = StreamJsonParser()
+    kinds = []
+    for line in lines:
+        kinds += [event.kind for event in parser.feed(line)]
+    return parser, kinds
+
+
+def check_fixture(name):
+    """Differences from the expected outcome, as 'field: got ... expected ...' strings"""
+    with open(os.path.join(FIXTURES_DIR, name + '.jsonl'), encoding='utf-8') as f:
+        parser, kinds = parse(f)
+    with open(os.path.join(FIXTURES_DIR, name + '.expected.json'), encoding='utf-8') as f:
+        expected = json.load(f)
+    got = {'text': parser.text, 'error': parser.error, 'tools': parser.tools, 'usage': parser.usage,
+           'kinds': kinds}
+    return [f"{field}: got {got[field]!r}, expected {expected[field]!r}"
+            for field in expected if got[field] != expected[field]]
+
+
+def test_fixtures():
+    names = fixture_names()
+    assert names, f"no fixtures in {FIXTURES_DIR}"
+    failures = {name: check_fixture(name) for name in names}
+    assert not any(failures.values()), failures
+
+
+def test_delta_text_reported_once():
+    """Deltas and the complete message of the same id must not double the answer"""
+    parser, _ = parse(open(os.path.join(FIXTURES_DIR, 'partial_messages.jsonl'), encoding='utf-8'))
+    assert parser.text == parser.result['result']
+
+
+def test_delta_continues_block():
+    """Only the first delta of a block starts new text; clients append the rest as is"""
+    parser = StreamJsonParser()
+    starts = []
+    with open(os.path.join(FIXTURES_DIR, 'partial_messages.jsonl'), encoding='utf-8') as f:
+        for line in f:
+            starts += [event.data is None for event in parser.feed(line) if event.kind == 'text']
+    assert starts == [True, False, False], starts
+
+
+def test_fake_cli():
+    env = {**os.environ, 'FAKE_CLAUDE_STARTUP': '0', 'FAKE_CLAUDE_FIRST_TOKEN': '0', 'FAKE_CLAUDE_CHUNK': '0'}
+    for extra in ([], ['--include-partial-messages']):
+        result = subprocess.run([sys.executable, FAKE_CLI, '--print', '--output-format', 'stream-json',
+                                 '--verbose'] + extra, input='テスト', capture_output=True, text=True, env=env)
+        parser, kinds = parse(result.stdout.splitlines())
+        assert parser.error is None and kinds[-1] == 'result', kinds
+        assert parser.text == parser.result['result'], extra
+
+
+def main():
+    print("stream-json parser conformance")
+    print("=" * 80)
+    failed = 0
+    for name in fixture_names():
+        problems = check_fixture(name)
+        failed += bool(problems)
+        print(f"{'FAIL' if problems else 'ok':4s}  {name}")
+        for problem in problems:
+            print(f"      {problem}")
+    for test in (test_delta_text_reported_once, test_delta_continues_block, test_fake_cli):
+        try:
+            test()
+            print(f"ok    {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
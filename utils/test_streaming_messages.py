@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for answers persisted while they stream (SessionManager.start_message)
+The text so far is readable during the stream, a finished answer is stored and indexed like
+any other message, one cut short keeps its status, and rows a restart left 'streaming' are
+recovered as 'interrupted'. Runs with pytest or directly
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from session_manager import SessionManager
+
+# Configuration
+USER = 'tester'
+BATCHES = ['検索結果によると、', 'この機能は2024年に', '導入されました。' * 40]
+
+
+def open_manager(path, write_behind=False):
+    return SessionManager(path, write_behind=write_behind, compress_existing=False)
+
+
+def stream_answer(manager, status, finish=True):
+    """A chat with a question and a streamed answer; returns (chat_id, StreamingMessage)"""
+    chat_id = manager.create_chat(USER)
+    manager.add_message(chat_id, 'user', '質問')
+    message = manager.start_message(chat_id)
+    for text in BATCHES:
+        manager.append_to_message(message, text)
+    if finish:
+        manager.finish_message(message, status)
+    manager.flush()
+    return chat_id, message
+
+
+def last_message(manager, chat_id):
+    return manager.get_chat_messages(chat_id)[-1]
+
+
+def check_streaming(write_behind):
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = open_manager(os.path.join(tmp, 'chat.db'), write_behind)
+        chat_id, _ = stream_answer(manager, None, finish=False)
+        message = last_message(manager, chat_id)
+        assert message['status'] == 'streaming', message['status']
+        assert message['content'] == ''.join(BATCHES)
+        # Not searchable until finished
+        assert not manager.search_messages(USER, '導入されました')['results']
+        manager.close()
+
+
+def test_streaming_text_readable():
+    check_streaming(write_behind=False)
+
+
+def test_streaming_text_readable_write_behind():
+    check_streaming(write_behind=True)
+
+
+def test_finished_and_interrupted():
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = open_manager(os.path.join(tmp, 'chat.db'))
+        for status in (None, 'interrupted'):
+            chat_id, streamed = stream_answer(manager, status)
+            message = last_message(manager, chat_id)
+            assert message['status'] == status, message['status']
+            assert message['content'] == ''.join(BATCHES)
+            assert message['id'] == streamed.id
+        # Both answers are indexed once finished
+        assert len(manager.search_messages(USER, '導入されました')['results']) == 2
+        # Text appended after the end is ignored
+        manager.append_to_message(streamed, 'extra')
+        manager.flush()
+        assert last_message(manager, chat_id)['content'] == ''.join(BATCHES)
+        manager.close()
+
+
+def test_recover_after_restart():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'chat.db')
+        manager = open_manager(path)
+        chat_id, _ = stream_answer(manager, None, finish=False)
+        manager.close()
+        # The process died mid-answer: the next start finishes the row
+        manager = open_manager(path)
+        message = last_message(manager, chat_id)
+        assert message['status'] == 'interrupted', message['status']
+        assert message['content'] == ''.join(BATCHES)
+        assert manager.search_messages(USER, '導入されました')['results']
+        with manager.pool.connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM message_parts').fetchone()[0] == 0
+        manager.close()
+
+
+def main():
+    print("streamed answer persistence")
+    print("=" * 80)
+    failed = 0
+    for test in (test_streaming_text_readable, test_streaming_text_readable_write_behind,
+                 test_finished_and_interrupted, test_recover_after_restart):
+        try:
+            test()
+            print(f"ok    {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()